@@ -5,13 +5,18 @@
 2. elastic search 搜查核中心報告跟社稿 (用embedding搜)
 3. 解釋查核點 -> 評估與提問機器人 -> 重新生成解釋 (最多重複3次) -> 最終寫報告
 """
-from agents import Agent, Runner, RunContextWrapper, handoff
+from agents import Agent, Runner, RunContextWrapper, RunConfig, OpenAIProvider, handoff
 from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX
 from pydantic import BaseModel, Field
 from typing import Optional, List
+import time
 import asyncio
 from openai.types.responses import ResponseTextDeltaEvent
 from functions import *
+from clients import get_async_openai_client
+from deadline import Deadline, DeadlineExceeded, DEADLINE_MIN_GENERATION
+from tracing import start_span
+from usage_ledger import record_usage, AGENT_DEFAULT_MODEL
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -19,6 +24,71 @@ load_dotenv()
 
 today = datetime.now().strftime("%Y-%m-%d")
 
+def shared_run_config():
+    """讓 agent 使用共用連線池的 AsyncOpenAI，而不是 SDK 預設各自建立的 client"""
+    return RunConfig(model_provider=OpenAIProvider(openai_client=get_async_openai_client()))
+
+DEADLINE_NOTICE = "\n\n（已達查核時間上限，內容可能不完整）"
+
+async def stream_events(result, deadline=None, stage="agent", floor=0.0):
+    """
+    逐一取出 agent run 的 stream 事件；超過 deadline 分給該階段的時間時取消 run 並拋出 DeadlineExceeded
+    每次 run 記成一個 agent.<stage> span，結束時附上 token 用量，並以 stage 記入用量帳本
+    :param floor: 必要的階段即使預算用完也至少給這麼多秒
+    """
+    run_span = start_span(f"agent.{stage}", agent=result.current_agent.name)
+    started_at = time.monotonic()
+    try:
+        async for event in _deadline_events(result, deadline, stage, floor):
+            yield event
+    except Exception as e:
+        run_span.record_error(e)
+        raise
+    finally:
+        usage = usage_attributes(result)
+        run_span.set_attributes(**usage)
+        run_span.end()
+        # 逾時中止的 run 已產生的用量也要記錄
+        if usage.get("requests"):
+            record_usage(stage, agent_model(result.current_agent), usage["input_tokens"], usage["output_tokens"],
+                         usage["cached_tokens"] or 0, time.monotonic() - started_at, usage["requests"])
+
+def agent_model(agent):
+    """agent 的模型名稱；沒有指定或不是字串（自訂 Model 物件）時記為 AGENT_DEFAULT_MODEL"""
+    return agent.model if isinstance(agent.model, str) and agent.model else AGENT_DEFAULT_MODEL
+
+def usage_attributes(result):
+    """agent run 的 token 用量，run 尚未產生用量時回傳空 dict"""
+    usage = getattr(result.context_wrapper, "usage", None)
+    if usage is None:
+        return {}
+    details = getattr(usage, "input_tokens_details", None)
+    return {
+        "requests": usage.requests,
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", None),
+    }
+
+async def _deadline_events(result, deadline, stage, floor):
+    if deadline is None:
+        async for event in result.stream_events():
+            yield event
+        return
+    timeout = deadline.for_stage(stage, floor=floor)
+    expires_at = asyncio.get_running_loop().time() + timeout
+    events = result.stream_events().__aiter__()
+    while True:
+        try:
+            event = await asyncio.wait_for(events.__anext__(), max(0.0, expires_at - asyncio.get_running_loop().time()))
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            result.cancel()
+            print(f"[Info] {stage} 超過查核時間預算，已中止（{deadline}）")
+            raise DeadlineExceeded(stage, deadline) from None
+        yield event
+
 # 提問Agent
 
 class QAEval(BaseModel):
@@ -113,7 +183,7 @@ Q5. 我認同這個解釋嗎？
 
 
 # 生成查核結果
-async def generate_explanation(user_input, check_points, resources, question: str = ""):
+async def generate_explanation(user_input, check_points, resources, question: str = "", deadline: Optional[Deadline] = None):
 
     prompt = f"""{RECOMMENDED_PROMPT_PREFIX}
 <role>
@@ -174,14 +244,18 @@ async def generate_explanation(user_input, check_points, resources, question: st
     
     _input = f"使用者要查核的內容: {user_input}\n查核點: {check_points}\n證據資料: {resources}\n提問: {question}"
 
-    response = Runner.run_streamed(explain_agent, _input)
+    response = Runner.run_streamed(explain_agent, _input, run_config=shared_run_config())
 
     full_text = ""
-    async for event in response.stream_events():
-        # 仍可逐 token 顯示
-        if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
-            print(event.data.delta, end="", flush=True)
-            full_text += event.data.delta
+    try:
+        async for event in stream_events(response, deadline, "explanation", DEADLINE_MIN_GENERATION):
+            # 仍可逐 token 顯示
+            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                print(event.data.delta, end="", flush=True)
+                full_text += event.data.delta
+    except DeadlineExceeded:
+        # 逾時時以已生成的部分當作草稿
+        return full_text + DEADLINE_NOTICE
 
     print("\n" + "="*50)
 
@@ -194,9 +268,10 @@ async def generate_explanation(user_input, check_points, resources, question: st
 
     return explanation_text
 
-async def generate_explanation_streaming(user_input, check_points, resources, question: str = ""):
+async def generate_explanation_streaming(user_input, check_points, resources, question: str = "", deadline: Optional[Deadline] = None):
     """
     Streaming版本的generate_explanation，用於Streamlit的st.write_stream
+    :param deadline: 超過時間預算時停止生成，並在結尾加上提示
     """
     prompt = f"""{RECOMMENDED_PROMPT_PREFIX}
 <role>
@@ -257,20 +332,23 @@ async def generate_explanation_streaming(user_input, check_points, resources, qu
 
     _input = f"使用者要查核的內容: {user_input}\n查核點: {check_points}\n證據資料: {resources}\n提問: {question}"
 
-    response = Runner.run_streamed(explain_agent, _input)
+    response = Runner.run_streamed(explain_agent, _input, run_config=shared_run_config())
 
     # 逐個yield streaming內容
     full_response = ""
-    async for event in response.stream_events():
-        if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
-            full_response += event.data.delta
-            yield event.data.delta
+    try:
+        async for event in stream_events(response, deadline, "explanation", DEADLINE_MIN_GENERATION):
+            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                full_response += event.data.delta
+                yield event.data.delta
+    except DeadlineExceeded:
+        yield DEADLINE_NOTICE
     
     print(f"[Callback] Explanation: \n{full_response[:100]}...\n\n")
 
     # 不需要在這裡print，因為Streamlit會處理顯示
 
-async def final_report_agent(history: str, check_points: str, user_input: str, resources: str):
+async def final_report_agent(history: str, check_points: str, user_input: str, resources: str, deadline: Optional[Deadline] = None):
     final_report_agent = Agent(
         name="final_report_agent",
         model="gpt-4.1",
@@ -333,11 +411,16 @@ async def final_report_agent(history: str, check_points: str, user_input: str, r
 
     input_text = f"history: {history}\ncheck_points: {check_points}\nuser_input: {user_input}\nresources: {resources}"
 
-    final_report = Runner.run_streamed(final_report_agent, input_text)
+    final_report = Runner.run_streamed(final_report_agent, input_text, run_config=shared_run_config())
     
-    async for event in final_report.stream_events():
-        if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
-            print(event.data.delta, end="", flush=True)
+    full_text = ""
+    try:
+        async for event in stream_events(final_report, deadline, "final_report", DEADLINE_MIN_GENERATION):
+            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                print(event.data.delta, end="", flush=True)
+                full_text += event.data.delta
+    except DeadlineExceeded:
+        return full_text + DEADLINE_NOTICE
     print("\n" + "="*50)
 
     try:
@@ -348,7 +431,7 @@ async def final_report_agent(history: str, check_points: str, user_input: str, r
 
     return final_report.final_output
 
-async def final_report_agent_streaming(history: str, check_points: str, user_input: str, resources: str):
+async def final_report_agent_streaming(history: str, check_points: str, user_input: str, resources: str, deadline: Optional[Deadline] = None):
     """
     Streaming版本的final_report_agent，用於Streamlit的st.write_stream
     """
@@ -412,23 +495,29 @@ async def final_report_agent_streaming(history: str, check_points: str, user_inp
 
     input_text = f"history: {history}\ncheck_points: {check_points}\nuser_input: {user_input}\nresources: {resources}"
 
-    final_report = Runner.run_streamed(final_report_agent, input_text)
+    final_report = Runner.run_streamed(final_report_agent, input_text, run_config=shared_run_config())
 
     # 逐個yield streaming內容
     full_response = ""
-    async for event in final_report.stream_events():
-        if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
-            full_response += event.data.delta
-            yield event.data.delta
+    try:
+        async for event in stream_events(final_report, deadline, "final_report", DEADLINE_MIN_GENERATION):
+            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                full_response += event.data.delta
+                yield event.data.delta
+    except DeadlineExceeded:
+        yield DEADLINE_NOTICE
     
     print(f"[Callback] Final Report: \n{full_response}...\n\n")
 
-async def run_question_review(draft_report: str, check_points: str):
+async def run_question_review(draft_report: str, check_points: str, deadline: Optional[Deadline] = None):
+    """
+    :param deadline: 超過時間預算時拋出 DeadlineExceeded，由呼叫端決定略過評估
+    """
     review_input = f"draft_report: {draft_report}\ncheck_points: {check_points}"
-    result = Runner.run_streamed(questioners_agent, review_input)
+    result = Runner.run_streamed(questioners_agent, review_input, run_config=shared_run_config())
 
     # 不需要逐 token 時，可以只監聽語義事件或直接拿 final
-    async for _ in result.stream_events():
+    async for _ in stream_events(result, deadline, "review"):
         pass
 
     eval_obj: QAEval = result.final_output  # 已是 QAEval
@@ -564,14 +653,16 @@ if __name__ == "__main__":
 
     converted_text = date_noun_converter(user_input)
 
-    check_points_data = get_check_points(converted_text, media_name="Chiming")
+    # 互動階段要等使用者輸入，deadline 只涵蓋查核點與搜尋
+    deadline = Deadline()
+    check_points_data = get_check_points(converted_text, media_name="Chiming", deadline=deadline)
     if check_points_data["Result"] == "Y":
         check_points = check_points_data["ResultData"]["check_points"]
     else:
         check_points = None
         print("[Info] 查核點 API 失敗")
 
-    resources = es_resources(converted_text)
+    resources = es_resources(converted_text, deadline=deadline)
 
     async def main():
         result = await run_interactive_fact_check(
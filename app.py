@@ -4,13 +4,32 @@
 """
 import streamlit as st
 import asyncio
-from functions import get_check_points, es_resources, date_noun_converter
+import functools
+import contextvars
+from functions import es_resources_async, date_noun_converter, text_embeddings_3
+from check_points import get_check_points_async
+from es_SearchLib import es, register_stored_scripts, register_search_templates
+from es_SearchLib_async import close_async_es
+from clients import close_async_clients
+from factcheck_cache import get_factcheck_cache, FACTCHECK_CACHE_ENABLED
+from deadline import Deadline, DeadlineExceeded, DEADLINE_MIN_GENERATION, DEADLINE_MIN_REVIEW
+from tracing import span, set_attributes
+from usage_ledger import get_usage_ledger, fact_check_scope, new_fact_check_id
 from agentic import (
     generate_explanation_streaming,
     run_question_review,
     final_report_agent_streaming
 )
 from datetime import datetime
+import re
+
+async def _closing_clients(coroutine):
+    """臨時建立的事件循環結束前關閉該 loop 的 AsyncElasticsearch、AsyncOpenAI 與 httpx.AsyncClient"""
+    try:
+        return await coroutine
+    finally:
+        await close_async_es()
+        await close_async_clients()
 
 def run_async_sync(coroutine):
     """同步執行異步函數的輔助函數"""
@@ -25,18 +44,27 @@ def run_async_sync(coroutine):
                 new_loop = asyncio.new_event_loop()
                 asyncio.set_event_loop(new_loop)
                 try:
-                    return new_loop.run_until_complete(coroutine)
+                    return new_loop.run_until_complete(_closing_clients(coroutine))
                 finally:
                     new_loop.close()
 
+            # 新執行緒不會繼承 contextvars，複製目前的 context 讓 span 接在呼叫端底下
             with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(run_in_thread)
+                future = executor.submit(contextvars.copy_context().run, run_in_thread)
                 return future.result()
         else:
             return loop.run_until_complete(coroutine)
     except RuntimeError:
         # 沒有事件循環，創建一個新的
-        return asyncio.run(coroutine)
+        return asyncio.run(_closing_clients(coroutine))
+
+STREAM_CHUNK_TIMEOUT = 30
+
+def _chunk_timeout(deadline):
+    """等待下一個 chunk 的秒數；有 deadline 時由 agent 端自行中止，這裡只多留一點緩衝"""
+    if deadline is None:
+        return STREAM_CHUNK_TIMEOUT
+    return max(deadline.remaining(), DEADLINE_MIN_GENERATION) + 5
 
 def create_streaming_generator_with_result(async_streaming_func, *args, **kwargs):
     """創建同步的 generator 來包裝異步 streaming 函數，並返回完整文本"""
@@ -57,18 +85,18 @@ def create_streaming_generator_with_result(async_streaming_func, *args, **kwargs
                     result_queue.put(chunk)
                 result_queue.put(None)  # 結束信號
 
-            new_loop.run_until_complete(collect_chunks())
+            new_loop.run_until_complete(_closing_clients(collect_chunks()))
         finally:
             new_loop.close()
 
     # 在背景線程中運行異步函數
     with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(run_async_streaming)
+        future = executor.submit(contextvars.copy_context().run, run_async_streaming)
 
         def generator():
             while True:
                 try:
-                    chunk = result_queue.get(timeout=30)  # 30秒超時
+                    chunk = result_queue.get(timeout=_chunk_timeout(kwargs.get("deadline")))
                     if chunk is None:  # 結束信號
                         break
                     yield chunk
@@ -85,6 +113,27 @@ def create_streaming_generator(async_streaming_func, *args, **kwargs):
     generator, _ = create_streaming_generator_with_result(async_streaming_func, *args, **kwargs)
     return generator
 
+def fact_check_step(name, new=False):
+    """
+    查核的各個步驟包成 span 並設定用量帳本的查核 ID
+    之後的步驟（提問、最終報告）在之後的 rerun 執行，以 session 的 fact_check_id 接回同一個 trace 與帳本紀錄
+    :param new: True 時開始新的查核，產生新的 fact_check_id
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if new:
+                st.session_state.fact_check_id = new_fact_check_id()
+            fact_check_id = st.session_state.get("fact_check_id")
+            with fact_check_scope(fact_check_id), span(name, trace_id=fact_check_id, round=st.session_state.get("round_num")):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def escape_references(text):
+    # 將 [1], [2], [3] 等轉換為 \[1\], \[2\], \[3\] 以避免被誤認為列表
+    return re.sub(r'\[(\d+)\]', r'\\[\1\\]', text)
+
 class StreamlitFactCheckBot:
     def __init__(self):
         pass
@@ -100,23 +149,38 @@ class StreamlitFactCheckBot:
         st.session_state.history = []
         st.session_state.messages = []
         st.session_state.ai_suggested_question = None
+        st.session_state.reused_fact_check = None
+        st.session_state.fact_check_id = None
 
 
-    def start_fact_check(self, user_input: str, media_name: str = "Chiming"):
-        """開始事實查核流程"""
+    @fact_check_step("fact_check", new=True)
+    def start_fact_check(self, user_input: str, media_name: str = "Chiming", refresh: bool = False):
+        """
+        開始事實查核流程
+        :param refresh: True 時不沿用先前相同或相似傳言的查核結果，重新查核
+        """
         # 重置狀態（但保留messages）
         st.session_state.fact_check_state = "starting"
         st.session_state.current_draft = None
         st.session_state.check_points = None
         st.session_state.resources = None
         st.session_state.user_input = user_input
+        st.session_state.media_name = media_name
         st.session_state.round_num = 1
         st.session_state.history = []
         st.session_state.ai_suggested_question = None
+        st.session_state.reused_fact_check = None
+        set_attributes(media_name=media_name, refresh=refresh, input_chars=len(user_input))
+        # 整個查核共用的時間預算，各步驟只用剩餘時間，不夠時略過 AI 評估
+        deadline = Deadline()
+
+        # 步驟0: 先前查核過相同或相似的傳言時直接沿用
+        if not refresh and self.reuse_fact_check(user_input, media_name):
+            return
 
         # 步驟1: 分析查核點
         with st.spinner("🔍 正在分析查核點..."):
-            check_points_data = get_check_points(user_input, media_name)
+            check_points_data = run_async_sync(get_check_points_async(user_input, media_name, deadline=deadline))
             if check_points_data["Result"] == "Y":
                 check_points = check_points_data["ResultData"]["check_points"]
                 st.session_state.check_points = check_points
@@ -156,7 +220,7 @@ class StreamlitFactCheckBot:
 
         # 步驟2: 搜索相關資源
         with st.spinner("📚 正在搜索相關證據資料..."):
-            resources = es_resources(user_input)
+            resources = run_async_sync(es_resources_async(user_input, deadline=deadline))
             st.session_state.resources = resources
             with st.chat_message("assistant"):
                 st.markdown(f"**一共找到{len(resources)}筆證據資料**")
@@ -173,7 +237,7 @@ class StreamlitFactCheckBot:
                 def explanation_generator():
                     return create_streaming_generator(
                         generate_explanation_streaming,
-                        user_input, check_points, resources, ""
+                        user_input, check_points, resources, "", deadline=deadline
                     )
                 draft = st.write_stream(explanation_generator())
 
@@ -185,11 +249,15 @@ class StreamlitFactCheckBot:
             "content": f"**初步查核結果**\n\n{draft}"
         })
 
-        # 步驟4: AI評估
+        # 步驟4: AI評估（剩餘時間不足時略過）
         # 預先顯示AI評估開始訊息
         with st.chat_message("assistant"):
             with st.spinner("👁️‍🗨️ 正在評估查核結果..."):
-                eval_result = run_async_sync(run_question_review(draft, check_points))
+                eval_result = self.review_within_deadline(draft, check_points, deadline)
+                print(f"[Info] 查核流程 {deadline}")
+                if eval_result is None:
+                    self.skip_review()
+                    return
 
                 eval_result_content = f"""📊 **AI評估結果：**\n\n
 •  說服力: {eval_result.persuasiveness}/5\n
@@ -245,6 +313,67 @@ class StreamlitFactCheckBot:
         st.session_state.fact_check_state = "waiting_user_choice"
         st.session_state.ai_suggested_question = eval_result.improvement_question
 
+    def review_within_deadline(self, draft: str, check_points, deadline: Deadline):
+        """剩餘時間足夠時執行 AI 評估；時間不足或評估逾時回傳 None"""
+        if deadline.for_stage("review") < DEADLINE_MIN_REVIEW:
+            print(f"[Info] 剩餘時間不足，略過AI評估（{deadline}）")
+            return None
+        try:
+            return run_async_sync(run_question_review(draft, check_points, deadline=deadline))
+        except DeadlineExceeded:
+            return None
+
+    def skip_review(self):
+        """略過 AI 評估：沒有建議的問題，使用者可以自行提問或直接生成最終報告"""
+        skip_content = "⏱️ 已接近查核時間上限，略過AI評估。可以自行輸入問題，或直接生成最終報告。"
+        st.markdown(skip_content)
+        st.session_state.messages.append({"role": "assistant", "content": skip_content})
+        st.session_state.round_num += 1
+        st.session_state.fact_check_state = "waiting_user_choice"
+        st.session_state.ai_suggested_question = None
+
+    def reuse_fact_check(self, user_input: str, media_name: str):
+        """找到可沿用的查核時顯示先前的查核點、參考資料與最終報告，回傳是否沿用"""
+        if not FACTCHECK_CACHE_ENABLED:
+            return False
+        try:
+            with st.spinner("🗂️ 正在比對先前的查核..."):
+                entry = get_factcheck_cache().lookup(user_input, text_embeddings_3, media_name)
+        except Exception as e:
+            print(f"[Error] 查核快取查詢失敗: {str(e)}")
+            return False
+        if entry is None:
+            return False
+
+        checked_at = datetime.fromtimestamp(entry["created_at"]).strftime('%Y-%m-%d %H:%M')
+        if entry["match"] == "exact":
+            notice = f"♻️ 此訊息已於 {checked_at} 查核過，以下沿用當時的查核結果"
+        else:
+            notice = f"♻️ 找到 {checked_at} 查核過的相似訊息（相似度 {entry['similarity']:.2f}），以下沿用當時的查核結果：\n\n> {entry['claim']}"
+        print(f"[Info] 沿用查核 #{entry['id']}（{entry['match']}，相似度 {entry['similarity']}）")
+        set_attributes(reused_fact_check=entry["id"], reuse_match=entry["match"], reuse_similarity=entry["similarity"])
+
+        st.session_state.check_points = entry["check_points"]
+        st.session_state.resources = entry["resources"]
+        st.session_state.current_draft = entry["final_report"]
+        st.session_state.reused_fact_check = entry["id"]
+
+        check_points = entry["check_points"]
+        check_points_text = "\n".join(map(str, check_points)) if isinstance(check_points, list) else f"{check_points or '無'}"
+        contents = [
+            notice,
+            f"**查核點：**\n\n{check_points_text}",
+            f"一共找到{len(entry['resources'] or [])}筆證據資料",
+            f"**最終查核報告：**\n\n{escape_references(entry['final_report'])}",
+        ]
+        for content in contents:
+            with st.chat_message("assistant"):
+                st.markdown(content)
+            st.session_state.messages.append({"role": "assistant", "content": content})
+
+        st.session_state.fact_check_state = "completed"
+        return True
+
     def handle_user_choice(self, choice: str):
         """處理用戶選擇"""
         choice = choice.strip()
@@ -265,6 +394,7 @@ class StreamlitFactCheckBot:
             # 生成最終報告
             self.generate_final_report()
 
+    @fact_check_step("fact_check.improvement")
     def apply_improvement(self, improvement_question: str):
         """應用改善問題並重新生成"""
         if st.session_state.fact_check_state != "waiting_for_improvement_choice":
@@ -350,6 +480,7 @@ class StreamlitFactCheckBot:
                 st.session_state.fact_check_state = "waiting_for_improvement_choice"
                 st.session_state.ai_suggested_question = eval_result.improvement_question
 
+    @fact_check_step("fact_check.question")
     def continue_with_question(self, question: str, source: str):
         """繼續查核流程處理問題"""
         with st.chat_message("assistant"):
@@ -454,6 +585,7 @@ class StreamlitFactCheckBot:
             st.session_state.fact_check_state = "waiting_user_choice"
             st.session_state.ai_suggested_question = eval_result.improvement_question
 
+    @fact_check_step("fact_check.final_report")
     def generate_final_report(self):
         """生成最終報告"""
         # 構建完整歷史
@@ -484,11 +616,6 @@ class StreamlitFactCheckBot:
             final_report = full_text_ref["text"]
 
         # 處理 Markdown 格式 - 轉義參考資料編號以避免解析問題
-        def escape_references(text):
-            import re
-            # 將 [1], [2], [3] 等轉換為 \[1\], \[2\], \[3\] 以避免被誤認為列表
-            return re.sub(r'\[(\d+)\]', r'\\[\1\\]', text)
-
         escaped_final_report = escape_references(final_report)
 
         # 記錄最終查核報告 - 使用轉義後的內容保持 Markdown 格式
@@ -507,6 +634,26 @@ class StreamlitFactCheckBot:
         })
 
         st.session_state.fact_check_state = "completed"
+        self.store_fact_check(final_report)
+        if st.session_state.fact_check_id:
+            print(f"[Info] 查核 {st.session_state.fact_check_id} 用量: {get_usage_ledger().summary(st.session_state.fact_check_id)}")
+
+    def store_fact_check(self, final_report: str):
+        """把完成的查核存進快取，之後相同或相似的傳言可以直接沿用"""
+        if not FACTCHECK_CACHE_ENABLED or not final_report:
+            return
+        try:
+            user_input = st.session_state.user_input
+            get_factcheck_cache().store(
+                user_input,
+                text_embeddings_3(user_input),
+                st.session_state.check_points,
+                st.session_state.resources,
+                final_report,
+                st.session_state.get("media_name", "Chiming"),
+            )
+        except Exception as e:
+            print(f"[Error] 查核快取寫入失敗: {str(e)}")
 
 
 def init_session_state():
@@ -529,6 +676,10 @@ def init_session_state():
         st.session_state.history = []
     if "ai_suggested_question" not in st.session_state:
         st.session_state.ai_suggested_question = None
+    if "reused_fact_check" not in st.session_state:
+        st.session_state.reused_fact_check = None
+    if "fact_check_id" not in st.session_state:
+        st.session_state.fact_check_id = None
 
 def display_chat_message(role: str, content: str):
     """顯示聊天訊息"""
@@ -536,6 +687,12 @@ def display_chat_message(role: str, content: str):
         st.markdown(content)
 
 
+@st.cache_resource
+def setup_search():
+    """每個 process 只做一次：確認 ES 上的 stored scripts 與 search templates 已註冊"""
+    return {"stored_scripts": register_stored_scripts(es), "search_templates": register_search_templates(es)}
+
+
 def main():
     """主應用介面"""
     st.set_page_config(
@@ -543,6 +700,7 @@ def main():
         page_icon="🔍",
         layout="wide"
     )
+    setup_search()
 
     st.title("🔍 AskCNA - 事實查核助手")
 
@@ -581,7 +739,8 @@ def main():
         if "button_clicked" not in st.session_state:
             st.session_state.button_clicked = None
 
-        if st.button("1. 採用AI建議的問題", key="use_ai_btn"):
+        # 略過 AI 評估時沒有建議的問題
+        if st.session_state.ai_suggested_question and st.button("1. 採用AI建議的問題", key="use_ai_btn"):
             st.session_state.button_clicked = "1"
 
         if st.button("2. 自行輸入問題", key="custom_btn"):
@@ -601,7 +760,13 @@ def main():
                 st.error(f"❌ 處理選擇時發生錯誤: {str(e)}")
 
     elif st.session_state.fact_check_state == "completed":
-        pass
+        # 沿用先前的查核時，可以選擇重新查核
+        if st.session_state.reused_fact_check is not None and st.button("🔄 重新查核（不沿用先前的結果）", key="refresh_btn"):
+            try:
+                bot.start_fact_check(st.session_state.user_input, st.session_state.get("media_name", "Chiming"), refresh=True)
+                st.rerun()
+            except Exception as e:
+                st.error(f"❌ 重新查核時發生錯誤: {str(e)}")
 
     # 聊天輸入 - 根據狀態顯示不同提示文字，但始終顯示
     input_placeholder = "請輸入要查核的新聞或消息..."
@@ -0,0 +1,86 @@
+"""
+Micro-batching 工具
+
+把多個執行緒 / 協程在短時間窗口內送來的單筆請求收集起來，
+合併成一次批次呼叫，再把結果依序分回給各個呼叫者。
+Streamlit 每個 session 跑在自己的執行緒，所以這裡用背景執行緒 + Future 實作。
+批次函數在背景執行緒自己的 context 中執行，不屬於任何一個呼叫者；
+需要依呼叫者記錄的資訊（例如 tracing 的 span、用量帳本）請放進各筆的回傳結果，由呼叫端在自己的 context 記錄。
+"""
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+class MicroBatcher:
+    """
+    :param batch_fn: 批次函數，輸入 list，回傳等長且同順序的 list
+    :param max_wait_ms: 第一筆請求進來後最多等多久再送出
+    :param max_batch_size: 單一批次最多幾筆
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_wait_ms=5, max_batch_size=64, name="micro-batcher"):
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def submit(self, item) -> Future:
+        """送出一筆請求，回傳 concurrent.futures.Future"""
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """同步取得單筆結果"""
+        return self.submit(item).result(timeout=timeout)
+
+    async def submit_async(self, item):
+        """在 asyncio 事件循環中等待單筆結果"""
+        return await asyncio.wrap_future(self.submit(item))
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # 已取消的請求（例如 submit_async 的呼叫端被 cancel）直接略過；其餘標記為執行中，之後無法再被取消
+            batch = [(item, future) for item, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"批次結果數量不符：送出 {len(items)} 筆，收到 {len(results)} 筆")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,68 @@
+"""
+向量搜尋：kNN (HNSW) vs script_score 效能比較
+
+python -m benchmarks.knn_vs_script_score [--index lab_mainsite_search] [--queries 50] [--k 10] [--num-candidates 100]
+
+從索引中隨機抽文件，用它們的向量當查詢，
+script_score（精確搜尋）的結果當作標準答案，計算 kNN 的 recall@k 與兩者的延遲。
+"""
+import time
+import argparse
+import statistics
+
+from es_SearchLib import es, es_vector_search, _knn_unsupported
+
+
+def sample_query_vectors(index, embedding_column_name, n):
+    response = es.search(index=index, body={
+        "size": n,
+        "query": {"function_score": {"query": {"exists": {"field": embedding_column_name}}, "random_score": {}}},
+        "_source": [embedding_column_name],
+    })
+    return [hit['_source'][embedding_column_name] for hit in response['hits']['hits']]
+
+
+def timed_search(index, embedding_column_name, vector, k, method, num_candidates):
+    start = time.perf_counter()
+    hits = es_vector_search(es, index, embedding_column_name, vector, recall_size=k, includes=["_id"],
+                            method=method, num_candidates=num_candidates)
+    return (time.perf_counter() - start) * 1000, [hit['_id'] for hit in hits]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="kNN vs script_score")
+    parser.add_argument("--index", default="lab_mainsite_search")
+    parser.add_argument("--field", default="embeddings")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=None)
+    args = parser.parse_args()
+
+    vectors = sample_query_vectors(args.index, args.field, args.queries)
+    print(f"[Info] 取得 {len(vectors)} 筆查詢向量（{args.index}.{args.field}）")
+
+    latency = {"script_score": [], "knn": []}
+    recalls = []
+    for vector in vectors:
+        exact_ms, exact_ids = timed_search(args.index, args.field, vector, args.k, "script_score", None)
+        knn_ms, knn_ids = timed_search(args.index, args.field, vector, args.k, "knn", args.num_candidates)
+        if (args.index, args.field) in _knn_unsupported:
+            print(f"[Error] {args.index}.{args.field} 沒有 HNSW mapping，無法比較")
+            return
+        latency["script_score"].append(exact_ms)
+        latency["knn"].append(knn_ms)
+        recalls.append(len(set(exact_ids) & set(knn_ids)) / max(1, len(exact_ids)))
+
+    print("\n" + "=" * 60)
+    for method, values in latency.items():
+        print(f"{method:<13} 平均 {statistics.mean(values):8.1f} ms  p50 {percentile(values, 0.5):8.1f} ms  p95 {percentile(values, 0.95):8.1f} ms")
+    print(f"kNN recall@{args.k}：{statistics.mean(recalls):.3f}（最低 {min(recalls):.2f}）")
+
+
+if __name__ == "__main__":
+    main()
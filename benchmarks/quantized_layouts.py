@@ -0,0 +1,68 @@
+"""
+降維 / 量化索引：recall 與延遲比較
+
+python -m benchmarks.quantized_layouts lab_mainsite_search_1024_int8 lab_mainsite_search_1024_byte \
+    [--baseline lab_mainsite_search] [--queries 50] [--k 10] [--method knn]
+
+從原始索引隨機抽文件，用它們的 3072 維向量當查詢，
+原始索引的 script_score（精確搜尋）結果當作標準答案，
+比較每個候選索引（migrate_index.py 建出，文件 _id 相同）的 recall@k、延遲、查詢向量大小與索引大小。
+"""
+import json
+import time
+import argparse
+import statistics
+
+from es_SearchLib import es, es_vector_search, fit_query_vector
+from migrate_index import index_size
+from benchmarks.knn_vs_script_score import sample_query_vectors, percentile
+
+
+def timed_search(index, embedding_column_name, vector, k, method, num_candidates):
+    start = time.perf_counter()
+    hits = es_vector_search(es, index, embedding_column_name, vector, recall_size=k, includes=["_id"],
+                            method=method, num_candidates=num_candidates)
+    return (time.perf_counter() - start) * 1000, [hit['_id'] for hit in hits]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="降維 / 量化索引比較")
+    parser.add_argument("candidates", nargs="+", help="要比較的索引")
+    parser.add_argument("--baseline", default="lab_mainsite_search")
+    parser.add_argument("--field", default="embeddings")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--method", choices=["knn", "script_score"], default="knn")
+    parser.add_argument("--num-candidates", type=int, default=None)
+    args = parser.parse_args()
+
+    vectors = sample_query_vectors(args.baseline, args.field, args.queries)
+    print(f"[Info] 取得 {len(vectors)} 筆查詢向量（{args.baseline}.{args.field}）")
+
+    truth = []
+    latency = {args.baseline: []}
+    for vector in vectors:
+        ms, ids = timed_search(args.baseline, args.field, vector, args.k, "script_score", None)
+        latency[args.baseline].append(ms)
+        truth.append(set(ids))
+
+    recalls = {}
+    for index in args.candidates:
+        latency[index], recalls[index] = [], []
+        for vector, expected in zip(vectors, truth):
+            ms, ids = timed_search(index, args.field, vector, args.k, args.method, args.num_candidates)
+            latency[index].append(ms)
+            recalls[index].append(len(expected & set(ids)) / max(1, len(expected)))
+
+    print("\n" + "=" * 100)
+    print(f"{'索引':<40}{'recall@' + str(args.k):>10}{'p50 ms':>10}{'p95 ms':>10}{'向量 KB':>10}{'索引 MB':>12}")
+    for index, values in latency.items():
+        vector_kb = len(json.dumps(fit_query_vector(es, index, args.field, vectors[0]))) / 1024
+        _, size = index_size(es, index)
+        recall = f"{statistics.mean(recalls[index]):.3f}" if index in recalls else "1.000"
+        print(f"{index:<40}{recall:>10}{percentile(values, 0.5):>10.1f}{percentile(values, 0.95):>10.1f}"
+              f"{vector_kb:>10.1f}{size / 1024 / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
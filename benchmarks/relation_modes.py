@@ -0,0 +1,95 @@
+"""
+相關性判斷：逐筆 vs 批次 效能比較
+
+python -m benchmarks.relation_modes "要查核的文本" ["要查核的文本2" ...]
+
+同一組 ES 候選資料分別用
+1. single：每筆一次 gpt-4.1 呼叫（併發）
+2. batch：所有候選資料一次呼叫
+比較耗時、request 數、token 數，以及兩種模式判斷結果的一致率。
+"""
+import sys
+import time
+import asyncio
+
+from clients import get_async_openai_client
+from functions import (
+    text_embeddings_3, date_noun_converter, _search_resources, _cna_resource, _tfc_resource, _candidate_ids,
+    _relation_input, _relation_batch_input, _relation_batch_result,
+    Relation, RelationBatch, RELATION_MODEL,
+)
+
+
+def get_candidates(text):
+    cna_res, tfc_res = _search_resources(text_embeddings_3(text), text)
+    return [_cna_resource(item['_source']) for item in cna_res] + [_tfc_resource(item['_source']) for item in tfc_res]
+
+
+async def run_single(text, candidates):
+    client = get_async_openai_client()
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(
+        client.responses.parse(model=RELATION_MODEL, input=_relation_input(text, data['summary']), text_format=Relation)
+        for data in candidates
+    ))
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "requests": len(responses),
+        "input_tokens": sum(r.usage.input_tokens for r in responses),
+        "output_tokens": sum(r.usage.output_tokens for r in responses),
+        "verdicts": [r.output_parsed.relation for r in responses],
+    }
+
+
+async def run_batch(text, candidates):
+    client = get_async_openai_client()
+    ids = _candidate_ids(candidates)
+    pairs = [(cid, data['summary']) for cid, data in zip(ids, candidates)]
+    start = time.perf_counter()
+    response = await client.responses.parse(model=RELATION_MODEL, input=_relation_batch_input(text, pairs), text_format=RelationBatch)
+    elapsed = time.perf_counter() - start
+    verdicts = _relation_batch_result(response, pairs)
+    return {
+        "seconds": elapsed,
+        "requests": 1,
+        "input_tokens": response.usage.input_tokens,
+        "output_tokens": response.usage.output_tokens,
+        "verdicts": [verdicts[cid] for cid in ids],
+    }
+
+
+async def main(texts):
+    totals = {"single": [], "batch": []}
+    agreements = []
+    for text in texts:
+        text = date_noun_converter(text)
+        candidates = get_candidates(text)
+        if not candidates:
+            print(f"[Info] 沒有候選資料，略過：{text[:30]}")
+            continue
+        single = await run_single(text, candidates)
+        batch = await run_batch(text, candidates)
+        agree = sum(a == b for a, b in zip(single["verdicts"], batch["verdicts"])) / len(candidates)
+        agreements.append(agree)
+        totals["single"].append(single)
+        totals["batch"].append(batch)
+        print(f"\n>>> {text[:30]}... 候選 {len(candidates)} 筆，一致率 {agree:.0%}")
+        for mode, result in (("single", single), ("batch", batch)):
+            print(f"    {mode:<6} {result['seconds']:6.2f} 秒  request {result['requests']:>2}  "
+                  f"input {result['input_tokens']:>6}  output {result['output_tokens']:>5}  "
+                  f"相關 {sum(result['verdicts'])} 筆")
+
+    if agreements:
+        print("\n" + "=" * 60)
+        for mode, results in totals.items():
+            n = len(results)
+            print(f"{mode:<6} 平均 {sum(r['seconds'] for r in results) / n:6.2f} 秒  "
+                  f"平均 input token {sum(r['input_tokens'] for r in results) / n:8.0f}  "
+                  f"總 request {sum(r['requests'] for r in results)}")
+        print(f"平均一致率：{sum(agreements) / len(agreements):.0%}")
+
+
+if __name__ == "__main__":
+    texts = sys.argv[1:] or ["勞動部勞工保險局今天宣布，從明天開始陸續發放國民年金生育保險給付，女性皆可領取3萬9522元，提醒民眾儘速透過網路銀行或存摺明細確認款項，確認是否到帳。"]
+    asyncio.run(main(texts))
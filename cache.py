@@ -0,0 +1,265 @@
+"""
+快取工具
+
+1. 記憶體 LRU 快取（可設定每筆 TTL）
+2. SQLite 磁碟快取，依總大小淘汰最久未使用的資料
+3. 兩層快取：先查記憶體，再查磁碟，並統計命中率
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+### 文字正規化與 key
+def normalize_text(text):
+    """全形半形統一、去頭尾空白、連續空白壓成一個，讓同一則傳言只差空白時也能命中快取"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_key(*parts):
+    """把多個欄位組成固定長度的 sha256 key"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+### embedding 序列化（float32）
+def pack_floats(vector):
+    return array("f", vector).tobytes()
+
+
+def unpack_floats(blob):
+    values = array("f")
+    values.frombytes(blob)
+    return values.tolist()
+
+
+### 命中統計
+class CacheStats:
+    """累計命中次數，另外依小時分桶，方便看每小時省下多少次呼叫"""
+
+    def __init__(self, keep_hours=48):
+        self._lock = threading.Lock()
+        self.keep_hours = keep_hours
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._hourly = OrderedDict()  # "YYYY-MM-DD HH:00" -> [hits, misses]
+
+    def record(self, kind):
+        hour = time.strftime("%Y-%m-%d %H:00")
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+            bucket = self._hourly.setdefault(hour, [0, 0])
+            bucket[1 if kind == "misses" else 0] += 1
+            while len(self._hourly) > self.keep_hours:
+                self._hourly.popitem(last=False)
+
+    def hourly(self):
+        """回傳每小時的 hits、misses 與命中率"""
+        with self._lock:
+            return [
+                {"hour": hour, "hits": hits, "misses": misses,
+                 "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0}
+                for hour, (hits, misses) in self._hourly.items()
+            ]
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+### 記憶體 LRU
+class LRUCache:
+    """執行緒安全的 LRU 快取，每筆資料可帶各自的到期時間"""
+
+    def __init__(self, max_items=1024):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+### SQLite 磁碟快取
+class DiskCache:
+    """
+    以 SQLite 存 bytes 的磁碟快取
+    :param path: SQLite 檔案路徑
+    :param max_bytes: 資料總大小上限，超過時淘汰最久未讀取的資料
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed_at)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        value, _ = self.get_entry(key)
+        return value
+
+    def get_entry(self, key):
+        """回傳 (value, expires_at)；不存在或已過期時回傳 (None, None)"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, size, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            value, size, expires_at = row
+            if expires_at is not None and expires_at < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._total_bytes -= size
+                return None, None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return value, expires_at
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        size = len(value)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, expires_at, now),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._total_bytes -= row[0]
+
+    def _evict(self):
+        # 先清掉過期資料，再依最久未讀取的順序刪到總大小的 90% 以下
+        self._conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        target = int(self.max_bytes * 0.9)
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total > target:
+            rows = self._conn.execute("SELECT key, size FROM cache ORDER BY accessed_at").fetchall()
+            stale = []
+            for key, size in rows:
+                if total <= target:
+                    break
+                stale.append((key,))
+                total -= size
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", stale)
+        self._total_bytes = total
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+### 兩層快取
+class TieredCache:
+    """
+    記憶體 LRU + SQLite 磁碟的兩層快取
+    :param dumps: 寫入磁碟前把值轉成 bytes
+    :param loads: 從磁碟讀出後把 bytes 轉回值
+    :param path: SQLite 路徑；None 代表只用記憶體
+    """
+
+    def __init__(self, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any],
+                 path: Optional[str] = None, max_items=1024, max_bytes=512 * 1024 * 1024):
+        self.dumps = dumps
+        self.loads = loads
+        self.memory = LRUCache(max_items)
+        self.disk = DiskCache(path, max_bytes) if path else None
+        self.stats = CacheStats()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats.record("memory_hits")
+            return value
+        if self.disk is not None:
+            blob, expires_at = self.disk.get_entry(key)
+            if blob is not None:
+                value = self.loads(blob)
+                self.memory.set(key, value, expires_at - time.time() if expires_at else None)
+                self.stats.record("disk_hits")
+                return value
+        self.stats.record("misses")
+        return None
+
+    def set(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, self.dumps(value), ttl)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
@@ -0,0 +1,319 @@
+"""
+查核點 API 的非同步 client
+
+- connect / read timeout 分開設定，不再一次等一小時
+- 5xx、429、逾時、連線錯誤時以指數退避重試
+- 連續失敗達門檻時斷路（circuit breaker），冷卻期間直接回傳失敗，不再打 API
+- 回傳格式：{"Result", "ResultData", "Message"}
+- get_check_points 是同步版本（functions 與命令列使用），以新的事件循環執行 get_check_points_async，行為完全相同
+
+本機測試可以啟動 stub server，再把環境變數 check_points_url 指向它：
+    python -m check_points --stub --port 8099
+    check_points_url=http://127.0.0.1:8099 streamlit run app.py
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from dotenv import load_dotenv
+
+from clients import get_async_http_client, close_async_clients
+from deadline import stage_timeout, DEADLINE_MIN_STAGE
+from tracing import span, traced, set_attributes
+from cache import TieredCache, LRUCache, normalize_text, make_key
+
+load_dotenv()
+
+CHECK_POINTS_URL = os.getenv("check_points_url", "https://get-check-points-1007110536706.asia-east1.run.app")
+# Cloud Run 冷啟動加上 LLM 產生查核點，read timeout 需要比一般 API 長
+CHECK_POINTS_CONNECT_TIMEOUT = float(os.getenv("check_points_connect_timeout", "10"))
+CHECK_POINTS_READ_TIMEOUT = float(os.getenv("check_points_read_timeout", "90"))
+CHECK_POINTS_MAX_ATTEMPTS = int(os.getenv("check_points_max_attempts", "3"))
+CHECK_POINTS_BACKOFF = float(os.getenv("check_points_backoff", "1.0"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 時間預算不足、放棄重試時的訊息；這個結果只代表這次查核沒時間，不寫入快取
+DEADLINE_MESSAGE = "查核時間預算不足"
+
+CHECK_POINTS_CACHE_TTL = int(os.getenv("check_points_cache_ttl", str(24 * 3600)))
+CHECK_POINTS_NEGATIVE_TTL = int(os.getenv("check_points_negative_ttl", "60"))
+
+
+### 回傳格式
+def check_points_result(check_points, message):
+    if check_points:
+        return {"Result": "Y", "ResultData": {"check_points": check_points}, "Message": message}
+    return {"Result": "N", "ResultData": {"check_points": None}, "Message": message}
+
+
+def parse_check_points_response(response_json):
+    """把 API 回傳的 JSON 轉成固定格式"""
+    check_points = []
+    if response_json.get("Result") == "Y" and "ResultData" in response_json:
+        check_points = response_json["ResultData"].get("check_points", [])
+    if check_points:
+        return check_points_result(check_points, "API成功回傳結果")
+    return check_points_result(None, "查核點為空")
+
+
+### 查核點快取
+# 成功結果：記憶體 + 磁碟，TTL 較長；空結果或失敗：只放記憶體，TTL 很短，避免服務中斷時大量重試
+check_points_cache = TieredCache(
+    dumps=lambda result: json.dumps(result, ensure_ascii=False).encode("utf-8"),
+    loads=lambda blob: json.loads(blob.decode("utf-8")),
+    path=os.getenv("check_points_cache_path", ".cache/check_points.sqlite") or None,
+    max_items=int(os.getenv("check_points_cache_items", "1024")),
+    max_bytes=int(os.getenv("check_points_cache_mb", "64")) * 1024 * 1024,
+)
+check_points_negative_cache = LRUCache(max_items=1024)
+
+
+def check_points_cache_key(text, media_name=None):
+    """text 應為 date_noun_converter 處理後的文字，日期已展開成絕對日期"""
+    return make_key(normalize_text(text), media_name or "")
+
+
+def get_cached_check_points(key):
+    result = check_points_negative_cache.get(key)
+    if result is not None:
+        print(f"[Info] 查核點快取命中（空結果 / 失敗）")
+        return result
+    result = check_points_cache.get(key)
+    if result is not None:
+        print(f"[Info] 查核點快取命中")
+    return result
+
+
+def store_check_points(key, result):
+    if result["Result"] == "Y":
+        check_points_cache.set(key, result, CHECK_POINTS_CACHE_TTL)
+    else:
+        check_points_negative_cache.set(key, result, CHECK_POINTS_NEGATIVE_TTL)
+
+
+### 斷路器
+class CircuitBreaker:
+    """
+    連續失敗 failure_threshold 次後斷路 reset_timeout 秒；
+    冷卻結束後放行一次試探請求，成功則恢復，失敗則再斷路
+    allow() 放行試探請求時回傳 PROBE，呼叫端結束時（包含被取消）要呼叫 release_probe()
+    """
+    PROBE = "probe"
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._half_open = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._half_open:
+                return False
+            # 冷卻結束，只放行一個試探請求
+            self._half_open = True
+            return self.PROBE
+
+    def release_probe(self):
+        """試探請求沒有記錄成功或失敗就結束時（取消、逾時），讓下一個請求可以再試探"""
+        with self._lock:
+            self._half_open = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._half_open = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._half_open or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._half_open = False
+
+
+check_points_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("check_points_breaker_threshold", "5")),
+    reset_timeout=float(os.getenv("check_points_breaker_reset", "60")),
+)
+
+
+### 查核點api（非同步）
+@traced("check_points")
+async def get_check_points_async(text, media_name=None, url=None,
+                                 connect_timeout=None, read_timeout=None, max_attempts=None, use_cache=True, deadline=None):
+    """
+    :param deadline: deadline.Deadline，每次呼叫的 read timeout 不超過剩餘預算，預算不夠時不再重試
+    """
+    print(f"[Info] 查核點評估...")
+    key = check_points_cache_key(text, media_name)
+    if use_cache:
+        cached = get_cached_check_points(key)
+        set_attributes(cache_hit=cached is not None)
+        if cached is not None:
+            return cached
+
+    result = await _fetch_check_points_async(text, media_name, url, connect_timeout, read_timeout, max_attempts, deadline)
+    if use_cache and result["Message"] != DEADLINE_MESSAGE:
+        store_check_points(key, result)
+    set_attributes(result=result["Result"], message=result["Message"])
+    return result
+
+
+async def _fetch_check_points_async(text, media_name, url, connect_timeout, read_timeout, max_attempts, deadline=None):
+    """回傳查核點結果；因 deadline 放棄重試時 Message 為 DEADLINE_MESSAGE（不寫入快取）"""
+    url = url or CHECK_POINTS_URL
+    max_attempts = max_attempts or CHECK_POINTS_MAX_ATTEMPTS
+    read_timeout = read_timeout if read_timeout is not None else CHECK_POINTS_READ_TIMEOUT
+    connect_timeout = connect_timeout if connect_timeout is not None else CHECK_POINTS_CONNECT_TIMEOUT
+
+    permit = check_points_breaker.allow()
+    if not permit:
+        print(f"[Error] 查核點服務斷路中，暫停呼叫")
+        set_attributes(breaker_open=True)
+        return check_points_result(None, "查核點服務暫時無法使用")
+    try:
+        return await _request_check_points(text, media_name, url, connect_timeout, read_timeout, max_attempts, deadline)
+    finally:
+        if permit == CircuitBreaker.PROBE:
+            check_points_breaker.release_probe()
+
+
+async def _request_check_points(text, media_name, url, connect_timeout, read_timeout, max_attempts, deadline):
+    client = get_async_http_client()
+    start_time = time.time()
+    for attempt in range(1, max_attempts + 1):
+        timeout = httpx.Timeout(stage_timeout(deadline, "check_points", read_timeout, DEADLINE_MIN_STAGE), connect=connect_timeout)
+        set_attributes(attempts=attempt)
+        try:
+            with span("check_points.request", attempt=attempt, read_timeout=timeout.read) as s:
+                response = await client.post(url, json={"text": text, "media_name": media_name}, timeout=timeout)
+                s.set_attribute("status_code", response.status_code)
+            if response.status_code in RETRY_STATUS:
+                raise httpx.HTTPStatusError(f"status {response.status_code}", request=response.request, response=response)
+        except (httpx.TimeoutException, httpx.TransportError, httpx.HTTPStatusError) as e:
+            print(f"[Error] 查核點API第{attempt}次呼叫失敗：{e!r}")
+            if attempt == max_attempts:
+                check_points_breaker.record_failure()
+                print(f"[Info] 查核點API耗時: {time.time() - start_time:.2f} 秒")
+                return check_points_result(None, "API回傳None")
+            backoff = CHECK_POINTS_BACKOFF * 2 ** (attempt - 1) * (0.5 + random.random())
+            if deadline is not None and deadline.for_stage("check_points") < backoff + DEADLINE_MIN_STAGE:
+                print(f"[Info] 查核時間預算不足，不再重試查核點API（{deadline}）")
+                check_points_breaker.record_failure()
+                return check_points_result(None, DEADLINE_MESSAGE)
+            await asyncio.sleep(backoff)
+            continue
+
+        check_points_breaker.record_success()
+        print(f"[Info] 查核點API耗時: {time.time() - start_time:.2f} 秒")
+        if response.status_code != 200:
+            # 4xx 重試也沒用，直接回傳失敗
+            print(f"[Error] 取得查核點時發生錯誤：{response.status_code}")
+            return check_points_result(None, "API回傳None")
+        try:
+            result = parse_check_points_response(response.json())
+        except ValueError:
+            print(f"[Error] 查核點API回傳格式錯誤")
+            return check_points_result(None, "API回傳None")
+        if result["Result"] == "Y":
+            print(f"[Info] 成功取得查核點")
+            print(f">>>{result['ResultData']['check_points']}")
+        else:
+            print(f"[Info] 查核點為空")
+        return result
+
+
+### 查核點api（同步）
+def get_check_points(text, media_name=None, use_cache=True, deadline=None):
+    """
+    同步版本，重試、斷路器與快取都與 get_check_points_async 共用；不可在執行中的事件循環內呼叫
+    """
+    async def run():
+        try:
+            return await get_check_points_async(text, media_name, use_cache=use_cache, deadline=deadline)
+        finally:
+            # httpx client 綁定在這個暫時的事件循環上，結束前關閉
+            await close_async_clients()
+
+    return asyncio.run(run())
+
+
+### 本機 stub server
+class _StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    fail_rate = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+        text = payload.get("text") or ""
+        body = json.dumps({
+            "Result": "Y",
+            "ResultData": {"check_points": [f"1. 查證內容是否屬實：{text[:30]}", "2. 查證消息來源與發布單位"]},
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(host="127.0.0.1", port=0, delay=0.0, fail_rate=0.0):
+    """
+    在背景執行緒啟動查核點 stub server，回傳 (server, url)
+    :param delay: 每個 request 的延遲秒數，模擬冷啟動
+    :param fail_rate: 回傳 503 的機率，用來測試重試與斷路
+    """
+    handler = type("StubHandler", (_StubHandler,), {"delay": delay, "fail_rate": fail_rate})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查核點 API client / stub server")
+    parser.add_argument("--stub", action="store_true", help="啟動本機 stub server")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.stub:
+        server, url = start_stub_server(port=args.port, delay=args.delay, fail_rate=args.fail_rate)
+        print(f"[Info] 查核點 stub server 啟動：{url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        text = "勞動部勞工保險局今天宣布，從明天開始陸續發放國民年金生育保險給付，女性皆可領取3萬9522元。"
+        print(get_check_points(text, media_name="Chiming"))
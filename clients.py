@@ -0,0 +1,142 @@
+"""
+共用的 OpenAI / HTTP client
+
+所有模組都從這裡取得 client，重複使用 keep-alive 連線，
+避免每次呼叫都重新建立 TLS 連線。
+連線池大小與 timeout 可由環境變數設定，或在第一次使用前呼叫 configure_clients()。
+"""
+import os
+import asyncio
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from openai import OpenAI, AsyncOpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CLIENT_CONFIG = {
+    # OpenAI（httpx）只連同一個 host，所以總連線數即為 per-host 上限
+    "openai_max_connections": int(os.getenv("openai_max_connections", "50")),
+    "openai_max_keepalive": int(os.getenv("openai_max_keepalive", "20")),
+    "openai_keepalive_expiry": float(os.getenv("openai_keepalive_expiry", "60")),
+    "openai_connect_timeout": float(os.getenv("openai_connect_timeout", "10")),
+    "openai_read_timeout": float(os.getenv("openai_read_timeout", "120")),
+    "openai_max_retries": int(os.getenv("openai_max_retries", "2")),
+    # requests Session：pool_connections 為 host 數，pool_maxsize 為每個 host 的連線數
+    "http_pool_connections": int(os.getenv("http_pool_connections", "10")),
+    "http_pool_maxsize": int(os.getenv("http_pool_maxsize", "20")),
+    "http_connect_timeout": float(os.getenv("http_connect_timeout", "5")),
+    "http_read_timeout": float(os.getenv("http_read_timeout", "120")),
+}
+
+_lock = threading.Lock()
+_openai_client = None
+_http_session = None
+# AsyncClient 的連線綁定在建立它的事件循環上，app.py 會在不同執行緒開新的 loop，所以每個 loop 各自一份
+_async_openai_clients = weakref.WeakKeyDictionary()
+_async_http_clients = weakref.WeakKeyDictionary()
+
+
+def configure_clients(**overrides):
+    """更新設定並丟棄已建立的同步 client，下次取用時以新設定重建"""
+    global _openai_client, _http_session
+    unknown = set(overrides) - set(CLIENT_CONFIG)
+    if unknown:
+        raise ValueError(f"未知的 client 設定: {sorted(unknown)}")
+    with _lock:
+        CLIENT_CONFIG.update(overrides)
+        _openai_client = None
+        _http_session = None
+
+
+def _httpx_limits():
+    return httpx.Limits(
+        max_connections=CLIENT_CONFIG["openai_max_connections"],
+        max_keepalive_connections=CLIENT_CONFIG["openai_max_keepalive"],
+        keepalive_expiry=CLIENT_CONFIG["openai_keepalive_expiry"],
+    )
+
+
+def _httpx_timeout(connect=None, read=None):
+    read = read if read is not None else CLIENT_CONFIG["openai_read_timeout"]
+    connect = connect if connect is not None else CLIENT_CONFIG["openai_connect_timeout"]
+    return httpx.Timeout(read, connect=connect)
+
+
+### OpenAI
+def get_openai_client() -> OpenAI:
+    global _openai_client
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                _openai_client = OpenAI(
+                    http_client=httpx.Client(limits=_httpx_limits(), timeout=_httpx_timeout()),
+                    max_retries=CLIENT_CONFIG["openai_max_retries"],
+                )
+    return _openai_client
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """取得目前事件循環專用的 AsyncOpenAI，必須在協程內呼叫"""
+    loop = asyncio.get_running_loop()
+    client = _async_openai_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            http_client=httpx.AsyncClient(limits=_httpx_limits(), timeout=_httpx_timeout()),
+            max_retries=CLIENT_CONFIG["openai_max_retries"],
+        )
+        _async_openai_clients[loop] = client
+    return client
+
+
+### 一般 HTTP（查核點 API 等）
+def get_http_session() -> requests.Session:
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=CLIENT_CONFIG["http_pool_connections"],
+                    pool_maxsize=CLIENT_CONFIG["http_pool_maxsize"],
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """取得目前事件循環專用的 httpx.AsyncClient，必須在協程內呼叫"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=CLIENT_CONFIG["http_pool_connections"] * CLIENT_CONFIG["http_pool_maxsize"],
+                max_keepalive_connections=CLIENT_CONFIG["http_pool_maxsize"],
+            ),
+            timeout=httpx.Timeout(CLIENT_CONFIG["http_read_timeout"], connect=CLIENT_CONFIG["http_connect_timeout"]),
+        )
+        _async_http_clients[loop] = client
+    return client
+
+
+async def close_async_clients():
+    """關閉目前事件循環的 AsyncOpenAI 與 httpx.AsyncClient；臨時建立的事件循環結束前呼叫，之後再取用會重新建立"""
+    loop = asyncio.get_running_loop()
+    openai_client = _async_openai_clients.pop(loop, None)
+    http_client = _async_http_clients.pop(loop, None)
+    if openai_client is not None:
+        await openai_client.close()
+    if http_client is not None:
+        await http_client.aclose()
+
+
+def http_timeout():
+    """requests 用的 (connect, read) timeout"""
+    return (CLIENT_CONFIG["http_connect_timeout"], CLIENT_CONFIG["http_read_timeout"])
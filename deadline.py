@@ -0,0 +1,98 @@
+"""
+單次查核的時間預算
+
+每個查核請求在進入點（StreamlitFactCheckBot.start_fact_check、functions / agentic 的 __main__）建立一個 Deadline，
+往下傳給查核點、ES 搜尋、相關性判斷與 agent。每個階段的 timeout 是「剩餘時間 - 後面階段需要預留的時間」，
+時間不夠時降級（少判斷幾筆參考資料、跳過 AI 評估），而不是整個查核超過延遲目標。
+
+    deadline = Deadline()                                    # 預算默認為環境變數 fact_check_budget 秒
+    timeout = deadline.for_stage("check_points", cap=90)     # 預留給搜尋與生成的時間之外，最多 90 秒
+    result = await deadline.run(coroutine, "review")         # 超過時拋出 DeadlineExceeded
+"""
+import os
+import time
+import asyncio
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FACT_CHECK_BUDGET = float(os.getenv("fact_check_budget", "60"))
+# 必要的網路呼叫（查核點、ES 搜尋）即使預算用完也至少給這麼多秒
+DEADLINE_MIN_STAGE = float(os.getenv("deadline_min_stage", "2"))
+# 生成查核解釋是唯一不能省略的 LLM 呼叫，至少給這麼多秒
+DEADLINE_MIN_GENERATION = float(os.getenv("deadline_min_generation", "15"))
+# AI 評估的剩餘時間低於此值時直接跳過
+DEADLINE_MIN_REVIEW = float(os.getenv("deadline_min_review", "5"))
+
+# 各階段要預留給後面階段的秒數
+STAGE_RESERVES = {
+    "check_points": float(os.getenv("deadline_reserve_check_points", "35")),  # 搜尋、相關性判斷、生成、評估
+    "search": float(os.getenv("deadline_reserve_search", "30")),              # 相關性判斷、生成、評估
+    "relation": float(os.getenv("deadline_reserve_relation", "20")),          # 生成、評估
+    "explanation": float(os.getenv("deadline_reserve_explanation", "5")),     # 評估
+    "review": 0.0,
+    "final_report": 0.0,
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, stage, deadline=None):
+        self.stage = stage
+        super().__init__(f"{stage} 超過查核時間預算" + (f"（{deadline}）" if deadline else ""))
+
+
+class Deadline:
+    """
+    :param budget: 整個查核的秒數預算
+    """
+
+    def __init__(self, budget=FACT_CHECK_BUDGET):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def for_stage(self, stage, cap=None, floor=0.0):
+        """
+        階段可用的秒數：剩餘時間扣掉 STAGE_RESERVES[stage]
+        :param cap: 上限（例如該服務原本的 timeout）
+        :param floor: 下限；必要的階段即使預算用完也給這麼多秒
+        """
+        budget = self.remaining() - STAGE_RESERVES.get(stage, 0.0)
+        if cap is not None:
+            budget = min(budget, cap)
+        return max(budget, floor)
+
+    def check(self, stage):
+        if self.expired():
+            raise DeadlineExceeded(stage, self)
+
+    async def run(self, coroutine, stage, cap=None, floor=0.0):
+        """以階段可用的秒數執行 coroutine，逾時拋出 DeadlineExceeded"""
+        timeout = self.for_stage(stage, cap, floor)
+        if timeout <= 0:
+            coroutine.close()
+            raise DeadlineExceeded(stage, self)
+        try:
+            return await asyncio.wait_for(coroutine, timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(stage, self) from None
+
+    def __repr__(self):
+        return f"Deadline(已用 {self.elapsed():.1f} 秒 / 預算 {self.budget:g} 秒)"
+
+
+def stage_timeout(deadline, stage, cap=None, floor=0.0):
+    """deadline 為 None 時回傳 cap（沿用各服務原本的 timeout）"""
+    if deadline is None:
+        return cap
+    return deadline.for_stage(stage, cap, floor)
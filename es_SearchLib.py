@@ -1,37 +1,141 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, BadRequestError, NotFoundError
 import json
+import time
+import hashlib
 from typing import List, Dict, Any, Optional, Union
 import os
 from dotenv import load_dotenv
+from quantization import encode_for_layout
+from cache import LRUCache, CacheStats, make_key, pack_floats
+from tracing import span, traced, set_attributes
 
 load_dotenv()
 
 ### Elasticsearch
 es = Elasticsearch(os.getenv("es_host"), basic_auth=(os.getenv("es_username"), os.getenv("es_password")), request_timeout=3600)
 
+def es_with_timeout(es, timeout=None):
+    """
+    回傳單次請求帶 timeout（秒）的 client，同步與 AsyncElasticsearch 皆可用；None 時沿用 client 原本的設定
+    查核流程以 deadline.Deadline 算出剩餘時間後傳入，避免一次搜尋就等到 request_timeout
+    """
+    if timeout is None:
+        return es
+    return es.options(request_timeout=max(timeout, 0.1))
+
+##### _source 欄位篩選
+### 預設排除向量欄位（3072 維 float 每筆就有數十 KB），只有明確要求時才回傳
+VECTOR_FIELDS = ["embeddings", "embedding_*"]
+
+def _source_filter(includes=None, excludes=None, embedding_column_name=None):
+    """
+    :param includes: 要回傳的欄位，None 代表全部
+    :param excludes: 要排除的欄位，None 代表排除向量欄位；傳 [] 可取回完整 _source
+    """
+    if excludes is None:
+        excludes = VECTOR_FIELDS + ([embedding_column_name] if embedding_column_name else [])
+    source = {}
+    if includes:
+        source["includes"] = includes
+    if excludes:
+        source["excludes"] = excludes
+    return source or True
+
+
+##### 向量欄位 layout（維度 / element_type）
+### 查詢向量一律是 3072 維 float；查 migrate_index.py 建出的降維或量化索引時，依 mapping 截斷並量化
+### 第一次查某個 (index, 向量欄位) 時讀一次 mapping，之後沿用
+_vector_layouts = {}  # (index, 向量欄位) -> {"dims", "element_type"}；None 代表不是 dense_vector 或讀不到
+
+
+def register_vector_layout(index, embedding_column_name, dims=None, element_type="float"):
+    """手動指定向量欄位的 layout，不必再讀 mapping"""
+    _vector_layouts[(index, embedding_column_name)] = {"dims": dims, "element_type": element_type}
+
+
+def get_vector_layout(es, index, embedding_column_name):
+    key = (index, embedding_column_name)
+    if key in _vector_layouts:
+        return _vector_layouts[key]
+    try:
+        response = es.indices.get_field_mapping(index=index, fields=embedding_column_name)
+    except Exception as e:
+        # 連線問題時不記錄，下次再讀
+        print(f"[Error] 讀取 {index}.{embedding_column_name} mapping 失敗: {e}")
+        return None
+    _vector_layouts[key] = _parse_vector_layout(response, embedding_column_name)
+    return _vector_layouts[key]
+
+
+def _parse_vector_layout(response, embedding_column_name):
+    for item in response.values():
+        mapping = item.get("mappings", {}).get(embedding_column_name, {}).get("mapping", {})
+        field = next(iter(mapping.values()), {})
+        if field.get("type") == "dense_vector":
+            return {"dims": field.get("dims"), "element_type": field.get("element_type", "float")}
+    return None
+
+
+def fit_query_vector(es, index, embedding_column_name, input_embedding):
+    """依索引的 layout 截斷、正規化、量化查詢向量；維度相同的 float 索引原樣回傳"""
+    return _fit_to_layout(get_vector_layout(es, index, embedding_column_name), input_embedding)
+
+
+def _fit_to_layout(layout, input_embedding):
+    if not layout:
+        return input_embedding
+    dims, element_type = layout["dims"], layout["element_type"]
+    if element_type == "float" and (not dims or dims >= len(input_embedding)):
+        return input_embedding
+    return encode_for_layout(input_embedding, dims, element_type)
+
+
+def _prepare_vector_search(es, index, embedding_column_name, input_embedding):
+    """組 query 前確認 stored scripts 狀態，並依索引 layout 轉換查詢向量"""
+    _scripts_ready(es)
+    return fit_query_vector(es, index, embedding_column_name, input_embedding)
+
+
+def _fit_search(es, search):
+    return {**search, "input_embedding": _prepare_vector_search(es, search["index"], search["embedding_column_name"], search["input_embedding"])}
+
+
 ##### 原生 query 搜尋，可自定義 query
 ### query 搜尋 (自定義 query)
-def es_search_queryJSON(es, index, query):
-    response = es.search(index=index, body=query)
+def es_search_queryJSON(es, index, query, includes=None, excludes=None):
+    return _search(es, index, _queryJSON_body(query, includes, excludes))
+
+
+def _queryJSON_body(query, includes=None, excludes=None):
+    # query 已自帶 _source 時以 query 為準
+    if "_source" not in query:
+        query = {**query, "_source": _source_filter(includes, excludes)}
+    return query
+
+
+def _search(es, index, body):
+    response = es.search(index=index, body=body)
     #print(f"Found {response['hits']['total']['value']} documents")
     return response['hits']['hits']
 
 
 ##### 欄位字串搜尋
 ### 使用 match 單一搜尋
-def es_search_string_match(es, index, field_name, search_string, recall_size=10):
-    query = { "size": recall_size, "query": { "match": { field_name: search_string } } }
-    response = es.search(index=index, body=query)
-    #print(f"Found {response['hits']['total']['value']} documents")
-    return response['hits']['hits']
+def es_search_string_match(es, index, field_name, search_string, recall_size=10, includes=None, excludes=None):
+    return _search(es, index, _string_match_body(field_name, search_string, recall_size, includes, excludes))
+
+
+def _string_match_body(field_name, search_string, recall_size=10, includes=None, excludes=None):
+    return { "size": recall_size, "query": { "match": { field_name: search_string } }, "_source": _source_filter(includes, excludes) }
 
 
 ### 使用 term 單一搜尋
-def es_search_string_term(es, index, field_name, search_string, recall_size=10):
-    query = { "size": recall_size, "query": { "term": { field_name: search_string } } }
-    response = es.search(index=index, body=query)
-    #print(f"Found {response['hits']['total']['value']} documents")
-    return response['hits']['hits']
+def es_search_string_term(es, index, field_name, search_string, recall_size=10, includes=None, excludes=None):
+    return _search(es, index, _string_term_body(field_name, search_string, recall_size, includes, excludes))
+
+
+def _string_term_body(field_name, search_string, recall_size=10, includes=None, excludes=None):
+    return { "size": recall_size, "query": { "term": { field_name: search_string } }, "_source": _source_filter(includes, excludes) }
 
 
 
@@ -39,55 +143,825 @@ def es_search_string_term(es, index, field_name, search_string, recall_size=10):
 
 ##### 顯示日期
 ### 使用特定日期搜尋
-def es_search_certain_date(es, index, date_column_name, date, size=1000):
-    query = {"query":{"bool":{"must":[{"range":{date_column_name:{"gte":date,"lte":date}}}],"must_not":[],"should":[]}},"from":0,"size":size,"sort":[],"aggs":{}}
-    response = es.search(index=index, body=query)
-    #print(f"Found {response['hits']['total']['value']} documents")
-    return response['hits']['hits']
+def es_search_certain_date(es, index, date_column_name, date, size=1000, includes=None, excludes=None):
+    return _search(es, index, _certain_date_body(date_column_name, date, size, includes, excludes))
+
+
+def _certain_date_body(date_column_name, date, size=1000, includes=None, excludes=None):
+    return {"query":{"bool":{"must":[{"range":{date_column_name:{"gte":date,"lte":date}}}],"must_not":[],"should":[]}},"from":0,"size":size,"sort":[],"aggs":{},"_source":_source_filter(includes, excludes)}
 
 
 ### 使用日期範圍搜尋
-def es_search_date_range(es, index, date_column_name, start_date, end_date): # 前後皆含
-    query = {"query":{"bool":{"must":[{"range":{date_column_name:{"gte":start_date,"lte":end_date}}}],"must_not":[],"should":[]}},"from":0,"size":1000,"sort":[],"aggs":{}}
-    response = es.search(index=index, body=query)
-    #print(f"Found {response['hits']['total']['value']} documents")
+def es_search_date_range(es, index, date_column_name, start_date, end_date, includes=None, excludes=None): # 前後皆含
+    return _search(es, index, _date_range_body(date_column_name, start_date, end_date, includes, excludes))
+
+
+def _date_range_body(date_column_name, start_date, end_date, includes=None, excludes=None):
+    return {"query":{"bool":{"must":[{"range":{date_column_name:{"gte":start_date,"lte":end_date}}}],"must_not":[],"should":[]}},"from":0,"size":1000,"sort":[],"aggs":{},"_source":_source_filter(includes, excludes)}
+
+
+### 完整讀取日期搜尋結果（point-in-time + search_after）
+### es_search_certain_date / es_search_date_range 最多只回傳 1000 筆，
+### 以下 generator 逐頁讀取全部結果，記憶體中同時只有一頁
+DATE_SCAN_PAGE_SIZE = 500
+PIT_KEEP_ALIVE = "2m"
+
+
+def es_scan_certain_date(es, index, date_column_name, date, page_size=DATE_SCAN_PAGE_SIZE, includes=None, excludes=None,
+                         sort=None, batches=False):
+    """es_search_certain_date 的完整版本，參數說明同 es_scan_date_range"""
+    yield from es_scan_date_range(es, index, date_column_name, date, date, page_size, includes, excludes, sort, batches)
+
+
+def es_scan_date_range(es, index, date_column_name, start_date, end_date, page_size=DATE_SCAN_PAGE_SIZE, includes=None, excludes=None,
+                       sort=None, batches=False): # 前後皆含
+    """
+    :param page_size: 每頁筆數
+    :param sort: 排序，默認為 _shard_doc（最快，但不依日期排序）；要依日期排序可傳 [{date_column_name: "asc"}]
+    :param batches: True 時每次 yield 一頁的 hits 列表，False 時逐筆 yield hit
+    """
+    query = _date_range_body(date_column_name, start_date, end_date)["query"]
+    for page in _scan_pit(es, index, query, page_size, sort, _source_filter(includes, excludes)):
+        if batches:
+            yield page
+        else:
+            yield from page
+
+
+def _pit_page_body(pit_id, query, page_size, sort, source, search_after=None):
+    # _shard_doc 當最後一個排序欄位，確保 search_after 不會漏掉或重複同分的文件
+    body = {
+        "pit": {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE},
+        "query": query,
+        "size": page_size,
+        "sort": list(sort or []) + [{"_shard_doc": "asc"}],
+        "_source": source,
+        "track_total_hits": False,
+    }
+    if search_after is not None:
+        body["search_after"] = search_after
+    return body
+
+
+def _scan_pit(es, index, query, page_size, sort, source):
+    pit_id = es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)["id"]
+    try:
+        search_after = None
+        while True:
+            response = es.search(body=_pit_page_body(pit_id, query, page_size, sort, source, search_after))
+            pit_id = response.get("pit_id", pit_id)
+            hits = response['hits']['hits']
+            if not hits:
+                return
+            yield hits
+            if len(hits) < page_size:
+                return
+            search_after = hits[-1]["sort"]
+    finally:
+        # PIT 過期後也會自動釋放，關閉失敗時不蓋掉原本的例外
+        try:
+            es.close_point_in_time(id=pit_id)
+        except Exception as e:
+            print(f"[Error] 關閉 point in time 失敗: {e}")
+
+
+
+
+
+##### Stored scripts（cosine 分數）
+### 欄位名稱以參數傳入，所有向量欄位共用同一份預先編譯的 script，
+### 不會因為欄位不同而各自編譯，也不佔 script 編譯頻率上限；啟動時註冊一次（register_stored_scripts）
+### 設定環境變數 es_stored_scripts=false 或註冊失敗時，改用 inline script
+STORED_SCRIPTS_ENABLED = os.getenv("es_stored_scripts", "true").lower() == "true"
+COSINE_SCRIPT_ID = "askcna-cosine-v1"
+COSINE_EXISTS_SCRIPT_ID = "askcna-cosine-exists-v1"
+STORED_SCRIPTS = {
+    COSINE_SCRIPT_ID: "cosineSimilarity(params.query_vector, params.field) + 1.0",
+    COSINE_EXISTS_SCRIPT_ID: "if (doc[params.field].size() > 0) { return cosineSimilarity(params.query_vector, params.field) + 1.0; } else { return 0.0; }",
+}
+_scripts_state = {"ready": None, "baseline": None}  # ready 為 None 代表尚未檢查
+
+
+def _stored_script_outdated(existing, source):
+    return existing is None or existing.get("script", {}).get("source") != source
+
+
+def _register_stored(es, scripts, lang, force=False):
+    """確認 stored script / template 存在，不存在或內容不同時重新註冊"""
+    for script_id, source in scripts.items():
+        existing = None
+        if not force:
+            try:
+                existing = es.get_script(id=script_id)
+            except NotFoundError:
+                pass
+        if force or _stored_script_outdated(existing, source):
+            es.put_script(id=script_id, script={"lang": lang, "source": source})
+            print(f"[Info] 註冊 stored script {script_id}")
+
+
+def register_stored_scripts(es, force=False):
+    """
+    註冊 cosine stored scripts，並記下目前的 script 編譯次數作為 script_cache_stats 的基準
+    :return: 是否可以使用 stored scripts
+    """
+    try:
+        _register_stored(es, STORED_SCRIPTS, "painless", force)
+        _scripts_state["ready"] = True
+    except Exception as e:
+        print(f"[Error] 註冊 stored script 失敗，改用 inline script: {e}")
+        _scripts_state["ready"] = False
+    # 讀取 nodes stats 需要 monitor 權限，沒有權限時只是少了統計基準，stored script 照常使用
+    try:
+        _scripts_state["baseline"] = _sum_script_stats(es.nodes.stats(metric="script"))
+    except Exception as e:
+        print(f"[Error] 讀取 script 統計失敗，script_cache_stats 不提供 *_since_start: {e}")
+    return _scripts_state["ready"]
+
+
+def _scripts_ready(es):
+    if not STORED_SCRIPTS_ENABLED:
+        return False
+    if _scripts_state["ready"] is None:
+        register_stored_scripts(es)
+    return _scripts_state["ready"]
+
+
+def _stored_scripts_usable():
+    # 尚未檢查時也先用 stored script：各 helper 組 query 前都會先經過 _scripts_ready
+    return STORED_SCRIPTS_ENABLED and _scripts_state["ready"] is not False
+
+
+def _sum_script_stats(response):
+    totals = {"compilations": 0, "cache_evictions": 0, "compilation_limit_triggered": 0}
+    for node in response.get("nodes", {}).values():
+        for key in totals:
+            totals[key] += node.get("script", {}).get(key, 0)
+    return totals
+
+
+def script_cache_stats(es):
+    """
+    各節點 script 編譯次數（即 script cache miss）、快取淘汰、編譯頻率限制觸發次數的加總，
+    以及從 register_stored_scripts 之後增加的次數（*_since_start）
+    """
+    totals = _sum_script_stats(es.nodes.stats(metric="script"))
+    return _with_baseline(totals)
+
+
+def _with_baseline(totals):
+    baseline = _scripts_state["baseline"]
+    if baseline:
+        totals.update({f"{key}_since_start": totals[key] - baseline[key] for key in baseline})
+    return totals
+
+
+##### Query builder
+### 向量、過濾、關鍵字加權、PID 日期範圍等子句集中在這裡組裝，各 helper 與 search template 共用
+def cosine_script(embedding_column_name, input_embedding, check_exists=False):
+    """cosine + 1.0 的 script；check_exists=True 時沒有向量的文件給 0 分"""
+    if _stored_scripts_usable():
+        return {
+            "id": COSINE_EXISTS_SCRIPT_ID if check_exists else COSINE_SCRIPT_ID,
+            "params": {"query_vector": input_embedding, "field": embedding_column_name}
+        }
+    source = f"cosineSimilarity(params.query_vector, '{embedding_column_name}') + 1.0"
+    if check_exists:
+        source = f"if (doc['{embedding_column_name}'].size() > 0) {{ return {source}; }} else {{ return 0.0; }}"
+    return {"source": source, "params": {"query_vector": input_embedding}}
+
+
+def script_score_clause(embedding_column_name, input_embedding, query=None, check_exists=False):
+    """以 cosine 分數取代 query（默認為 match_all）的分數"""
+    return {
+        "script_score": {
+            "query": query or {"match_all": {}},
+            "script": cosine_script(embedding_column_name, input_embedding, check_exists)
+        }
+    }
+
+
+def exists_clause(field):
+    return {"exists": {"field": field}}
+
+
+def pid_range_clause(pid_column_name, start_date, end_date):
+    """PID格式：YYYYMMDDNNNN（前8位是日期，後4位是編號），日期 YYYYMMDD 轉成 PID 範圍"""
+    return {"range": {pid_column_name: {"gte": f"{start_date}0002", "lte": f"{end_date}9999"}}}
+
+
+def filter_clauses(filters, strict=False):
+    """
+    把過濾條件列表 [{"type", "field", "value"}, ...] 轉成 (must, should)
+    :param strict: False 時 term 多值轉成 terms、match / match_phrase 放進 should 作為 OR 條件、其他類型原樣放進 must；
+                   True 時只接受 term / match / range，全部放進 must
+    """
+    must_conditions = []
+    should_conditions = []
+    for filter_condition in filters or []:
+        filter_type = filter_condition["type"]
+        field = filter_condition["field"]
+        value = filter_condition["value"]
+
+        if strict:
+            if filter_type not in ("term", "match", "range"):
+                raise ValueError(f"不支持的過濾類型: {filter_type}")
+            must_conditions.append({filter_type: {field: value}})
+        elif filter_type == "term":
+            must_conditions.append({"terms" if isinstance(value, list) else "term": {field: value}})
+        elif filter_type in ("match", "match_phrase"):
+            # 如果是多個值，則應將它們加到 should_conditions 中，作為 OR 條件
+            for v in value if isinstance(value, list) else [value]:
+                should_conditions.append({filter_type: {field: v}})
+        else:
+            must_conditions.append({filter_type: {field: value}})
+    return must_conditions, should_conditions
+
+
+def keyword_boost_clauses(keyword_fields):
+    """
+    :param keyword_fields: [{"field": "欄位名稱", "keywords": [...], "weight": 加權值 (可選，默認為1.0)}, ...]
+    """
+    return [
+        {"match": {field_info["field"]: {"query": keyword, "boost": field_info.get("weight", 1.0)}}}
+        for field_info in keyword_fields or []
+        for keyword in field_info["keywords"]
+    ]
+
+
+def search_body(size, source, query=None, knn=None):
+    body = {"size": size}
+    if query is not None:
+        body["query"] = query
+    if knn is not None:
+        body["knn"] = knn
+    body["_source"] = source
+    return body
+
+
+
+
+
+##### kNN (HNSW) 搜尋
+### method="knn" 使用近似 kNN，method="script_score" 使用逐筆計算 cosine 的精確搜尋
+### 索引沒有 HNSW mapping（dense_vector 未設 index: true）時，kNN 會失敗並自動改用 script_score
+KNN_NUM_CANDIDATES_FACTOR = 10
+_knn_unsupported = set()  # 已知不支援 kNN 的 (index, 向量欄位)，之後直接走 script_score
+
+
+def _knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates=None, filters=None):
+    """
+    :param num_candidates: 每個 shard 的候選數，越大 recall 越高但越慢，默認為 recall_size 的 10 倍（至少 100）
+    :param filters: 套用在 kNN 的過濾條件（query 列表），在 HNSW 搜尋時一併過濾
+    """
+    knn = {
+        "field": embedding_column_name,
+        "query_vector": input_embedding,
+        "k": recall_size,
+        "num_candidates": num_candidates or max(100, recall_size * KNN_NUM_CANDIDATES_FACTOR),
+    }
+    if filters:
+        knn["filter"] = filters
+    return knn
+
+
+def _use_knn(method, index, embedding_column_name):
+    if method not in ("knn", "script_score"):
+        raise ValueError(f"不支持的向量搜尋方式: {method}")
+    return method == "knn" and (index, embedding_column_name) not in _knn_unsupported
+
+
+def _require_script_score_layout(index, embedding_column_name):
+    """cosineSimilarity 的 script / template 不適用 bit 向量；bit 索引只能走 kNN（以 hamming 距離比較）"""
+    layout = _vector_layouts.get((index, embedding_column_name))
+    if layout and layout["element_type"] == "bit":
+        raise ValueError(f"{index}.{embedding_column_name} 是 bit 向量，不支援 script_score（cosine），請改用 method=\"knn\"")
+
+
+# 代表查詢語法不被索引 / 叢集支援的錯誤類型；逾時、429、shard 失敗等暫時性錯誤不在此列
+UNSUPPORTED_ERROR_TYPES = {"illegal_argument_exception", "parsing_exception", "x_content_parse_exception",
+                           "named_object_not_found_exception"}
+
+
+def _is_unsupported_error(error, license_errors=False):
+    """
+    _msearch 單筆錯誤是否代表「不支援」：400 且錯誤類型（含 root_cause）在 UNSUPPORTED_ERROR_TYPES
+    :param license_errors: 403 且原因提到 license 時也算（rrf retriever 需要授權）
+    """
+    if not isinstance(error, dict):
+        return False
+    status = error.get("status")
+    if license_errors and status == 403 and "license" in json.dumps(error).lower():
+        return True
+    # 查詢向量維度與索引不符也是 illegal_argument，但改用 script_score 一樣會失敗，不算不支援
+    if "dimension" in json.dumps(error).lower():
+        return False
+    types = {error.get("type")} | {cause.get("type") for cause in error.get("root_cause", [])}
+    return status == 400 and bool(types & UNSUPPORTED_ERROR_TYPES)
+
+
+def _api_error(e):
+    """把單次搜尋的 ApiError 轉成與 _msearch 單筆錯誤相同的格式（error 內容加上 status）"""
+    body = getattr(e, "body", None)
+    error = body.get("error") if isinstance(body, dict) else None
+    if not isinstance(error, dict):
+        error = {"reason": str(e)}
+    return {**error, "status": getattr(e, "status_code", None)}
+
+
+def _is_knn_unsupported_error(error):
+    """「不支援」的錯誤且原因指向 kNN / dense_vector（例如向量欄位沒有 HNSW index），而不是 rrf retriever 本身"""
+    if not _is_unsupported_error(error):
+        return False
+    reason = json.dumps(error).lower()
+    return "knn" in reason or "dense_vector" in reason
+
+
+def _mark_knn_unsupported(index, embedding_column_name, error):
+    print(f"[Info] {index}.{embedding_column_name} 無法使用 kNN，改用 script_score：{error}")
+    _knn_unsupported.add((index, embedding_column_name))
+
+
+def _search_vector(es, index, embedding_column_name, method, exact_query, knn_query, templates=None):
+    """
+    method="knn" 時先用 kNN，失敗時改用 script_score 精確搜尋；結果依查詢條件與查詢向量快取
+    :param templates: (精確搜尋 template, kNN template)，template 已註冊時只送 template id 與參數
+    """
+    with span("es.search", index=index, method=method) as s:
+        key = _result_cache_key(es, index, (method, exact_query, knn_query), knn_query["knn"]["query_vector"])
+        hits = _cached_result(key)
+        s.set_attribute("cache_hit", hits is not None)
+        if hits is None:
+            hits = _run_vector_search(es, index, embedding_column_name, method, exact_query, knn_query, templates)
+            _store_result(key, hits)
+        s.set_attribute("hits", len(hits))
+        return hits
+
+
+def _run_vector_search(es, index, embedding_column_name, method, exact_query, knn_query, templates=None):
+    use_templates = templates is not None and _templates_ready(es)
+    if _use_knn(method, index, embedding_column_name):
+        try:
+            return _search_template(es, index, templates[1]) if use_templates else _search(es, index, knn_query)
+        except BadRequestError as e:
+            # 只有「不支援」才改用 script_score；query 寫錯、維度不符等其他 400 原樣拋出，不影響之後的 kNN 查詢
+            error = _api_error(e)
+            if not _is_unsupported_error(error):
+                raise
+            _mark_knn_unsupported(index, embedding_column_name, error)
+    _require_script_score_layout(index, embedding_column_name)
+    return _search_template(es, index, templates[0]) if use_templates else _search(es, index, exact_query)
+
+
+##### Stored search templates
+### 向量搜尋註冊成叢集上的 mustache search template，request 只送 template id 與參數，
+### 叢集端快取解析過的 template；template 內容由上面的 query builder 產生，與一般 query 相同
+### 設定環境變數 es_search_templates=false 或註冊失敗時，改送完整 query
+SEARCH_TEMPLATES_ENABLED = os.getenv("es_search_templates", "true").lower() == "true"
+VECTOR_EXACT_TEMPLATE_ID = "askcna-vector-exact-v1"
+VECTOR_KNN_TEMPLATE_ID = "askcna-vector-knn-v1"
+_templates_state = {"ready": None}  # None 代表尚未檢查
+
+
+def _template_source(body, json_params, string_params=()):
+    """
+    把 builder 產生的 body 轉成 mustache 字串
+    :param json_params: 以 "@@名稱@@" 佔位、要用 toJson 代入的參數（向量、列表、數字）
+    :param string_params: 出現在字串中的佔位參數（欄位名稱）
+    """
+    source = json.dumps(body, ensure_ascii=False)
+    for name in json_params:
+        source = source.replace(json.dumps(f"@@{name}@@"), "{{#toJson}}%s{{/toJson}}" % name)
+    for name in string_params:
+        source = source.replace(f"@@{name}@@", "{{%s}}" % name)
+    return source
+
+
+SEARCH_TEMPLATES = {
+    VECTOR_EXACT_TEMPLATE_ID: _template_source(
+        search_body("@@size@@", "@@source@@", query=script_score_clause(
+            "@@field@@", "@@query_vector@@",
+            {"bool": {"must": [exists_clause("@@field@@")], "filter": "@@filters@@"}}, check_exists=True)),
+        ["size", "source", "query_vector", "filters"], ["field"]),
+    VECTOR_KNN_TEMPLATE_ID: _template_source(
+        search_body("@@size@@", "@@source@@", knn={
+            "field": "@@field@@", "query_vector": "@@query_vector@@", "k": "@@k@@",
+            "num_candidates": "@@num_candidates@@", "filter": "@@filters@@"}),
+        ["size", "source", "query_vector", "k", "num_candidates", "filters"], ["field"]),
+}
+
+
+def _vector_templates(embedding_column_name, input_embedding, recall_size=10, includes=None, excludes=None,
+                      num_candidates=None, filters=None):
+    """回傳 (精確搜尋 template, kNN template)，格式為 {"id", "params"}"""
+    knn = _knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates)
+    params = {
+        "size": recall_size,
+        "source": _source_filter(includes, excludes, embedding_column_name),
+        "field": embedding_column_name,
+        "query_vector": input_embedding,
+        "k": knn["k"],
+        "num_candidates": knn["num_candidates"],
+        "filters": filters or [],
+    }
+    return {"id": VECTOR_EXACT_TEMPLATE_ID, "params": params}, {"id": VECTOR_KNN_TEMPLATE_ID, "params": params}
+
+
+def register_search_templates(es, force=False):
+    """
+    確認 template 已在叢集上，不存在或內容不同時重新註冊，適合在服務啟動時呼叫
+    :return: 是否可以使用 template
+    """
+    try:
+        _register_stored(es, SEARCH_TEMPLATES, "mustache", force)
+        _templates_state["ready"] = True
+    except Exception as e:
+        print(f"[Error] 註冊 search template 失敗，改用一般 query: {e}")
+        _templates_state["ready"] = False
+    return _templates_state["ready"]
+
+
+def _templates_ready(es):
+    if not SEARCH_TEMPLATES_ENABLED:
+        return False
+    # template 內的 script 引用 stored script，stored script 無法使用時 template 也不能用
+    if STORED_SCRIPTS_ENABLED and not _scripts_ready(es):
+        return False
+    if _templates_state["ready"] is None:
+        register_search_templates(es)
+    return _templates_state["ready"]
+
+
+def _search_template(es, index, template):
+    response = es.search_template(index=index, id=template["id"], params=template["params"])
     return response['hits']['hits']
 
 
 
 
 
+##### 向量搜尋結果快取
+### 同一則傳言常在短時間內被重複查核，(index, 查詢條件, 查詢向量) 相同時直接回傳上次的 hits（已依 _source 篩選）
+### key 帶有 index 的 generation（文件數與最新排序值），新文件寫入後 key 改變，舊結果不再命中；
+### generation 每 RESULT_CACHE_PROBE_INTERVAL 秒最多探測一次，更新既有文件的情況由 TTL 處理
+### _msearch 類的搜尋把過期的探測放進同一個 _msearch，這次不查快取，結果以新的 generation 寫入，不多一次 round trip
+### 設定環境變數 es_result_cache=false 可關閉
+RESULT_CACHE_ENABLED = os.getenv("es_result_cache", "true").lower() == "true"
+RESULT_CACHE_TTL = int(os.getenv("es_result_cache_ttl", "600"))
+RESULT_CACHE_PROBE_INTERVAL = float(os.getenv("es_result_cache_probe_interval", "30"))
+result_cache = LRUCache(max_items=int(os.getenv("es_result_cache_size", "2048")))
+result_cache_stats = CacheStats()
+_generation_fields = {}  # index -> 遞增欄位（例如 pid），探測時一併取最大值
+_index_generations = {}  # index -> (探測時間, generation)；generation 為 None 代表探測失敗
+
+
+def register_generation_field(index, field):
+    """指定 index 的遞增欄位，文件數不變（例如刪一筆、加一筆）時也能發現新文件"""
+    _generation_fields[index] = field
+    _index_generations.pop(index, None)
+
+
+def clear_result_cache():
+    result_cache.clear()
+    _index_generations.clear()
+
+
+def _generation_probe_body(index):
+    field = _generation_fields.get(index)
+    if field:
+        return {"size": 1, "track_total_hits": True, "_source": False, "sort": [{field: "desc"}]}
+    return {"size": 0, "track_total_hits": True}
+
+
+def _parse_generation(response):
+    hits = response['hits']
+    return hits['total']['value'], hits['hits'][0].get('sort') if hits['hits'] else None
+
+
+def _recent_generation(index):
+    """回傳 (是否仍在探測間隔內, generation)"""
+    checked = _index_generations.get(index)
+    if checked and time.monotonic() - checked[0] < RESULT_CACHE_PROBE_INTERVAL:
+        return True, checked[1]
+    return False, None
+
+
+def _record_generation(index, response=None, error=None):
+    generation = None
+    if error is not None:
+        # 探測失敗時這段期間不使用快取，也不每次重試
+        print(f"[Error] 探測 {index} 文件數失敗，暫不使用結果快取: {error}")
+    else:
+        generation = _parse_generation(response)
+    _index_generations[index] = (time.monotonic(), generation)
+    return generation
+
+
+def _stale_indices(searches):
+    """generation 過期、需要探測的 index；快取關閉時不探測"""
+    if not RESULT_CACHE_ENABLED:
+        return []
+    return sorted({search["index"] for search in searches if not _recent_generation(search["index"])[0]})
+
+
+def _probe_lines(probes, template=False):
+    """探測 generation 的 _msearch / _msearch/template 行；template 時以 inline source 送出"""
+    lines = []
+    for index in probes:
+        body = _generation_probe_body(index)
+        lines.append({"index": index})
+        lines.append({"source": body} if template else body)
+    return lines
+
+
+def _record_probes(probes, items):
+    for index, item in zip(probes, items):
+        if 'error' in item:
+            _record_generation(index, error=item['error'])
+        else:
+            _record_generation(index, item)
+
+
+def index_generation(es, index):
+    fresh, generation = _recent_generation(index)
+    if fresh:
+        return generation
+    try:
+        response = es.search(index=index, body=_generation_probe_body(index))
+    except Exception as e:
+        return _record_generation(index, error=e)
+    return _record_generation(index, response)
+
+
+def _result_cache_key(es, index, request, input_embedding):
+    """快取關閉或探測失敗時回傳 None"""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    return _result_key(index, index_generation(es, index), request, input_embedding)
+
+
+def _result_key(index, generation, request, input_embedding):
+    if generation is None:
+        return None
+    fingerprint = json.dumps(_without_vector(request, input_embedding), sort_keys=True, ensure_ascii=False, default=str)
+    return make_key(index, generation, fingerprint, _embedding_hash(input_embedding))
+
+
+def _without_vector(value, input_embedding):
+    """查詢向量另外以 hash 放進 key，fingerprint 只留查詢條件"""
+    if value is input_embedding:
+        return "@@query_vector@@"
+    if isinstance(value, dict):
+        return {key: _without_vector(item, input_embedding) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_without_vector(item, input_embedding) for item in value]
+    return value
+
+
+def _embedding_hash(input_embedding):
+    # bit 索引的查詢向量是 hex 字串
+    data = input_embedding.encode("utf-8") if isinstance(input_embedding, str) else pack_floats(input_embedding)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cached_result(key):
+    if key is None:
+        return None
+    hits = result_cache.get(key)
+    result_cache_stats.record("misses" if hits is None else "memory_hits")
+    return None if hits is None else list(hits)
+
+
+def _store_result(key, hits):
+    if key is not None:
+        result_cache.set(key, list(hits), RESULT_CACHE_TTL)
+
+
+def _cached_results(keys):
+    """回傳與 keys 同順序的 (hits, None)，未命中為 None"""
+    results = []
+    for key in keys:
+        hits = _cached_result(key)
+        results.append(None if hits is None else (hits, None))
+    return results
+
+
+def _store_results(keys, pending, fetched, results, failed=()):
+    """把 pending 位置的搜尋結果填回 results，成功的寫入快取"""
+    for i, result in zip(pending, fetched):
+        results[i] = result
+        if result[1] is None and i not in failed:
+            _store_result(keys[i], result[0])
+
+
+
+
+
 ##### Vector Search
 ### 純粹向量搜尋
-def es_vector_search(es, index, embedding_column_name, input_embedding, recall_size=10):
-    query = {
-        "size": recall_size,
-        "query": {
-            "script_score": {
-                "query": {
-                    "bool": {
-                        "must": [
-                            {
-                                "exists": {
-                                    "field": embedding_column_name
-                                }
-                            }
-                        ]
-                    }
-                },
-                "script": {
-                    "source": f"if (doc['{embedding_column_name}'].size() > 0) {{ return cosineSimilarity(params.query_vector, '{embedding_column_name}') + 1.0; }} else {{ return 0.0; }}",
-                    "params": {"query_vector": input_embedding}
-                }
-            }
+def es_vector_search(es, index, embedding_column_name, input_embedding, recall_size=10, includes=None, excludes=None,
+                     method="script_score", num_candidates=None):
+    input_embedding = _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _vector_search_bodies(embedding_column_name, input_embedding, recall_size, includes, excludes, num_candidates)
+    templates = _vector_templates(embedding_column_name, input_embedding, recall_size, includes, excludes, num_candidates)
+    return _search_vector(es, index, embedding_column_name, method, query, knn_query, templates)
+
+
+def _vector_search_bodies(embedding_column_name, input_embedding, recall_size=10, includes=None, excludes=None, num_candidates=None):
+    """回傳 (script_score 精確搜尋 body, kNN body)"""
+    source = _source_filter(includes, excludes, embedding_column_name)
+    query = search_body(recall_size, source, query=_vector_query(embedding_column_name, input_embedding))
+    knn_query = search_body(recall_size, source, knn=_knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates))
+    return query, knn_query
+
+
+def _vector_query(embedding_column_name, input_embedding):
+    return script_score_clause(embedding_column_name, input_embedding,
+                               {"bool": {"must": [exists_clause(embedding_column_name)]}}, check_exists=True)
+
+
+### 多個搜尋合併成一次 _msearch
+def es_multi_search(es, searches):
+    """
+    把多個搜尋合併成一次 _msearch request，由叢集端平行執行
+    :param searches: 搜尋條件列表，每個項目是一個字典，格式如下：
+                     {
+                         "index": "索引名稱",
+                         "query": query 內容 (與 knn / retriever 至少擇一),
+                         "knn": knn 內容 (可選),
+                         "retriever": retriever 內容 (可選),
+                         "size": 返回的結果數量 (可選，默認為10),
+                         "includes": 要回傳的欄位 (可選),
+                         "excludes": 要排除的欄位 (可選，默認排除向量欄位)
+                     }
+    :return: 與 searches 同順序的 hits 列表；個別搜尋失敗時該項為空列表
+    """
+    return _hits_or_empty(searches, _msearch(es, searches))
+
+
+def _hits_or_empty(searches, results):
+    """把 (hits, error) 轉成 hits 列表，失敗的搜尋印出錯誤並回傳空列表"""
+    hits_list = []
+    for search, (hits, error) in zip(searches, results):
+        if error is not None:
+            print(f"[Error] {search['index']} 搜尋出錯: {error}")
+        hits_list.append(hits or [])
+    return hits_list
+
+
+def _msearch(es, searches, probes=()):
+    """
+    回傳與 searches 同順序的 (hits, error)；每個搜尋都帶 template 且已註冊時改用 _msearch/template
+    :param probes: 一併探測結果快取 generation 的 index，探測結果直接記錄，不在回傳值內
+    """
+    with span("es.msearch", indices=[search["index"] for search in searches], probes=len(probes)) as s:
+        if _templates_applicable(searches) and _templates_ready(es):
+            s.set_attribute("template", True)
+            response = es.msearch_template(search_templates=_msearch_template_body(searches) + _probe_lines(probes, template=True))
+        else:
+            response = es.msearch(searches=_msearch_body(searches) + _probe_lines(probes))
+        results = _msearch_results(response, probes)
+        s.set_attributes(**_msearch_attributes(results))
+        return results
+
+
+def _msearch_attributes(results):
+    """span 屬性：與 indices 同順序的筆數，出錯的搜尋記為 -1"""
+    return {
+        "hits": [-1 if error is not None else len(hits) for hits, error in results],
+        "errors": sum(error is not None for _, error in results),
+    }
+
+
+def _templates_applicable(searches):
+    return SEARCH_TEMPLATES_ENABLED and all("template" in search for search in searches)
+
+
+def _msearch_template_body(searches):
+    body = []
+    for search in searches:
+        body.append({"index": search["index"]})
+        body.append(search["template"])
+    return body
+
+
+def _msearch_body(searches):
+    body = []
+    for search in searches:
+        body.append({"index": search["index"]})
+        request = {
+            "size": search.get("size", 10),
+            "_source": _source_filter(search.get("includes"), search.get("excludes"), search.get("embedding_column_name")),
         }
+        for key in ("query", "knn", "retriever"):
+            if key in search:
+                request[key] = search[key]
+        body.append(request)
+    return body
+
+
+def _msearch_results(response, probes=()):
+    # 最後 len(probes) 筆是 generation 探測；錯誤附上 HTTP status，讓呼叫端分辨「不支援」與暫時性錯誤
+    items = response['responses']
+    _record_probes(probes, items[len(items) - len(probes):])
+    return [
+        (None, {**item['error'], "status": item.get('status')} if isinstance(item['error'], dict) else item['error'])
+        if 'error' in item else (item['hits']['hits'], None)
+        for item in items[:len(items) - len(probes)]
+    ]
+
+
+### 多個索引的純粹向量搜尋，一次 round trip
+@traced("es.multi_vector_search")
+def es_multi_vector_search(es, searches):
+    """
+    :param searches: 搜尋條件列表，每個項目是一個字典，格式如下：
+                     {
+                         "index": "索引名稱",
+                         "embedding_column_name": "向量欄位名稱",
+                         "input_embedding": 查詢向量,
+                         "recall_size": 返回的結果數量 (可選，默認為10),
+                         "includes": 要回傳的欄位 (可選),
+                         "excludes": 要排除的欄位 (可選，默認排除向量欄位),
+                         "method": "script_score"/"knn" (可選，默認為script_score),
+                         "num_candidates": kNN 候選數 (可選)
+                     }
+    :return: 與 searches 同順序的 hits 列表
+    """
+    searches = [_fit_search(es, search) for search in searches]
+    requests = [_multi_vector_request(search) for search in searches]
+    stale = _stale_indices(searches)
+
+    def key_of(search, request):
+        return _result_cache_key(es, search["index"], request, search["input_embedding"])
+
+    keys = [None if search["index"] in stale else key_of(search, request) for search, request in zip(searches, requests)]
+    results = _cached_results(keys)
+
+    # 只有未命中快取的搜尋送出 _msearch，過期的 generation 一起探測
+    pending = [i for i, result in enumerate(results) if result is None]
+    set_attributes(indices=[search["index"] for search in searches], cache_hits=len(searches) - len(pending))
+    if pending:
+        fetched = _multi_vector_fetch(es, [searches[i] for i in pending], [requests[i] for i in pending], stale)
+        keys = [key_of(search, request) if search["index"] in stale else key for search, request, key in zip(searches, requests, keys)]
+        _store_results(keys, pending, fetched, results)
+    return _hits_or_empty(searches, results)
+
+
+def _multi_vector_fetch(es, searches, requests, probes=()):
+    results = _msearch(es, requests, probes)
+
+    # kNN 失敗的搜尋改用 script_score 再送一次
+    retry = _knn_retry(searches, requests, results)
+    if retry:
+        retried = _msearch(es, [_multi_vector_request(searches[i]) for i in retry])
+        for i, result in zip(retry, retried):
+            results[i] = result
+    return results
+
+
+def _knn_retry(searches, requests, results):
+    """
+    回傳 kNN 失敗、需要重送的位置；只有「不支援」的錯誤才記錄為不支援 kNN 並改用 script_score，
+    暫時性錯誤（逾時、429、shard 失敗）原樣重送一次，不影響之後的查詢
+    """
+    retry = [i for i, (request, (_, error)) in enumerate(zip(requests, results)) if error is not None and "knn" in request]
+    for i in retry:
+        if _is_unsupported_error(results[i][1]):
+            _mark_knn_unsupported(searches[i]["index"], searches[i]["embedding_column_name"], results[i][1])
+        else:
+            print(f"[Error] {searches[i]['index']} kNN 搜尋出錯，重送一次: {results[i][1]}")
+    return retry
+
+
+def _multi_vector_request(search):
+    recall_size = search.get("recall_size", 10)
+    request = {
+        "index": search["index"],
+        "size": recall_size,
+        "includes": search.get("includes"),
+        "excludes": search.get("excludes"),
+        "embedding_column_name": search["embedding_column_name"],
     }
-    response = es.search(index=index, body=query)
-    return response['hits']['hits']
+    exact_template, knn_template = _vector_templates(search["embedding_column_name"], search["input_embedding"], recall_size,
+                                                     search.get("includes"), search.get("excludes"), search.get("num_candidates"))
+    if _use_knn(search.get("method", "script_score"), search["index"], search["embedding_column_name"]):
+        request["knn"] = _knn_clause(search["embedding_column_name"], search["input_embedding"], recall_size, search.get("num_candidates"))
+        request["template"] = knn_template
+    else:
+        _require_script_score_layout(search["index"], search["embedding_column_name"])
+        request["query"] = _vector_query(search["embedding_column_name"], search["input_embedding"])
+        request["template"] = exact_template
+    return request
+#  cna_hits, tfc_hits = es_multi_vector_search(es, [
+#     {"index": "lab_mainsite_search", "embedding_column_name": "embeddings", "input_embedding": input_embedding, "recall_size": 10, "includes": ["h1", "dt", "pid"]},
+#     {"index": "lab_tfc_search_test", "embedding_column_name": "embeddings", "input_embedding": input_embedding, "recall_size": 5},
+# ])
 
 
 ### 智能向量搜尋 - 支持可選日期篩選（基於PID）
-def es_smart_vector_search(es, index, embedding_column_name, input_embedding, pid_column_name=None, start_date=None, end_date=None, recall_size=10):
+def es_smart_vector_search(es, index, embedding_column_name, input_embedding, pid_column_name=None, start_date=None, end_date=None, recall_size=10, includes=None, excludes=None,
+                           method="script_score", num_candidates=None):
     """
     智能向量搜尋函數，根據輸入參數自動選擇合適的搜尋方式
     :param pid_column_name: PID欄位名稱（可選）
@@ -101,7 +975,7 @@ def es_smart_vector_search(es, index, embedding_column_name, input_embedding, pi
     """
     # 沒有提供日期參數，使用純向量搜尋
     if not pid_column_name or (start_date is None and end_date is None):
-        return es_vector_search(es, index, embedding_column_name, input_embedding, recall_size)
+        return es_vector_search(es, index, embedding_column_name, input_embedding, recall_size, includes, excludes, method, num_candidates)
     
     # 處理日期邏輯
     if start_date is not None and end_date is None:
@@ -112,11 +986,12 @@ def es_smart_vector_search(es, index, embedding_column_name, input_embedding, pi
         start_date = end_date
     
     # 使用日期範圍向量搜尋（基於PID前綴）
-    return es_vector_search_with_date_range(es, index, embedding_column_name, input_embedding, pid_column_name, start_date, end_date, recall_size)
+    return es_vector_search_with_date_range(es, index, embedding_column_name, input_embedding, pid_column_name, start_date, end_date, recall_size, includes, excludes, method, num_candidates)
 
 
 ### 向量搜尋結合日期範圍篩選（基於PID前綴）
-def es_vector_search_with_date_range(es, index, embedding_column_name, input_embedding, pid_column_name, start_date, end_date, recall_size=10):
+def es_vector_search_with_date_range(es, index, embedding_column_name, input_embedding, pid_column_name, start_date, end_date, recall_size=10, includes=None, excludes=None,
+                                     method="script_score", num_candidates=None):
     """
     使用PID前綴進行日期範圍篩選的向量搜尋
     :param pid_column_name: PID欄位名稱
@@ -125,49 +1000,42 @@ def es_vector_search_with_date_range(es, index, embedding_column_name, input_emb
     
     PID格式：YYYYMMDDNNNN（前8位是日期，後4位是編號）
     """
+    input_embedding = _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _date_range_vector_bodies(embedding_column_name, input_embedding, pid_column_name, start_date, end_date,
+                                                 recall_size, includes, excludes, num_candidates)
+    templates = _vector_templates(embedding_column_name, input_embedding, recall_size, includes, excludes, num_candidates,
+                                  [pid_range_clause(pid_column_name, start_date, end_date)])
+    return _search_vector(es, index, embedding_column_name, method, query, knn_query, templates)
+
+
+def _date_range_vector_bodies(embedding_column_name, input_embedding, pid_column_name, start_date, end_date, recall_size=10,
+                              includes=None, excludes=None, num_candidates=None):
     # 將日期轉換為PID前綴範圍
-    start_pid_prefix = f"{start_date}0002"  # 該日期的最小PID
-    end_pid_prefix = f"{end_date}9999"      # 該日期的最大PID
-    
-    query = {
-        "size": recall_size,
-        "query": {
-            "script_score": {
-                "query": {
-                    "bool": {
-                        "must": [
-                            {
-                                "range": {
-                                    pid_column_name: {
-                                        "gte": start_pid_prefix,
-                                        "lte": end_pid_prefix
-                                    }
-                                }
-                            },
-                            {
-                                "exists": {
-                                    "field": embedding_column_name
-                                }
-                            }
-                        ]
-                    }
-                },
-                "script": {
-                    "source": f"if (doc['{embedding_column_name}'].size() > 0) {{ return cosineSimilarity(params.query_vector, '{embedding_column_name}') + 1.0; }} else {{ return 0.0; }}",
-                    "params": {"query_vector": input_embedding}
-                }
-            }
-        }
-    }
-    response = es.search(index=index, body=query)
-    return response['hits']['hits']
+    pid_filter = [pid_range_clause(pid_column_name, start_date, end_date)]
+    source = _source_filter(includes, excludes, embedding_column_name)
+    query = search_body(recall_size, source, query=script_score_clause(
+        embedding_column_name, input_embedding,
+        {"bool": {"must": pid_filter + [exists_clause(embedding_column_name)]}}, check_exists=True))
+    knn_query = search_body(recall_size, source, knn=_knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates, pid_filter))
+    return query, knn_query
 
 
 ### 加入1個query條件篩選。
-def es_vector_search_with_queryString(es, index, embedding_column_name, input_embedding, query_column_name, filter_query, recall_size=10):
-    query = { "size": recall_size,  "query": { "bool": { "must": [ { "term": { query_column_name: filter_query } }, { "script_score": { "query": {"match_all": {}}, "script": { "source": f"cosineSimilarity(params.query_vector, '{embedding_column_name}') + 1.0", "params": { "query_vector": input_embedding } } } } ] } } }
-    response = es.search(index=index, body=query)
-    return response['hits']['hits']
+def es_vector_search_with_queryString(es, index, embedding_column_name, input_embedding, query_column_name, filter_query, recall_size=10, includes=None, excludes=None,
+                                      method="script_score", num_candidates=None):
+    input_embedding = _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _queryString_vector_bodies(embedding_column_name, input_embedding, query_column_name, filter_query,
+                                                  recall_size, includes, excludes, num_candidates)
+    return _search_vector(es, index, embedding_column_name, method, query, knn_query)
+
+
+def _queryString_vector_bodies(embedding_column_name, input_embedding, query_column_name, filter_query, recall_size=10,
+                               includes=None, excludes=None, num_candidates=None):
+    term = { "term": { query_column_name: filter_query } }
+    source = _source_filter(includes, excludes, embedding_column_name)
+    query = search_body(recall_size, source, query={ "bool": { "must": [ term, script_score_clause(embedding_column_name, input_embedding) ] } })
+    knn_query = search_body(recall_size, source, knn=_knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates, [term]))
+    return query, knn_query
 
 
 ### 加入多個query條件篩選。
@@ -177,7 +1045,11 @@ def es_advanced_vector_search(
     embedding_column_name: str,
     input_embedding,
     filters: List[Dict[str, Any]],
-    recall_size: int = 10
+    recall_size: int = 10,
+    includes: Optional[List[str]] = None,
+    excludes: Optional[List[str]] = None,
+    method: str = "script_score",
+    num_candidates: Optional[int] = None
 ) -> List[Dict[str, Any]]:
     """
     執行向量搜尋，並結合多種過濾條件，支持同一欄位多個match_phrase query (OR 條件)
@@ -188,58 +1060,39 @@ def es_advanced_vector_search(
                         "value": 過濾值 或 [過濾值1, 過濾值2, ...]
                     }
     :param recall_size: 返回的結果數量
+    :param includes: 要回傳的 _source 欄位（可選）
+    :param excludes: 要排除的 _source 欄位（可選，默認排除向量欄位）
+    :param method: "script_score" 精確搜尋 / "knn" 近似搜尋，過濾條件會放進 kNN 的 filter
+    :param num_candidates: kNN 候選數（可選）
     :return: 匹配的文檔列表
     """
-    must_conditions = []
-    should_conditions = []
+    input_embedding = _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _advanced_vector_bodies(embedding_column_name, input_embedding, filters, recall_size, includes, excludes, num_candidates)
 
-    # 處理所有過濾條件
-    for filter_condition in filters:
-        filter_type = filter_condition["type"]
-        field = filter_condition["field"]
-        value = filter_condition["value"]
+    # 執行搜尋
+    return _search_vector(es, index, embedding_column_name, method, query, knn_query)
 
-        if filter_type == "term":
-            if isinstance(value, list):
-                must_conditions.append({"terms": {field: value}})
-            else:
-                must_conditions.append({"term": {field: value}})
-        elif filter_type == "match" or filter_type == "match_phrase":
-            # 如果是多個值，則應將它們加到 should_conditions 中，作為 OR 條件
-            if isinstance(value, list):
-                for v in value:
-                    should_conditions.append({filter_type: {field: v}})
-            else:
-                should_conditions.append({filter_type: {field: value}})
-        elif filter_type == "range":
-            must_conditions.append({"range": {field: value}})
-        else:
-            must_conditions.append({filter_type: {field: value}})
-            # raise ValueError(f"不支持的過濾類型: {filter_type}")
+
+def _advanced_vector_bodies(embedding_column_name, input_embedding, filters, recall_size=10, includes=None, excludes=None,
+                            num_candidates=None):
+    must_conditions, should_conditions = filter_clauses(filters)
+    source = _source_filter(includes, excludes, embedding_column_name)
 
     # 構建完整的查詢
-    query = {
-        "size": recall_size,
-        "query": {
-            "script_score": {
-                "query": {
-                    "bool": {
-                        "must": must_conditions,
-                        "should": should_conditions,
-                        "minimum_should_match": 1 if should_conditions else 0  # 至少匹配一個 should 條件
-                    }
-                },
-                "script": {
-                    "source": f"cosineSimilarity(params.query_vector, '{embedding_column_name}') + 1.0",
-                    "params": {"query_vector": input_embedding}
-                }
-            }
+    query = search_body(recall_size, source, query=script_score_clause(embedding_column_name, input_embedding, {
+        "bool": {
+            "must": must_conditions,
+            "should": should_conditions,
+            "minimum_should_match": 1 if should_conditions else 0  # 至少匹配一個 should 條件
         }
-    }
+    }))
 
-    # 執行搜尋
-    response = es.search(index=index, body=query)
-    return response['hits']['hits']
+    # kNN：must 條件直接過濾，match/match_phrase 以 should 組成 OR 條件
+    knn_filters = list(must_conditions)
+    if should_conditions:
+        knn_filters.append({"bool": {"should": should_conditions, "minimum_should_match": 1}})
+    knn_query = search_body(recall_size, source, knn=_knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates, knn_filters))
+    return query, knn_query
 #  filters = [
 #     {"type": "term", "field": "image_type.raw", "value": "其他照片"},
 #     {"type": "match", "field": "exp", "value": "降雨"}#,
@@ -256,7 +1109,11 @@ def es_keyword_weighted_search(
     input_embedding: List[float],
     keyword_fields: Optional[List[Dict[str, Any]]] = None,
     filters: Optional[List[Dict[str, Any]]] = None,
-    recall_size: int = 10
+    recall_size: int = 10,
+    includes: Optional[List[str]] = None,
+    excludes: Optional[List[str]] = None,
+    method: str = "script_score",
+    num_candidates: Optional[int] = None
 ) -> List[Dict[str, Any]]:
     """
     執行向量搜尋，可選擇性地結合關鍵字加權和多種過濾條件
@@ -273,81 +1130,258 @@ def es_keyword_weighted_search(
                         "value": 過濾值
                     }
     :param recall_size: 返回的結果數量
+    :param includes: 要回傳的 _source 欄位（可選）
+    :param excludes: 要排除的 _source 欄位（可選，默認排除向量欄位）
+    :param method: "script_score" 精確搜尋 / "knn" 近似搜尋（關鍵字加權分數與 kNN 分數相加）
+    :param num_candidates: kNN 候選數（可選）
     :return: 匹配的文檔列表
     """
-    must_conditions = []
-    should_conditions = []
+    input_embedding = _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _keyword_weighted_bodies(embedding_column_name, input_embedding, keyword_fields, filters, recall_size,
+                                                includes, excludes, num_candidates)
 
-    # 處理關鍵字加權（如果提供）
-    if keyword_fields:
-        for field_info in keyword_fields:
-            field = field_info["field"]
-            keywords = field_info["keywords"]
-            weight = field_info.get("weight", 1.0)
-            
-            for keyword in keywords:
-                should_conditions.append({
-                    "match": {
-                        field: {
-                            "query": keyword,
-                            "boost": weight
-                        }
-                    }
-                })
+    # 執行搜尋
+    try:
+        return _search_vector(es, index, embedding_column_name, method, query, knn_query)
+    except Exception as e:
+        #print(f"搜索出錯: {str(e)}")
+        return []
 
-    # 處理所有過濾條件（如果提供）
-    if filters:
-        for filter_condition in filters:
-            filter_type = filter_condition["type"]
-            field = filter_condition["field"]
-            value = filter_condition["value"]
-
-            if filter_type == "term":
-                must_conditions.append({"term": {field: value}})
-            elif filter_type == "match":
-                must_conditions.append({"match": {field: value}})
-            elif filter_type == "range":
-                must_conditions.append({"range": {field: value}})
-            else:
-                raise ValueError(f"不支持的過濾類型: {filter_type}")
 
-    # 添加向量搜尋條件
-    must_conditions.append({
-        "script_score": {
-            "query": {"match_all": {}},
-            "script": {
-                "source": f"cosineSimilarity(params.query_vector, '{embedding_column_name}') + 1.0",
-                "params": {"query_vector": input_embedding}
-            }
-        }
-    })
+def _keyword_weighted_bodies(embedding_column_name, input_embedding, keyword_fields=None, filters=None, recall_size=10,
+                             includes=None, excludes=None, num_candidates=None):
+    should_conditions = keyword_boost_clauses(keyword_fields)
+    filter_conditions, _ = filter_clauses(filters, strict=True)
+    source = _source_filter(includes, excludes, embedding_column_name)
 
-    # 構建完整的查詢
-    query = {
-        "size": recall_size,
-        "query": {
-            "bool": {
-                "must": must_conditions
-            }
+    # 過濾條件與向量分數都放在 must，關鍵字加權以 should 分數加上去
+    query_bool = {"must": filter_conditions + [script_score_clause(embedding_column_name, input_embedding)]}
+    if should_conditions:
+        query_bool["should"] = should_conditions
+    query = search_body(recall_size, source, query={"bool": query_bool})
+
+    # kNN：過濾條件放進 kNN filter，關鍵字加權以 query 的 should 分數加到 kNN 分數上
+    knn_query = search_body(recall_size, source, knn=_knn_clause(embedding_column_name, input_embedding, recall_size, num_candidates, filter_conditions))
+    if should_conditions:
+        knn_query["query"] = {"bool": {"filter": filter_conditions, "should": should_conditions, "minimum_should_match": 1}}
+    return query, knn_query
+
+
+
+
+
+##### Hybrid Search（BM25 + 向量，Reciprocal Rank Fusion）
+### 向量搜尋對人名、金額（例如 3萬9522元）這類精確字詞不敏感，加上關鍵字搜尋再用 RRF 合併排序
+### 叢集支援 rrf retriever（8.14+）時由叢集端合併，否則兩邊各搜一次，在 client 端合併
+RRF_RANK_CONSTANT = 60
+RRF_RANK_WINDOW_SIZE = 50
+_rrf_unsupported = set()  # 已知不支援 rrf retriever 的 index
+
+
+def reciprocal_rank_fusion(hit_lists, rank_constant=RRF_RANK_CONSTANT, size=10):
+    """
+    以 RRF 合併多個排序結果：score = Σ 1 / (rank_constant + rank)
+    :param hit_lists: 多個 hits 列表，各自依分數排序
+    :return: 合併後前 size 筆 hits，_score 為 RRF 分數
+    """
+    scores = {}
+    hits_by_id = {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits, 1):
+            key = (hit.get('_index'), hit['_id'])
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rank_constant + rank)
+            hits_by_id.setdefault(key, hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
+    return [{**hits_by_id[key], "_score": scores[key]} for key in ranked]
+
+
+def _lexical_query(query_text, text_fields, filter_conditions=None):
+    return {
+        "bool": {
+            "must": [{"multi_match": {"query": query_text, "fields": text_fields}}],
+            "filter": filter_conditions or []
         }
     }
 
-    # 如果有 should 條件，添加到查詢中
-    if should_conditions:
-        query["query"]["bool"]["should"] = should_conditions
 
-    # 將查詢轉換為JSON字符串，然後再解析回Python對象
-    # 這可以解決一些JSON序列化的問題
-    query_json = json.dumps(query)
-    query = json.loads(query_json)
+def _hybrid_requests(search):
+    """回傳 (叢集端 rrf request, [client 端用的 lexical request, vector request])"""
+    index = search["index"]
+    embedding_column_name = search["embedding_column_name"]
+    recall_size = search.get("recall_size", 10)
+    window = max(recall_size, search.get("rank_window_size", RRF_RANK_WINDOW_SIZE))
+    filter_conditions = search.get("filters") or []
+    common = {
+        "index": index,
+        "includes": search.get("includes"),
+        "excludes": search.get("excludes"),
+        "embedding_column_name": embedding_column_name,
+    }
+    lexical = _lexical_query(search["query_text"], search["text_fields"], filter_conditions)
+    knn = _knn_clause(embedding_column_name, search["input_embedding"], window, search.get("num_candidates"), filter_conditions)
 
-    # 執行搜尋
-    try:
-        response = es.search(index=index, body=query)
-        return response['hits']['hits']
-    except Exception as e:
-        #print(f"搜索出錯: {str(e)}")
+    server = {**common, "size": recall_size, "retriever": {"rrf": {
+        "retrievers": [{"standard": {"query": lexical}}, {"knn": knn}],
+        "rank_constant": search.get("rank_constant", RRF_RANK_CONSTANT),
+        "rank_window_size": window,
+    }}}
+
+    vector = {**common, "size": window}
+    if _use_knn("knn", index, embedding_column_name):
+        vector["knn"] = knn
+    else:
+        _require_script_score_layout(index, embedding_column_name)
+        vector["query"] = _vector_query(embedding_column_name, search["input_embedding"])
+        if filter_conditions:
+            vector["query"]["script_score"]["query"]["bool"]["filter"] = filter_conditions
+    return server, [{**common, "size": window, "query": lexical}, vector]
+
+
+### 多個索引的 hybrid 搜尋，叢集端 RRF 時只要一次 round trip
+@traced("es.multi_hybrid_search")
+def es_multi_hybrid_search(es, searches, server_side=True):
+    """
+    :param searches: 搜尋條件列表，每個項目是一個字典，格式如下：
+                     {
+                         "index": "索引名稱",
+                         "embedding_column_name": "向量欄位名稱",
+                         "input_embedding": 查詢向量,
+                         "query_text": 關鍵字搜尋的文字,
+                         "text_fields": 關鍵字搜尋的欄位，例如 ["h1^2", "article"],
+                         "filters": 過濾條件 query 列表 (可選),
+                         "recall_size": 返回的結果數量 (可選，默認為10),
+                         "rank_window_size": 每一路取幾筆參與 RRF (可選，默認為50),
+                         "rank_constant": RRF 常數 (可選，默認為60),
+                         "includes": 要回傳的欄位 (可選),
+                         "excludes": 要排除的欄位 (可選，默認排除向量欄位),
+                         "num_candidates": kNN 候選數 (可選)
+                     }
+    :param server_side: 是否優先使用叢集端 rrf retriever
+    :return: 與 searches 同順序的 hits 列表
+    """
+    searches = [_fit_search(es, search) for search in searches]
+    stale = _stale_indices(searches)
+
+    def key_of(search):
+        return _result_cache_key(es, search["index"], {**search, "server_side": server_side}, search["input_embedding"])
+
+    keys = [None if search["index"] in stale else key_of(search) for search in searches]
+    results = _cached_results(keys)
+    pending = [i for i, result in enumerate(results) if result is None]
+    set_attributes(indices=[search["index"] for search in searches], cache_hits=len(searches) - len(pending))
+    if pending:
+        fetched, failed = _multi_hybrid_fetch(es, [searches[i] for i in pending], server_side, stale)
+        keys = [key_of(search) if search["index"] in stale else key for search, key in zip(searches, keys)]
+        _store_results(keys, pending, [(hits, None) for hits in fetched], results, {pending[n] for n in failed})
+    return [hits for hits, _ in results]
+
+
+def _multi_hybrid_fetch(es, searches, server_side, probes=()):
+    """
+    回傳 (hits 列表, 任一路搜尋出錯的位置)
+    :param probes: 放進第一次 _msearch 的 generation 探測
+    """
+    results = [None] * len(searches)
+
+    # 叢集端 RRF
+    server_idx = _server_rrf_positions(searches, server_side)
+    if server_idx:
+        _merge_server_rrf(searches, server_idx, _msearch(es, [_hybrid_requests(searches[i])[0] for i in server_idx], probes), results)
+        probes = ()
+
+    # client 端 RRF：lexical 與 vector 兩路一起送
+    # 叢集端 RRF 之後才組 request，剛記錄為不支援 kNN 的索引 vector 一路直接用 script_score
+    failed = set()
+    client_idx = [i for i in range(len(searches)) if results[i] is None]
+    if client_idx:
+        legs = [_hybrid_requests(searches[i])[1] for i in client_idx]
+        flat = _msearch(es, [request for pair in legs for request in pair], probes)
+        retry = _vector_leg_retry(searches, client_idx, legs, flat)
+        if retry:
+            retried = _msearch(es, [_hybrid_requests(searches[client_idx[n]])[1][1] for n in retry])
+            for n, result in zip(retry, retried):
+                flat[2 * n + 1] = result
+        failed = _merge_client_rrf(searches, client_idx, flat, results)
+    return results, failed
+
+
+def _server_rrf_positions(searches, server_side):
+    """可以用叢集端 RRF 的位置；rrf retriever 的向量一路是 kNN，不支援 kNN 的索引改由 client 端以 script_score 合併"""
+    if not server_side:
         return []
+    return [i for i, search in enumerate(searches)
+            if search["index"] not in _rrf_unsupported and _use_knn("knn", search["index"], search["embedding_column_name"])]
+
+
+def _vector_leg_retry(searches, client_idx, legs, flat):
+    """回傳 vector 一路因索引不支援 kNN 而失敗的位置（client_idx 中的順序），並記錄為不支援 kNN，重送時改用 script_score"""
+    retry = []
+    for n, i in enumerate(client_idx):
+        error = flat[2 * n + 1][1]
+        if "knn" in legs[n][1] and _is_unsupported_error(error):
+            _mark_knn_unsupported(searches[i]["index"], searches[i]["embedding_column_name"], error)
+            retry.append(n)
+    return retry
+
+
+def _merge_server_rrf(searches, server_idx, responses, results):
+    for i, (hits, error) in zip(server_idx, responses):
+        if error is None:
+            results[i] = hits
+        elif _is_knn_unsupported_error(error):
+            # rrf retriever 內的 kNN 失敗，不是 rrf 不支援；這次與之後都由 client 端以 script_score 合併
+            _mark_knn_unsupported(searches[i]["index"], searches[i]["embedding_column_name"], error)
+        elif _is_unsupported_error(error, license_errors=True):
+            print(f"[Info] {searches[i]['index']} 無法使用 rrf retriever，改由 client 端合併：{error}")
+            _rrf_unsupported.add(searches[i]["index"])
+        else:
+            # 暫時性錯誤：這次改由 client 端合併，之後仍先試叢集端 RRF
+            print(f"[Error] {searches[i]['index']} rrf retriever 搜尋出錯，這次改由 client 端合併：{error}")
+
+
+def _merge_client_rrf(searches, client_idx, flat, results):
+    """回傳任一路搜尋出錯的位置，這些結果不寫入快取"""
+    failed = set()
+    for n, i in enumerate(client_idx):
+        lexical, vector = flat[2 * n], flat[2 * n + 1]
+        for (_, error), kind in ((lexical, "關鍵字"), (vector, "向量")):
+            if error is not None:
+                print(f"[Error] {searches[i]['index']} {kind}搜尋出錯: {error}")
+                failed.add(i)
+        results[i] = reciprocal_rank_fusion(
+            [lexical[0] or [], vector[0] or []],
+            rank_constant=searches[i].get("rank_constant", RRF_RANK_CONSTANT),
+            size=searches[i].get("recall_size", 10),
+        )
+    return failed
+
+
+### 單一索引的 hybrid 搜尋
+def es_hybrid_search(es, index, embedding_column_name, input_embedding, query_text, text_fields, filters=None,
+                     recall_size=10, rank_window_size=RRF_RANK_WINDOW_SIZE, rank_constant=RRF_RANK_CONSTANT,
+                     includes=None, excludes=None, num_candidates=None, server_side=True):
+    """
+    關鍵字（BM25）與向量搜尋同時執行，以 Reciprocal Rank Fusion 合併排序
+    :param query_text: 關鍵字搜尋的文字，通常就是要查核的文本
+    :param text_fields: 關鍵字搜尋的欄位，可加權，例如 ["h1^2", "article"]
+    :param filters: 兩路搜尋共用的過濾條件 query 列表（可選）
+    """
+    return es_multi_hybrid_search(es, [{
+        "index": index,
+        "embedding_column_name": embedding_column_name,
+        "input_embedding": input_embedding,
+        "query_text": query_text,
+        "text_fields": text_fields,
+        "filters": filters,
+        "recall_size": recall_size,
+        "rank_window_size": rank_window_size,
+        "rank_constant": rank_constant,
+        "includes": includes,
+        "excludes": excludes,
+        "num_candidates": num_candidates,
+    }], server_side=server_side)[0]
+#  hits = es_hybrid_search(es, "lab_mainsite_search", "embeddings", input_embedding,
+#                          "女性皆可領取3萬9522元", ["h1^2", "whatHappen200", "article"], recall_size=10)
 
 
 
@@ -0,0 +1,459 @@
+"""
+es_SearchLib 的 AsyncElasticsearch 版本
+
+每個 helper 的參數與回傳格式都與 es_SearchLib 相同，只是第一個參數換成 AsyncElasticsearch 並改為 await，
+query 內容共用 es_SearchLib 的 body builder，kNN / rrf 不支援的記錄也與同步版共用。
+
+AsyncElasticsearch 的連線綁定在建立它的事件循環上，app.py 會在不同執行緒開新的 loop，
+所以與 clients.py 一樣每個 loop 各自一份：
+    es = get_async_es()                  # 在協程內取得目前 loop 的 client
+    await close_async_es()               # loop 結束前關閉
+    async with async_es_session() as es: # 或用 context manager 自動關閉
+"""
+import os
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional
+
+from elasticsearch import AsyncElasticsearch, BadRequestError, NotFoundError
+from dotenv import load_dotenv
+
+from tracing import span, traced, set_attributes
+from es_SearchLib import (
+    _source_filter, _vector_layouts, _parse_vector_layout, _fit_to_layout,
+    _queryJSON_body, _string_match_body, _string_term_body, _certain_date_body, _date_range_body,
+    DATE_SCAN_PAGE_SIZE, PIT_KEEP_ALIVE, _pit_page_body,
+    _use_knn, _require_script_score_layout, _mark_knn_unsupported, _api_error, _is_unsupported_error, _vector_search_bodies, _date_range_vector_bodies, _queryString_vector_bodies,
+    _advanced_vector_bodies, _keyword_weighted_bodies, pid_range_clause,
+    STORED_SCRIPTS, STORED_SCRIPTS_ENABLED, _scripts_state, _sum_script_stats, _with_baseline, _stored_script_outdated,
+    SEARCH_TEMPLATES, SEARCH_TEMPLATES_ENABLED, _templates_state, _vector_templates, _templates_applicable,
+    _msearch_body, _msearch_template_body, _msearch_results, _msearch_attributes, _hits_or_empty, _multi_vector_request, _knn_retry,
+    _hybrid_requests, _server_rrf_positions, _vector_leg_retry, _merge_server_rrf, _merge_client_rrf,
+    RRF_RANK_CONSTANT, RRF_RANK_WINDOW_SIZE,
+    RESULT_CACHE_ENABLED, _generation_probe_body, _recent_generation, _record_generation, _result_key,
+    _stale_indices, _probe_lines,
+    _cached_result, _store_result, _cached_results, _store_results,
+)
+
+load_dotenv()
+
+ES_REQUEST_TIMEOUT = float(os.getenv("es_request_timeout", "3600"))
+
+_async_es_clients = weakref.WeakKeyDictionary()
+
+
+##### Client 生命週期
+def get_async_es() -> AsyncElasticsearch:
+    """取得目前事件循環專用的 AsyncElasticsearch，必須在協程內呼叫"""
+    loop = asyncio.get_running_loop()
+    client = _async_es_clients.get(loop)
+    if client is None:
+        client = AsyncElasticsearch(os.getenv("es_host"), basic_auth=(os.getenv("es_username"), os.getenv("es_password")),
+                                    request_timeout=ES_REQUEST_TIMEOUT)
+        _async_es_clients[loop] = client
+    return client
+
+
+async def close_async_es():
+    """關閉目前事件循環的 client；之後再呼叫 get_async_es() 會重新建立"""
+    client = _async_es_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+@asynccontextmanager
+async def async_es_session():
+    try:
+        yield get_async_es()
+    finally:
+        await close_async_es()
+
+
+##### 向量欄位 layout
+async def get_vector_layout(es, index, embedding_column_name):
+    key = (index, embedding_column_name)
+    if key in _vector_layouts:
+        return _vector_layouts[key]
+    try:
+        response = await es.indices.get_field_mapping(index=index, fields=embedding_column_name)
+    except Exception as e:
+        print(f"[Error] 讀取 {index}.{embedding_column_name} mapping 失敗: {e}")
+        return None
+    _vector_layouts[key] = _parse_vector_layout(response, embedding_column_name)
+    return _vector_layouts[key]
+
+
+async def fit_query_vector(es, index, embedding_column_name, input_embedding):
+    return _fit_to_layout(await get_vector_layout(es, index, embedding_column_name), input_embedding)
+
+
+async def _prepare_vector_search(es, index, embedding_column_name, input_embedding):
+    await _scripts_ready(es)
+    return await fit_query_vector(es, index, embedding_column_name, input_embedding)
+
+
+async def _fit_search(es, search):
+    return {**search, "input_embedding": await _prepare_vector_search(es, search["index"], search["embedding_column_name"], search["input_embedding"])}
+
+
+##### 原生 query / 欄位字串 / 日期搜尋
+async def _search(es, index, body):
+    response = await es.search(index=index, body=body)
+    return response['hits']['hits']
+
+
+async def es_search_queryJSON(es, index, query, includes=None, excludes=None):
+    return await _search(es, index, _queryJSON_body(query, includes, excludes))
+
+
+async def es_search_string_match(es, index, field_name, search_string, recall_size=10, includes=None, excludes=None):
+    return await _search(es, index, _string_match_body(field_name, search_string, recall_size, includes, excludes))
+
+
+async def es_search_string_term(es, index, field_name, search_string, recall_size=10, includes=None, excludes=None):
+    return await _search(es, index, _string_term_body(field_name, search_string, recall_size, includes, excludes))
+
+
+async def es_search_certain_date(es, index, date_column_name, date, size=1000, includes=None, excludes=None):
+    return await _search(es, index, _certain_date_body(date_column_name, date, size, includes, excludes))
+
+
+async def es_search_date_range(es, index, date_column_name, start_date, end_date, includes=None, excludes=None): # 前後皆含
+    return await _search(es, index, _date_range_body(date_column_name, start_date, end_date, includes, excludes))
+
+
+async def es_scan_certain_date(es, index, date_column_name, date, page_size=DATE_SCAN_PAGE_SIZE, includes=None, excludes=None,
+                               sort=None, batches=False):
+    async for item in es_scan_date_range(es, index, date_column_name, date, date, page_size, includes, excludes, sort, batches):
+        yield item
+
+
+async def es_scan_date_range(es, index, date_column_name, start_date, end_date, page_size=DATE_SCAN_PAGE_SIZE, includes=None, excludes=None,
+                             sort=None, batches=False): # 前後皆含
+    """async generator，用法：async for hit in es_scan_date_range(...)"""
+    query = _date_range_body(date_column_name, start_date, end_date)["query"]
+    async for page in _scan_pit(es, index, query, page_size, sort, _source_filter(includes, excludes)):
+        if batches:
+            yield page
+        else:
+            for hit in page:
+                yield hit
+
+
+async def _scan_pit(es, index, query, page_size, sort, source):
+    pit_id = (await es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE))["id"]
+    try:
+        search_after = None
+        while True:
+            response = await es.search(body=_pit_page_body(pit_id, query, page_size, sort, source, search_after))
+            pit_id = response.get("pit_id", pit_id)
+            hits = response['hits']['hits']
+            if not hits:
+                return
+            yield hits
+            if len(hits) < page_size:
+                return
+            search_after = hits[-1]["sort"]
+    finally:
+        try:
+            await es.close_point_in_time(id=pit_id)
+        except Exception as e:
+            print(f"[Error] 關閉 point in time 失敗: {e}")
+
+
+##### Stored scripts / search templates
+async def _register_stored(es, scripts, lang, force=False):
+    for script_id, source in scripts.items():
+        existing = None
+        if not force:
+            try:
+                existing = await es.get_script(id=script_id)
+            except NotFoundError:
+                pass
+        if force or _stored_script_outdated(existing, source):
+            await es.put_script(id=script_id, script={"lang": lang, "source": source})
+            print(f"[Info] 註冊 stored script {script_id}")
+
+
+async def register_stored_scripts(es, force=False):
+    try:
+        await _register_stored(es, STORED_SCRIPTS, "painless", force)
+        _scripts_state["ready"] = True
+    except Exception as e:
+        print(f"[Error] 註冊 stored script 失敗，改用 inline script: {e}")
+        _scripts_state["ready"] = False
+    try:
+        _scripts_state["baseline"] = _sum_script_stats(await es.nodes.stats(metric="script"))
+    except Exception as e:
+        print(f"[Error] 讀取 script 統計失敗，script_cache_stats 不提供 *_since_start: {e}")
+    return _scripts_state["ready"]
+
+
+async def _scripts_ready(es):
+    if not STORED_SCRIPTS_ENABLED:
+        return False
+    if _scripts_state["ready"] is None:
+        await register_stored_scripts(es)
+    return _scripts_state["ready"]
+
+
+async def script_cache_stats(es):
+    return _with_baseline(_sum_script_stats(await es.nodes.stats(metric="script")))
+
+
+async def register_search_templates(es, force=False):
+    try:
+        await _register_stored(es, SEARCH_TEMPLATES, "mustache", force)
+        _templates_state["ready"] = True
+    except Exception as e:
+        print(f"[Error] 註冊 search template 失敗，改用一般 query: {e}")
+        _templates_state["ready"] = False
+    return _templates_state["ready"]
+
+
+async def _templates_ready(es):
+    if not SEARCH_TEMPLATES_ENABLED:
+        return False
+    if STORED_SCRIPTS_ENABLED and not await _scripts_ready(es):
+        return False
+    if _templates_state["ready"] is None:
+        await register_search_templates(es)
+    return _templates_state["ready"]
+
+
+async def _search_template(es, index, template):
+    response = await es.search_template(index=index, id=template["id"], params=template["params"])
+    return response['hits']['hits']
+
+
+##### 向量搜尋結果快取（與同步版共用快取與 generation 記錄）
+async def index_generation(es, index):
+    fresh, generation = _recent_generation(index)
+    if fresh:
+        return generation
+    try:
+        response = await es.search(index=index, body=_generation_probe_body(index))
+    except Exception as e:
+        return _record_generation(index, error=e)
+    return _record_generation(index, response)
+
+
+async def _result_cache_key(es, index, request, input_embedding):
+    if not RESULT_CACHE_ENABLED:
+        return None
+    return _result_key(index, await index_generation(es, index), request, input_embedding)
+
+
+##### Vector Search
+async def _search_vector(es, index, embedding_column_name, method, exact_query, knn_query, templates=None):
+    """method="knn" 時先用 kNN，失敗時改用 script_score 精確搜尋；結果依查詢條件與查詢向量快取"""
+    with span("es.search", index=index, method=method) as s:
+        key = await _result_cache_key(es, index, (method, exact_query, knn_query), knn_query["knn"]["query_vector"])
+        hits = _cached_result(key)
+        s.set_attribute("cache_hit", hits is not None)
+        if hits is None:
+            hits = await _run_vector_search(es, index, embedding_column_name, method, exact_query, knn_query, templates)
+            _store_result(key, hits)
+        s.set_attribute("hits", len(hits))
+        return hits
+
+
+async def _run_vector_search(es, index, embedding_column_name, method, exact_query, knn_query, templates=None):
+    use_templates = templates is not None and await _templates_ready(es)
+    if _use_knn(method, index, embedding_column_name):
+        try:
+            return await (_search_template(es, index, templates[1]) if use_templates else _search(es, index, knn_query))
+        except BadRequestError as e:
+            error = _api_error(e)
+            if not _is_unsupported_error(error):
+                raise
+            _mark_knn_unsupported(index, embedding_column_name, error)
+    _require_script_score_layout(index, embedding_column_name)
+    return await (_search_template(es, index, templates[0]) if use_templates else _search(es, index, exact_query))
+
+
+async def es_vector_search(es, index, embedding_column_name, input_embedding, recall_size=10, includes=None, excludes=None,
+                           method="script_score", num_candidates=None):
+    input_embedding = await _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _vector_search_bodies(embedding_column_name, input_embedding, recall_size, includes, excludes, num_candidates)
+    templates = _vector_templates(embedding_column_name, input_embedding, recall_size, includes, excludes, num_candidates)
+    return await _search_vector(es, index, embedding_column_name, method, query, knn_query, templates)
+
+
+async def es_smart_vector_search(es, index, embedding_column_name, input_embedding, pid_column_name=None, start_date=None, end_date=None,
+                                 recall_size=10, includes=None, excludes=None, method="script_score", num_candidates=None):
+    """日期參數的處理與 es_SearchLib.es_smart_vector_search 相同"""
+    if not pid_column_name or (start_date is None and end_date is None):
+        return await es_vector_search(es, index, embedding_column_name, input_embedding, recall_size, includes, excludes, method, num_candidates)
+    start_date = start_date if start_date is not None else end_date
+    end_date = end_date if end_date is not None else start_date
+    return await es_vector_search_with_date_range(es, index, embedding_column_name, input_embedding, pid_column_name, start_date, end_date,
+                                                  recall_size, includes, excludes, method, num_candidates)
+
+
+async def es_vector_search_with_date_range(es, index, embedding_column_name, input_embedding, pid_column_name, start_date, end_date,
+                                           recall_size=10, includes=None, excludes=None, method="script_score", num_candidates=None):
+    input_embedding = await _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _date_range_vector_bodies(embedding_column_name, input_embedding, pid_column_name, start_date, end_date,
+                                                 recall_size, includes, excludes, num_candidates)
+    templates = _vector_templates(embedding_column_name, input_embedding, recall_size, includes, excludes, num_candidates,
+                                  [pid_range_clause(pid_column_name, start_date, end_date)])
+    return await _search_vector(es, index, embedding_column_name, method, query, knn_query, templates)
+
+
+async def es_vector_search_with_queryString(es, index, embedding_column_name, input_embedding, query_column_name, filter_query,
+                                            recall_size=10, includes=None, excludes=None, method="script_score", num_candidates=None):
+    input_embedding = await _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _queryString_vector_bodies(embedding_column_name, input_embedding, query_column_name, filter_query,
+                                                  recall_size, includes, excludes, num_candidates)
+    return await _search_vector(es, index, embedding_column_name, method, query, knn_query)
+
+
+async def es_advanced_vector_search(
+    es,
+    index: str,
+    embedding_column_name: str,
+    input_embedding,
+    filters: List[Dict[str, Any]],
+    recall_size: int = 10,
+    includes: Optional[List[str]] = None,
+    excludes: Optional[List[str]] = None,
+    method: str = "script_score",
+    num_candidates: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    input_embedding = await _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _advanced_vector_bodies(embedding_column_name, input_embedding, filters, recall_size, includes, excludes, num_candidates)
+    return await _search_vector(es, index, embedding_column_name, method, query, knn_query)
+
+
+async def es_keyword_weighted_search(
+    es,
+    index: str,
+    embedding_column_name: str,
+    input_embedding: List[float],
+    keyword_fields: Optional[List[Dict[str, Any]]] = None,
+    filters: Optional[List[Dict[str, Any]]] = None,
+    recall_size: int = 10,
+    includes: Optional[List[str]] = None,
+    excludes: Optional[List[str]] = None,
+    method: str = "script_score",
+    num_candidates: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    input_embedding = await _prepare_vector_search(es, index, embedding_column_name, input_embedding)
+    query, knn_query = _keyword_weighted_bodies(embedding_column_name, input_embedding, keyword_fields, filters, recall_size,
+                                                includes, excludes, num_candidates)
+    try:
+        return await _search_vector(es, index, embedding_column_name, method, query, knn_query)
+    except Exception as e:
+        return []
+
+
+##### _msearch
+async def _msearch(es, searches, probes=()):
+    with span("es.msearch", indices=[search["index"] for search in searches], probes=len(probes)) as s:
+        if _templates_applicable(searches) and await _templates_ready(es):
+            s.set_attribute("template", True)
+            response = await es.msearch_template(search_templates=_msearch_template_body(searches) + _probe_lines(probes, template=True))
+        else:
+            response = await es.msearch(searches=_msearch_body(searches) + _probe_lines(probes))
+        results = _msearch_results(response, probes)
+        s.set_attributes(**_msearch_attributes(results))
+        return results
+
+
+async def es_multi_search(es, searches):
+    return _hits_or_empty(searches, await _msearch(es, searches))
+
+
+@traced("es.multi_vector_search")
+async def es_multi_vector_search(es, searches):
+    searches = [await _fit_search(es, search) for search in searches]
+    requests = [_multi_vector_request(search) for search in searches]
+    stale = _stale_indices(searches)
+
+    async def key_of(search, request):
+        return await _result_cache_key(es, search["index"], request, search["input_embedding"])
+
+    keys = [None if search["index"] in stale else await key_of(search, request) for search, request in zip(searches, requests)]
+    results = _cached_results(keys)
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    set_attributes(indices=[search["index"] for search in searches], cache_hits=len(searches) - len(pending))
+    if pending:
+        fetched = await _multi_vector_fetch(es, [searches[i] for i in pending], [requests[i] for i in pending], stale)
+        keys = [await key_of(search, request) if search["index"] in stale else key for search, request, key in zip(searches, requests, keys)]
+        _store_results(keys, pending, fetched, results)
+    return _hits_or_empty(searches, results)
+
+
+async def _multi_vector_fetch(es, searches, requests, probes=()):
+    results = await _msearch(es, requests, probes)
+
+    retry = _knn_retry(searches, requests, results)
+    if retry:
+        retried = await _msearch(es, [_multi_vector_request(searches[i]) for i in retry])
+        for i, result in zip(retry, retried):
+            results[i] = result
+    return results
+
+
+##### Hybrid Search
+@traced("es.multi_hybrid_search")
+async def es_multi_hybrid_search(es, searches, server_side=True):
+    searches = [await _fit_search(es, search) for search in searches]
+    stale = _stale_indices(searches)
+
+    async def key_of(search):
+        return await _result_cache_key(es, search["index"], {**search, "server_side": server_side}, search["input_embedding"])
+
+    keys = [None if search["index"] in stale else await key_of(search) for search in searches]
+    results = _cached_results(keys)
+    pending = [i for i, result in enumerate(results) if result is None]
+    set_attributes(indices=[search["index"] for search in searches], cache_hits=len(searches) - len(pending))
+    if pending:
+        fetched, failed = await _multi_hybrid_fetch(es, [searches[i] for i in pending], server_side, stale)
+        keys = [await key_of(search) if search["index"] in stale else key for search, key in zip(searches, keys)]
+        _store_results(keys, pending, [(hits, None) for hits in fetched], results, {pending[n] for n in failed})
+    return [hits for hits, _ in results]
+
+
+async def _multi_hybrid_fetch(es, searches, server_side, probes=()):
+    results = [None] * len(searches)
+
+    server_idx = _server_rrf_positions(searches, server_side)
+    if server_idx:
+        _merge_server_rrf(searches, server_idx, await _msearch(es, [_hybrid_requests(searches[i])[0] for i in server_idx], probes), results)
+        probes = ()
+
+    failed = set()
+    client_idx = [i for i in range(len(searches)) if results[i] is None]
+    if client_idx:
+        legs = [_hybrid_requests(searches[i])[1] for i in client_idx]
+        flat = await _msearch(es, [request for pair in legs for request in pair], probes)
+        retry = _vector_leg_retry(searches, client_idx, legs, flat)
+        if retry:
+            retried = await _msearch(es, [_hybrid_requests(searches[client_idx[n]])[1][1] for n in retry])
+            for n, result in zip(retry, retried):
+                flat[2 * n + 1] = result
+        failed = _merge_client_rrf(searches, client_idx, flat, results)
+    return results, failed
+
+
+async def es_hybrid_search(es, index, embedding_column_name, input_embedding, query_text, text_fields, filters=None,
+                           recall_size=10, rank_window_size=RRF_RANK_WINDOW_SIZE, rank_constant=RRF_RANK_CONSTANT,
+                           includes=None, excludes=None, num_candidates=None, server_side=True):
+    return (await es_multi_hybrid_search(es, [{
+        "index": index,
+        "embedding_column_name": embedding_column_name,
+        "input_embedding": input_embedding,
+        "query_text": query_text,
+        "text_fields": text_fields,
+        "filters": filters,
+        "recall_size": recall_size,
+        "rank_window_size": rank_window_size,
+        "rank_constant": rank_constant,
+        "includes": includes,
+        "excludes": excludes,
+        "num_candidates": num_candidates,
+    }], server_side=server_side))[0]
@@ -0,0 +1,149 @@
+"""
+ES 日期 / PID 範圍匯出成 Parquet
+
+以 point-in-time + search_after 逐頁讀取（es_SearchLib._scan_pit），每一頁轉成一個 Arrow RecordBatch 寫入 Parquet，
+記憶體中同時只有一頁；embedding 存成 fixed_size_list<float32>，讀回時可以直接 reshape 成矩陣。
+缺少向量或維度不符的列寫入全 0 向量，另以 <embedding>_valid 欄位標記（fixed_size_list 有 null 時 Parquet 無法正確讀回）。
+
+python -m es_export cna 20250101 20250131 cna_202501.parquet            # CNA 以 PID 前綴篩選日期
+python -m es_export cna 202501010001 202501019999 cna.parquet           # 12 碼時直接當作 PID 起訖
+python -m es_export tfc 2025-01-01 2025-01-31 tfc_202501.parquet        # TFC 以 date 欄位篩選
+python -m es_export cna 20250101 20250131 cna.parquet --no-embeddings
+"""
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from es_SearchLib import _scan_pit, _date_range_body, pid_range_clause, get_vector_layout
+from vector_mirror import CNA_MIRROR_INDEX, TFC_MIRROR_INDEX, CNA_MIRROR_FIELDS, TFC_MIRROR_FIELDS
+
+EXPORT_PAGE_SIZE = 1000
+
+# index: 欄位、篩選方式（"pid" 以 PID 前綴 / 其他為日期欄位名稱）
+EXPORT_PRESETS = {
+    "cna": {"index": CNA_MIRROR_INDEX, "fields": CNA_MIRROR_FIELDS, "range_by": "pid"},
+    "tfc": {"index": TFC_MIRROR_INDEX, "fields": TFC_MIRROR_FIELDS, "range_by": "date"},
+}
+
+
+def export_schema(fields, embedding_column_name=None, dims=None):
+    """
+    _id 與一般欄位都存成 string（list / dict 轉成 JSON），embedding 為 fixed_size_list<float32>[dims]，
+    另加 bool 欄位 <embedding>_valid 標記該列是否有向量
+    """
+    columns = [pa.field("_id", pa.string(), nullable=False)] + [pa.field(field, pa.string()) for field in fields]
+    if embedding_column_name:
+        columns.append(pa.field(embedding_column_name, pa.list_(pa.float32(), dims), nullable=False))
+        columns.append(pa.field(_valid_column(embedding_column_name), pa.bool_(), nullable=False))
+    return pa.schema(columns)
+
+
+def _valid_column(embedding_column_name):
+    return f"{embedding_column_name}_valid"
+
+
+def pid_bounds_clause(pid_column_name, start, end):
+    """8 碼（YYYYMMDD）的起訖轉成該日期的 PID 範圍，12 碼的完整 PID 原樣使用（前後皆含）"""
+    date_bounds = pid_range_clause(pid_column_name, start, end)["range"][pid_column_name]
+    return {"range": {pid_column_name: {
+        "gte": date_bounds["gte"] if len(str(start)) == 8 else str(start),
+        "lte": date_bounds["lte"] if len(str(end)) == 8 else str(end),
+    }}}
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def hits_to_record_batch(hits, schema, embedding_column_name=None):
+    """把一頁 hits 轉成 RecordBatch；向量維度不符或缺少向量的列寫入全 0 向量，<embedding>_valid 為 False"""
+    arrays = [pa.array([hit["_id"] for hit in hits], pa.string())]
+    for field in schema.names[1:]:
+        if embedding_column_name and field in (embedding_column_name, _valid_column(embedding_column_name)):
+            continue
+        arrays.append(pa.array([_to_string(hit["_source"].get(field)) for hit in hits], pa.string()))
+
+    if embedding_column_name:
+        dims = schema.field(embedding_column_name).type.list_size
+        matrix = np.zeros((len(hits), dims), dtype=np.float32)
+        valid = np.zeros(len(hits), dtype=bool)
+        for i, hit in enumerate(hits):
+            vector = hit["_source"].get(embedding_column_name)
+            if vector and len(vector) == dims:
+                matrix[i] = vector
+                valid[i] = True
+        arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), dims))
+        arrays.append(pa.array(valid))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_range(es, index, path, start, end, fields, range_by="pid", embedding_column_name="embeddings", dims=None,
+                 page_size=EXPORT_PAGE_SIZE, compression="zstd"):
+    """
+    :param start, end: range_by="pid" 時為日期 YYYYMMDD（轉成 PID 範圍）或 12 碼的完整 PID，
+                       否則為 range_by 欄位的起訖值（前後皆含）
+    :param embedding_column_name: None 代表不匯出向量
+    :param dims: 向量維度，默認讀取索引 mapping
+    :return: {"rows", "bytes", "seconds"}
+    """
+    start_time = time.time()
+    if range_by == "pid":
+        query = {"bool": {"filter": [pid_bounds_clause("pid", start, end)]}}
+    else:
+        query = _date_range_body(range_by, start, end)["query"]
+    if embedding_column_name and not dims:
+        layout = get_vector_layout(es, index, embedding_column_name)
+        dims = layout["dims"] if layout else 3072
+
+    schema = export_schema(fields, embedding_column_name, dims)
+    source = {"includes": fields + ([embedding_column_name] if embedding_column_name else [])}
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for hits in _scan_pit(es, index, query, page_size, None, source):
+            writer.write_batch(hits_to_record_batch(hits, schema, embedding_column_name))
+            rows += len(hits)
+    stats = {"rows": rows, "bytes": os.path.getsize(path), "seconds": round(time.time() - start_time, 2)}
+    print(f"[Info] {index} {start} ~ {end} 匯出 {rows} 筆至 {path}，耗時 {stats['seconds']} 秒")
+    return stats
+
+
+def read_embedding_matrix(path, embedding_column_name="embeddings"):
+    """
+    讀回 (ids, matrix)；fixed_size_list 的值本身就是連續的 float32，不必逐筆轉換
+    缺少向量（<embedding>_valid 為 False）的列會被略過
+    """
+    table = pq.read_table(path, columns=["_id", embedding_column_name, _valid_column(embedding_column_name)])
+    column = table.column(embedding_column_name).combine_chunks()
+    valid = table.column(_valid_column(embedding_column_name)).to_numpy()
+    dims = column.type.list_size
+    matrix = column.values.to_numpy().reshape(-1, dims)[valid]
+    ids = np.asarray(table.column("_id").to_pylist(), dtype=object)[valid]
+    return ids.tolist(), matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ES 日期 / PID 範圍匯出成 Parquet")
+    parser.add_argument("preset", choices=sorted(EXPORT_PRESETS))
+    parser.add_argument("start", help="cna：日期 YYYYMMDD 或 12 碼 PID；tfc：date 欄位的起始值")
+    parser.add_argument("end", help="cna：日期 YYYYMMDD 或 12 碼 PID；tfc：date 欄位的結束值（前後皆含）")
+    parser.add_argument("path")
+    parser.add_argument("--index", default=None, help="覆寫預設索引")
+    parser.add_argument("--no-embeddings", action="store_true")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    parser.add_argument("--compression", default="zstd")
+    args = parser.parse_args()
+
+    from es_SearchLib import es
+    preset = EXPORT_PRESETS[args.preset]
+    export_range(es, args.index or preset["index"], args.path, args.start, args.end, preset["fields"], preset["range_by"],
+                 embedding_column_name=None if args.no_embeddings else "embeddings",
+                 page_size=args.page_size, compression=args.compression)
@@ -0,0 +1,213 @@
+"""
+已完成查核的快取
+
+同一則傳言常以些微不同的措辭反覆出現，每次都要重跑查核點、搜尋、相關性判斷、生成與評估。
+完成的查核（查核點、參考資料、最終報告）連同傳言的 embedding 存進 SQLite，新的傳言進來時：
+1. 先比對正規化文字的 hash，完全相同的傳言直接沿用
+2. 再以 embedding 的 cosine 相似度找最相近的已查核傳言，相似度超過門檻且在時效內才沿用
+
+近期的 embedding 載入成記憶體中的單位向量矩陣，一次矩陣乘法就能比完所有已查核的傳言。
+
+python -m factcheck_cache list
+python -m factcheck_cache lookup "要查核的文本"
+python -m factcheck_cache delete 12
+"""
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+
+import numpy as np
+from dotenv import load_dotenv
+
+from cache import normalize_text, make_key, pack_floats, unpack_floats
+
+load_dotenv()
+
+FACTCHECK_CACHE_ENABLED = os.getenv("factcheck_cache", "true").lower() == "true"
+FACTCHECK_CACHE_PATH = os.getenv("factcheck_cache_path", ".cache/factchecks.sqlite")
+# text-embedding-3-large 下，只差標點、語助詞的改寫通常在 0.95 以上，換了人名或數字的傳言多半低於 0.9
+FACTCHECK_SIMILARITY_THRESHOLD = float(os.getenv("factcheck_similarity_threshold", "0.95"))
+FACTCHECK_MAX_AGE_HOURS = float(os.getenv("factcheck_max_age_hours", "72"))
+
+
+def claim_key(claim, media_name=None):
+    return make_key(media_name or "", normalize_text(claim))
+
+
+class FactCheckCache:
+    """
+    :param path: SQLite 檔案路徑
+    :param threshold: 語意比對的 cosine 相似度門檻
+    :param max_age_hours: 超過幾小時的查核不再沿用（傳言的事實可能已經改變）
+    """
+
+    def __init__(self, path=FACTCHECK_CACHE_PATH, threshold=FACTCHECK_SIMILARITY_THRESHOLD, max_age_hours=FACTCHECK_MAX_AGE_HOURS):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.threshold = threshold
+        self.max_age = max_age_hours * 3600
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fact_checks ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " claim_key TEXT NOT NULL,"
+            " claim TEXT NOT NULL,"
+            " media_name TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fact_checks_key ON fact_checks(claim_key, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fact_checks_created ON fact_checks(created_at)")
+        self._conn.commit()
+        self._reload()
+
+    ### 載入時效內的 embedding
+    def _reload(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, media_name, embedding, created_at FROM fact_checks WHERE created_at >= ? ORDER BY id",
+                (self._cutoff(),)).fetchall()
+            self._ids = np.array([row[0] for row in rows], dtype=np.int64)
+            self._media = np.array([row[1] for row in rows], dtype=object)
+            self._created = np.array([row[3] for row in rows], dtype=np.float64)
+            self._matrix = self._normalize([unpack_floats(row[2]) for row in rows]) if rows else None
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def _cutoff(self):
+        return time.time() - self.max_age
+
+    def __len__(self):
+        return len(self._ids)
+
+    ### 查詢
+    def lookup(self, claim, embed=None, media_name=None):
+        """
+        :param embed: 取得 claim embedding 的函式；完全相同的傳言命中時不會呼叫
+        :return: 命中時回傳 entry（含 "match": "exact"/"semantic" 與 "similarity"），否則 None
+        """
+        entry = self.exact(claim, media_name)
+        if entry is None and embed is not None:
+            entry = self.nearest(embed(claim), media_name)
+        with self._lock:
+            self.stats[f"{entry['match']}_hits" if entry else "misses"] += 1
+        return entry
+
+    def exact(self, claim, media_name=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM fact_checks WHERE claim_key = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1",
+                (claim_key(claim, media_name), self._cutoff())).fetchone()
+        return self.get(row[0], match="exact", similarity=1.0) if row else None
+
+    def nearest(self, embedding, media_name=None):
+        """回傳相似度最高且超過門檻的 entry"""
+        with self._lock:
+            ids, media, created, matrix = self._ids, self._media, self._created, self._matrix
+        if matrix is None:
+            return None
+        scores = matrix @ self._normalize(embedding)[0]
+        scores[(media != (media_name or "")) | (created < self._cutoff())] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return self.get(int(ids[best]), match="semantic", similarity=round(float(scores[best]), 4))
+
+    def get(self, entry_id, **extra):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, claim, media_name, payload, created_at FROM fact_checks WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        entry_id, claim, media_name, payload, created_at = row
+        return {"id": entry_id, "claim": claim, "media_name": media_name or None, "created_at": created_at,
+                **json.loads(payload), **extra}
+
+    ### 寫入
+    def store(self, claim, embedding, check_points, resources, final_report, media_name=None):
+        """記錄一次完成的查核，回傳 entry id"""
+        payload = json.dumps({"check_points": check_points, "resources": resources, "final_report": final_report},
+                             ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO fact_checks (claim_key, claim, media_name, embedding, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (claim_key(claim, media_name), claim, media_name or "", pack_floats(embedding), payload, now))
+            self._conn.commit()
+            self._ids = np.append(self._ids, cursor.lastrowid)
+            self._media = np.append(self._media, np.array([media_name or ""], dtype=object))
+            self._created = np.append(self._created, now)
+            vector = self._normalize(embedding)
+            self._matrix = vector if self._matrix is None else np.vstack([self._matrix, vector])
+            return cursor.lastrowid
+
+    def delete(self, entry_id):
+        """移除一筆查核（例如查核結果有誤），之後不會再被沿用"""
+        with self._lock:
+            self._conn.execute("DELETE FROM fact_checks WHERE id = ?", (entry_id,))
+            self._conn.commit()
+            self._reload()
+
+    def prune(self):
+        """刪除超過時效的查核，回傳刪除筆數"""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM fact_checks WHERE created_at < ?", (self._cutoff(),))
+            self._conn.commit()
+            self._reload()
+            return cursor.rowcount
+
+    def recent(self, limit=20):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, claim, media_name, created_at FROM fact_checks ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [
+            {"id": entry_id, "claim": claim, "media_name": media_name or None, "created_at": created_at}
+            for entry_id, claim, media_name, created_at in rows
+        ]
+
+
+_factcheck_cache = None
+_factcheck_cache_lock = threading.Lock()
+
+
+def get_factcheck_cache():
+    global _factcheck_cache
+    with _factcheck_cache_lock:
+        if _factcheck_cache is None:
+            _factcheck_cache = FactCheckCache()
+        return _factcheck_cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="已完成查核的快取")
+    parser.add_argument("command", choices=["list", "lookup", "delete", "prune"])
+    parser.add_argument("text", nargs="?")
+    parser.add_argument("--media-name", default="Chiming")
+    args = parser.parse_args()
+
+    cache = get_factcheck_cache()
+    if args.command == "list":
+        for item in cache.recent():
+            print(f"{item['id']:>6}  {datetime.fromtimestamp(item['created_at']):%Y-%m-%d %H:%M}  {item['claim'][:60]}")
+    elif args.command == "lookup":
+        from functions import text_embeddings_3
+        entry = cache.lookup(args.text, text_embeddings_3, args.media_name)
+        if entry is None:
+            print("[Info] 沒有可沿用的查核")
+        else:
+            print(f"[Info] {entry['match']} 命中 #{entry['id']}（相似度 {entry['similarity']}）：{entry['claim']}")
+            print(entry["final_report"])
+    elif args.command == "delete":
+        cache.delete(int(args.text))
+    else:
+        print(f"[Info] 刪除 {cache.prune()} 筆過期查核")
@@ -1,103 +1,519 @@
 import time
 import re
-import requests
-from requests import post
-from openai import OpenAI
-from es_SearchLib import es_vector_search, es
+import asyncio
+from es_SearchLib import es_multi_vector_search, es_multi_hybrid_search, es, es_with_timeout, script_cache_stats, register_generation_field, result_cache_stats
+import es_SearchLib_async
 import os
-from openai import OpenAI
 from pydantic import BaseModel
+from typing import List
 from dotenv import load_dotenv
 from datetime import timedelta, datetime
 from dateutil.relativedelta import relativedelta
+from cache import TieredCache, normalize_text, make_key, pack_floats, unpack_floats
+from batcher import MicroBatcher
+from clients import get_openai_client, get_async_openai_client
+from openai import APITimeoutError
+from vector_mirror import get_mirror, mirror_available, CNA_MIRROR_INDEX, TFC_MIRROR_INDEX
+from quantization import truncate_embedding
+from deadline import Deadline, stage_timeout, DEADLINE_MIN_STAGE
+from tracing import span, traced, set_attributes
+from usage_ledger import record_usage, get_usage_ledger, fact_check_scope, new_fact_check_id
+from check_points import get_check_points
 
 load_dotenv()
 
+EMBEDDING_MODEL = "text-embedding-3-large"
+
+### Embedding 快取：key 為 (正規化文字, 模型) 的 hash，記憶體 LRU + SQLite 磁碟
+embedding_cache = TieredCache(
+    dumps=pack_floats,
+    loads=unpack_floats,
+    path=os.getenv("embedding_cache_path", ".cache/embeddings.sqlite") or None,
+    max_items=int(os.getenv("embedding_cache_items", "2048")),
+    max_bytes=int(os.getenv("embedding_cache_mb", "512")) * 1024 * 1024,
+)
+
+def embedding_cache_key(text, model=EMBEDDING_MODEL, dimensions=None):
+    if dimensions:
+        return make_key(model, dimensions, normalize_text(text))
+    return make_key(model, normalize_text(text))
+
+def _cached_embedding(text, model, dimensions):
+    """先查指定維度的快取；沒有時若有完整維度的向量，截斷並正規化即可（text-embedding-3 為 Matryoshka 向量）"""
+    cached = embedding_cache.get(embedding_cache_key(text, model, dimensions))
+    if cached is None and dimensions:
+        full = embedding_cache.get(embedding_cache_key(text, model))
+        if full is not None and len(full) > dimensions:
+            cached = truncate_embedding(full, dimensions)
+    return cached
+
+def _record_embedding_usage(response, model, started_at):
+    set_attributes(input_tokens=response.usage.prompt_tokens)
+    record_usage("embedding", model, response.usage.prompt_tokens, latency=time.monotonic() - started_at)
+
+def _create_embeddings(client, model, inputs, dimensions):
+    if dimensions:
+        return client.embeddings.create(model=model, input=inputs, dimensions=dimensions)
+    return client.embeddings.create(model=model, input=inputs)
+
 ### OpenAI Embedding
-def text_embeddings_3(text):
-    #搭配aisuite openai升級，修改寫法
-    # client = openai.OpenAI()
-    client = OpenAI()
-    t = client.embeddings.create(model="text-embedding-3-large", input=text)
-    return t.data[0].embedding
-
-### 查核點api
-def get_check_points(text, media_name=None):
-    print(f"[Info] 查核點評估...")
-    input = {
-        "text": text,
-        "media_name": media_name
-    }
-    url = "https://get-check-points-1007110536706.asia-east1.run.app"
-    
-    start_time = time.time()
-    response = requests.post(url, json=input, timeout=3600)
-
-    if response.status_code == 200:
-        response_json = response.json()
-        check_points = []
-        if response_json.get("Result") == "Y" and "ResultData" in response_json:
-            check_points = response_json["ResultData"].get("check_points", [])
-
-            if check_points:
-                print(f"[Info] 成功取得查核點")
-                print(f">>>{check_points}")
-                end_time = time.time()
-                print(f"[Info] 查核點API耗時: {end_time - start_time:.2f} 秒")
-                return {
-                    "Result": "Y",
-                    "ResultData": {"check_points": check_points},
-                    "Message": "API成功回傳結果"
-                }
-            else:
-                print(f"[Info] 查核點為空")
-                end_time = time.time()
-                print(f"[Info] 查核點API耗時: {end_time - start_time:.2f} 秒")
-                return {
-                    "Result": "N",
-                    "ResultData": {"check_points": None},
-                    "Message": "查核點為空"
-                }
-    else:
-        print(f"[Error] 取得查核點時發生錯誤：{response.status_code}")
-        end_time = time.time()
-        print(f"[Info] 查核點API耗時: {end_time - start_time:.2f} 秒")
-        return {
-            "Result": "N",
-            "ResultData": {"check_points": None},
-            "Message": "API回傳None"
-        }
+@traced("embedding")
+def text_embeddings_3(text, model=EMBEDDING_MODEL, dimensions=None):
+    """
+    :param dimensions: 輸出維度（例如 1024），None 為模型完整維度（text-embedding-3-large 為 3072）
+    """
+    cached = _cached_embedding(text, model, dimensions)
+    set_attributes(model=model, dimensions=dimensions, cache_hit=cached is not None)
+    if cached is not None:
+        return cached
+
+    client = get_openai_client()
+    started_at = time.monotonic()
+    t = _create_embeddings(client, model, text, dimensions)
+    _record_embedding_usage(t, model, started_at)
+    embedding = t.data[0].embedding
+    embedding_cache.set(embedding_cache_key(text, model, dimensions), embedding)
+    return embedding
+
+### OpenAI Embedding (批次)
+EMBEDDING_BATCH_SIZE = 256  # 單次 request 最多送幾筆，避免超過 API 的 input 上限
+
+@traced("embedding_batch")
+def text_embeddings_3_batch(texts, model=EMBEDDING_MODEL, dimensions=None):
+    """
+    一次 embedding 多筆文字，回傳與 texts 同順序的 embedding list
+    已在快取中的直接取用，重複的文字只送一次
+    """
+    embeddings, _, requests = _embed_texts(texts, model, dimensions)
+    for tokens, latency in requests:
+        record_usage("embedding", model, tokens, latency=latency)
+    return embeddings
+
+def _split_tokens(total, weights):
+    """把 total 依 weights 的比例分成整數，總和不變（最大餘數法）；weights 全為 0 時平分"""
+    if not any(weights):
+        weights = [1] * len(weights)
+    exact = [total * weight / sum(weights) for weight in weights]
+    parts = [int(value) for value in exact]
+    for i in sorted(range(len(exact)), key=lambda i: exact[i] - parts[i], reverse=True)[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+def _embed_texts(texts, model=EMBEDDING_MODEL, dimensions=None):
+    """
+    回傳 (embeddings, shares, requests)，不記錄用量
+    shares[i] 為位置 i 分攤到的 (token 數, 延遲秒數)，快取命中為 (0, 0.0)：一次 request 的 token 依各輸入的字數分攤，
+    同一段文字出現在多個位置時再平分；requests 為每次 API request 的 (token 數, 延遲秒數)
+    """
+    embeddings = [None] * len(texts)
+    shares = [(0, 0.0)] * len(texts)
+    requests = []
+    pending = {}  # cache key -> (送出的文字, 對應的位置)
+    for i, text in enumerate(texts):
+        cached = _cached_embedding(text, model, dimensions)
+        if cached is not None:
+            embeddings[i] = cached
+        else:
+            pending.setdefault(embedding_cache_key(text, model, dimensions), (text, []))[1].append(i)
+    set_attributes(model=model, inputs=len(texts), misses=len(pending))
+
+    if pending:
+        client = get_openai_client()
+        keys = list(pending)
+        for start in range(0, len(keys), EMBEDDING_BATCH_SIZE):
+            chunk = keys[start:start + EMBEDDING_BATCH_SIZE]
+            with span("embedding.request", inputs=len(chunk)) as s:
+                started_at = time.monotonic()
+                t = _create_embeddings(client, model, [pending[key][0] for key in chunk], dimensions)
+                latency = time.monotonic() - started_at
+                s.set_attribute("input_tokens", t.usage.prompt_tokens)
+            requests.append((t.usage.prompt_tokens, latency))
+            positions = [i for key in chunk for i in pending[key][1]]
+            weights = [len(pending[key][0]) / len(pending[key][1]) for key in chunk for _ in pending[key][1]]
+            for i, tokens in zip(positions, _split_tokens(t.usage.prompt_tokens, weights)):
+                shares[i] = (tokens, latency)
+            for item in t.data:
+                key = chunk[item.index]
+                embedding_cache.set(key, item.embedding)
+                for i in pending[key][1]:
+                    embeddings[i] = item.embedding
 
+    return embeddings, shares, requests
+
+def _embedding_batch_with_usage(texts):
+    """micro-batcher 的批次函數：回傳 [(embedding, token 數, 延遲), ...]，用量由各呼叫端在自己的 context 記錄"""
+    embeddings, shares, _ = _embed_texts(texts)
+    return [(embedding, tokens, latency) for embedding, (tokens, latency) in zip(embeddings, shares)]
+
+### 跨 session 的 micro-batcher：幾毫秒內收到的 embedding 請求合併成一次 API 呼叫
+embedding_batcher = MicroBatcher(
+    _embedding_batch_with_usage,
+    max_wait_ms=float(os.getenv("embedding_batch_wait_ms", "5")),
+    max_batch_size=EMBEDDING_BATCH_SIZE,
+    name="embedding-batcher",
+)
+
+@traced("embedding")
+async def text_embeddings_3_async(text):
+    """
+    經由 micro-batcher 取得單筆 embedding，多個 session 同時查核時合併成一次 API 呼叫，也不佔用事件循環的執行緒
+    合併後的 token 用量依字數分攤，記在各自的查核底下
+    """
+    embedding, tokens, latency = await embedding_batcher.submit_async(text)
+    set_attributes(model=EMBEDDING_MODEL, batched=True, cache_hit=tokens == 0)
+    if tokens:
+        set_attributes(input_tokens=tokens)
+        record_usage("embedding", EMBEDDING_MODEL, tokens, latency=latency)
+    return embedding
 
 ### Openai 判斷es結果跟text的相關性
-def es_relation(text, summary):
-    client = OpenAI()
+RELATION_MODEL = "gpt-4.1"
+RELATION_SYSTEM_PROMPT = "判斷參考資料與要做事時查核的文本的相關性。優先考慮事件、時間、人物、地點的相關性。回傳布林值：相關=true，不相關=false。"
+
+class Relation(BaseModel):
+    relation: bool
+
+def _relation_input(text, summary):
+    return [
+        {"role": "system", "content": RELATION_SYSTEM_PROMPT},
+        {"role": "user", "content": f"參考資料：{summary}\n要做事時查核的文本：{text}\n請回答兩者的相關性。"},
+    ]
+
+def _record_usage(response, stage, started_at):
+    """把 Responses API 的 token 用量記在目前的 span 與用量帳本"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    cached_tokens = getattr(usage.input_tokens_details, "cached_tokens", 0) or 0
+    set_attributes(input_tokens=usage.input_tokens, output_tokens=usage.output_tokens, cached_tokens=cached_tokens)
+    record_usage(stage, RELATION_MODEL, usage.input_tokens, usage.output_tokens, cached_tokens, time.monotonic() - started_at)
+
+def _with_timeout(client, timeout):
+    """
+    單次呼叫的 timeout（秒），None 時沿用 client 設定
+    timeout 來自 deadline 的剩餘時間，不再自動重試：client 默認重試 2 次，每次都等滿 timeout 會用掉約 3 倍的預算
+    """
+    return client if timeout is None else client.with_options(timeout=timeout, max_retries=0)
 
-    class Relation(BaseModel):
-        relation: bool
+def es_relation(text, summary, timeout=None):
+    client = _with_timeout(get_openai_client(), timeout)
 
+    started_at = time.monotonic()
     response = client.responses.parse(
-        model="gpt-4.1",
-        input=[
-            {"role": "system", "content": "判斷參考資料與要做事時查核的文本的相關性。優先考慮事件、時間、人物、地點的相關性。回傳布林值：相關=true，不相關=false。"},
-            {"role": "user", "content": f"參考資料：{summary}\n要做事時查核的文本：{text}\n請回答兩者的相關性。"},
-        ],
+        model=RELATION_MODEL,
+        input=_relation_input(text, summary),
         text_format=Relation,
     )
+    _record_usage(response, "relation", started_at)
 
     answer = response.output_parsed.relation
     return answer
 
+### 非同步版本，供 es_resources_async 併發使用
+async def es_relation_async(text, summary, timeout=None):
+    client = _with_timeout(get_async_openai_client(), timeout)
+
+    started_at = time.monotonic()
+    response = await client.responses.parse(
+        model=RELATION_MODEL,
+        input=_relation_input(text, summary),
+        text_format=Relation,
+    )
+    _record_usage(response, "relation", started_at)
+
+    return response.output_parsed.relation
+
+### 相關性判斷快取：key 為 (正規化 claim, index, 文件 ID, 摘要) 的 hash，同一份資料遇到相近傳言不用再問一次
+RELATION_CACHE_TTL = int(os.getenv("relation_cache_ttl", str(7 * 24 * 3600)))
+
+relation_cache = TieredCache(
+    dumps=lambda verdict: b"1" if verdict else b"0",
+    loads=lambda blob: blob == b"1",
+    path=os.getenv("relation_cache_path", ".cache/relations.sqlite") or None,
+    max_items=int(os.getenv("relation_cache_items", "20000")),
+    max_bytes=int(os.getenv("relation_cache_mb", "64")) * 1024 * 1024,
+)
+
+def relation_cache_key(text, index, doc_id, summary):
+    return make_key(make_key(normalize_text(text)), index, doc_id, make_key(summary))
+
+@traced("relation")
+def es_relation_cached(text, summary, cache_key, timeout=None):
+    verdict = relation_cache.get(cache_key)
+    set_attributes(cache_hit=verdict is not None)
+    if verdict is None:
+        verdict = es_relation(text, summary, timeout)
+        relation_cache.set(cache_key, verdict, RELATION_CACHE_TTL)
+    set_attributes(relevant=verdict)
+    return verdict
+
+@traced("relation")
+async def es_relation_cached_async(text, summary, cache_key, timeout=None):
+    verdict = relation_cache.get(cache_key)
+    set_attributes(cache_hit=verdict is not None)
+    if verdict is None:
+        verdict = await es_relation_async(text, summary, timeout)
+        relation_cache.set(cache_key, verdict, RELATION_CACHE_TTL)
+    set_attributes(relevant=verdict)
+    return verdict
+
+### 批次判斷：claim 只送一次，所有候選摘要帶固定 ID 一起判斷
+RELATION_BATCH_SYSTEM_PROMPT = "判斷每一筆參考資料與要做事時查核的文本的相關性。優先考慮事件、時間、人物、地點的相關性。每一筆參考資料都要回傳一個結果，id 必須與輸入相同：相關=true，不相關=false。"
+
+class RelationItem(BaseModel):
+    id: str
+    relation: bool
+
+class RelationBatch(BaseModel):
+    relations: List[RelationItem]
+
+def _relation_batch_input(text, candidates):
+    references = "\n".join(f"[{cid}] {summary}" for cid, summary in candidates)
+    return [
+        {"role": "system", "content": RELATION_BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": f"要做事時查核的文本：{text}\n參考資料：\n{references}\n請逐筆回答每一筆參考資料與文本的相關性。"},
+    ]
+
+def _relation_batch_result(response, candidates):
+    # 模型漏回的 ID 視為不相關
+    answers = {item.id: item.relation for item in response.output_parsed.relations}
+    set_attributes(candidates=len(candidates), relevant=sum(answers.get(cid, False) for cid, _ in candidates))
+    return {cid: answers.get(cid, False) for cid, _ in candidates}
+
+@traced("relation_batch")
+def es_relation_batch(text, candidates, timeout=None):
+    """
+    一次判斷多筆參考資料的相關性
+    :param candidates: [(id, summary), ...]
+    :return: {id: bool}
+    """
+    if not candidates:
+        return {}
+    client = _with_timeout(get_openai_client(), timeout)
+
+    started_at = time.monotonic()
+    response = client.responses.parse(
+        model=RELATION_MODEL,
+        input=_relation_batch_input(text, candidates),
+        text_format=RelationBatch,
+    )
+    _record_usage(response, "relation_batch", started_at)
+
+    return _relation_batch_result(response, candidates)
+
+@traced("relation_batch")
+async def es_relation_batch_async(text, candidates, timeout=None):
+    if not candidates:
+        return {}
+    client = _with_timeout(get_async_openai_client(), timeout)
+
+    started_at = time.monotonic()
+    response = await client.responses.parse(
+        model=RELATION_MODEL,
+        input=_relation_batch_input(text, candidates),
+        text_format=RelationBatch,
+    )
+    _record_usage(response, "relation_batch", started_at)
+
+    return _relation_batch_result(response, candidates)
+
+def _candidate_ids(candidates):
+    # 依資料來源與排序編號（CNA1、CNA2…、TFC1…），ID 短可省 token，也不會因為 url 重複或空白而撞號
+    counters = {}
+    ids = []
+    for data in candidates:
+        counters[data['data_type']] = counters.get(data['data_type'], 0) + 1
+        ids.append(f"{data['data_type']}{counters[data['data_type']]}")
+    return ids
+
+def _split_cached(candidates, keys):
+    """先查快取，回傳 (verdicts, 未命中的位置)，未命中的 verdict 為 None"""
+    verdicts = [relation_cache.get(key) for key in keys]
+    return verdicts, [i for i, verdict in enumerate(verdicts) if verdict is None]
+
+def _batch_pairs(candidates, misses):
+    ids = _candidate_ids(candidates)
+    return [(ids[i], candidates[i]['summary']) for i in misses]
+
+def _merge_batch(verdicts, keys, misses, pairs, answers):
+    for i, (cid, _) in zip(misses, pairs):
+        verdicts[i] = answers[cid]
+        relation_cache.set(keys[i], answers[cid], RELATION_CACHE_TTL)
+    return verdicts
+
+### es 搜尋結果轉成參考資料格式
+def _cna_resource(source):
+    return {
+        "data_type": "CNA",
+        "title": source.get('h1', ''),
+        "date": source.get('dt', '').replace('/', '-'),
+        "article": source.get('article', ''),
+        "summary": source.get('whatHappen200', ''),
+        "url": f"https://www.cna.com.tw/news/aall/{source.get('pid', '')}.aspx"
+    }
+
+def _tfc_resource(source):
+    return {
+        "data_type": "TFC",
+        "title": source.get('title', ''),
+        "date": source.get('date', '').replace('/', '-'),
+        "article": source.get('full_content', ''),
+        "summary": source.get('summary', ''),
+        "label": source.get('label', ''),
+        "url": source.get('link', ''),
+    }
+
+# 可指向 migrate_index.py 建出的降維 / 量化索引，查詢向量會依索引 mapping 自動截斷、量化
+CNA_INDEX = os.getenv("es_cna_index", "lab_mainsite_search")
+TFC_INDEX = os.getenv("es_tfc_index", "lab_tfc_search_test")
+CNA_RECALL_SIZE = int(os.getenv("es_cna_recall_size", "10"))
+TFC_RECALL_SIZE = int(os.getenv("es_tfc_recall_size", "5"))  ## 查核告有時候很舊, 只找5筆
+# 只取 _cna_resource / _tfc_resource 會用到的欄位
+CNA_SOURCE_FIELDS = ["h1", "dt", "article", "whatHappen200", "pid"]
+TFC_SOURCE_FIELDS = ["title", "date", "full_content", "summary", "label", "link"]
+# CNA 的 PID 依發稿時間遞增，搜尋結果快取以最新 PID 判斷是否有新稿
+register_generation_field(CNA_INDEX, os.getenv("es_cna_generation_field", "pid"))
+
+# "script_score" 精確搜尋 / "knn" HNSW 近似搜尋（索引不支援時自動改回 script_score）
+VECTOR_SEARCH_METHOD = os.getenv("es_vector_method", "script_score")
+# "vector" 純向量搜尋 / "hybrid" 關鍵字 + 向量以 RRF 合併，精確的人名、數字比較容易搜到
+RETRIEVAL_MODE = os.getenv("es_retrieval_mode", "vector")
+CNA_TEXT_FIELDS = ["h1^2", "whatHappen200", "article"]
+TFC_TEXT_FIELDS = ["title^2", "summary", "full_content"]
+
+# "es" 查 ES 叢集（失敗時若有本機鏡像則改查鏡像）/ "mirror" 只查本機鏡像（見 vector_mirror.py）
+SEARCH_BACKEND = os.getenv("es_search_backend", "es")
+
+def _search_resources(text_embedding, text=None, deadline=None):
+    """搜尋 CNA 與 TFC，回傳 (cna_res, tfc_res)"""
+    if SEARCH_BACKEND == "mirror":
+        return _search_mirror_resources(text_embedding)
+    try:
+        return _search_es_resources(text_embedding, text, deadline)
+    except Exception as e:
+        if not (mirror_available(CNA_MIRROR_INDEX) or mirror_available(TFC_MIRROR_INDEX)):
+            raise
+        print(f"[Error] ES 搜尋失敗，改用本機鏡像: {str(e)}")
+        return _search_mirror_resources(text_embedding)
+
+@traced("mirror_search")
+def _search_mirror_resources(text_embedding):
+    cna_res = get_mirror(CNA_MIRROR_INDEX).search(text_embedding, CNA_RECALL_SIZE) if mirror_available(CNA_MIRROR_INDEX) else []
+    tfc_res = get_mirror(TFC_MIRROR_INDEX).search(text_embedding, TFC_RECALL_SIZE) if mirror_available(TFC_MIRROR_INDEX) else []
+    return cna_res, tfc_res
+
+@traced("es_search")
+def _search_es_resources(text_embedding, text=None, deadline=None):
+    """CNA 與 TFC 的搜尋合併成一次 _msearch，回傳 (cna_res, tfc_res)；hybrid 模式需要傳入 text"""
+    client = es_with_timeout(es, stage_timeout(deadline, "search", floor=DEADLINE_MIN_STAGE))
+    if RETRIEVAL_MODE == "hybrid" and text:
+        cna_res, tfc_res = es_multi_hybrid_search(client, _hybrid_resource_searches(text_embedding, text))
+    else:
+        cna_res, tfc_res = es_multi_vector_search(client, _vector_resource_searches(text_embedding))
+    _record_search(cna_res, tfc_res, text)
+    return cna_res, tfc_res
+
+def _record_search(cna_res, tfc_res, text=None):
+    set_attributes(mode="hybrid" if RETRIEVAL_MODE == "hybrid" and text else "vector",
+                   cna_index=CNA_INDEX, cna_hits=len(cna_res), tfc_index=TFC_INDEX, tfc_hits=len(tfc_res))
+
+def _hybrid_resource_searches(text_embedding, text):
+    return [
+        {"index": CNA_INDEX, "embedding_column_name": "embeddings", "input_embedding": text_embedding,
+         "query_text": text, "text_fields": CNA_TEXT_FIELDS, "recall_size": CNA_RECALL_SIZE, "includes": CNA_SOURCE_FIELDS},
+        {"index": TFC_INDEX, "embedding_column_name": "embeddings", "input_embedding": text_embedding,
+         "query_text": text, "text_fields": TFC_TEXT_FIELDS, "recall_size": TFC_RECALL_SIZE, "includes": TFC_SOURCE_FIELDS},
+    ]
+
+def _vector_resource_searches(text_embedding):
+    return [
+        {"index": CNA_INDEX, "embedding_column_name": "embeddings", "input_embedding": text_embedding,
+         "recall_size": CNA_RECALL_SIZE, "includes": CNA_SOURCE_FIELDS, "method": VECTOR_SEARCH_METHOD},
+        {"index": TFC_INDEX, "embedding_column_name": "embeddings", "input_embedding": text_embedding,
+         "recall_size": TFC_RECALL_SIZE, "includes": TFC_SOURCE_FIELDS, "method": VECTOR_SEARCH_METHOD},
+    ]
+
+### 非同步版本：與 LLM 呼叫在同一個事件循環上執行，不佔用執行緒
+async def _search_resources_async(text_embedding, text=None, deadline=None):
+    if SEARCH_BACKEND == "mirror":
+        return await asyncio.to_thread(_search_mirror_resources, text_embedding)
+    try:
+        return await _search_es_resources_async(text_embedding, text, deadline)
+    except Exception as e:
+        if not (mirror_available(CNA_MIRROR_INDEX) or mirror_available(TFC_MIRROR_INDEX)):
+            raise
+        print(f"[Error] ES 搜尋失敗，改用本機鏡像: {str(e)}")
+        return await asyncio.to_thread(_search_mirror_resources, text_embedding)
+
+@traced("es_search")
+async def _search_es_resources_async(text_embedding, text=None, deadline=None):
+    async_es = es_with_timeout(es_SearchLib_async.get_async_es(), stage_timeout(deadline, "search", floor=DEADLINE_MIN_STAGE))
+    if RETRIEVAL_MODE == "hybrid" and text:
+        cna_res, tfc_res = await es_SearchLib_async.es_multi_hybrid_search(async_es, _hybrid_resource_searches(text_embedding, text))
+    else:
+        cna_res, tfc_res = await es_SearchLib_async.es_multi_vector_search(async_es, _vector_resource_searches(text_embedding))
+    _record_search(cna_res, tfc_res, text)
+    return cna_res, tfc_res
+
+### 時間預算不足時的降級：相關性判斷只做每個來源排序最前面的幾筆，完全沒時間時只用快取的判斷結果
+RELATION_DEGRADED_BUDGET = float(os.getenv("relation_degraded_budget", "8"))
+RELATION_DEGRADED_CANDIDATES = int(os.getenv("relation_degraded_candidates", "3"))
+
+def _relation_budget(deadline, relation_timeout=None):
+    """回傳相關性判斷可用的秒數，沒有 deadline 時為 relation_timeout"""
+    return stage_timeout(deadline, "relation", relation_timeout)
+
+def _degrade_candidates(candidates, keys, budget):
+    """預算低於 RELATION_DEGRADED_BUDGET 時，每個來源只保留排序前 RELATION_DEGRADED_CANDIDATES 筆"""
+    if budget is None or budget >= RELATION_DEGRADED_BUDGET:
+        return candidates, keys
+    counters = {}
+    kept = []
+    for data, key in zip(candidates, keys):
+        counters[data['data_type']] = counters.get(data['data_type'], 0) + 1
+        if counters[data['data_type']] <= RELATION_DEGRADED_CANDIDATES:
+            kept.append((data, key))
+    print(f"[Info] 相關性判斷剩餘 {budget:.1f} 秒，候選資料由 {len(candidates)} 筆減為 {len(kept)} 筆")
+    set_attributes(degraded_candidates=len(kept))
+    return [data for data, _ in kept], [key for _, key in kept]
+
+def _cached_relevant(candidates, keys):
+    """沒有時間呼叫 LLM 時，只保留快取判斷為相關的資料"""
+    print(f"[Info] 已無相關性判斷的時間預算，只使用快取結果")
+    set_attributes(relation_cache_only=True)
+    verdicts, _ = _split_cached(candidates, keys)
+    return _collect_relevant(candidates, verdicts)
+
+def _candidates(text, cna_res, tfc_res):
+    """es 搜尋結果轉成 (參考資料 list, 相關性快取 key list)，CNA 以 pid、TFC 以報告連結當文件 ID"""
+    candidates, keys = [], []
+    for item in cna_res:
+        data = _cna_resource(item['_source'])
+        candidates.append(data)
+        keys.append(relation_cache_key(text, CNA_INDEX, item['_source'].get('pid', ''), data['summary']))
+    for item in tfc_res:
+        data = _tfc_resource(item['_source'])
+        candidates.append(data)
+        keys.append(relation_cache_key(text, TFC_INDEX, item['_source'].get('link', ''), data['summary']))
+    return candidates, keys
+
 ## 用es搜社稿跟查核中心報告
-def es_resources(text): 
+@traced("es_resources")
+def es_resources(text, relation_mode="single", deadline=None):
+    """
+    :param relation_mode: "single" 每筆參考資料各自判斷相關性；"batch" 所有參考資料一次判斷
+    :param deadline: deadline.Deadline，時間不足時只用快取的相關性判斷
+    """
+    if relation_mode == "batch":
+        return es_resources_batch(text, deadline)
+
     # embedding input
     text_embedding = text_embeddings_3(text)
 
-    # es search CNA
+    # es search CNA + TFC（一次 _msearch）
     start_time = time.time()
-    print("[Info] 正在搜尋中央社社稿")
-    cna_res = es_vector_search(es, index="lab_mainsite_search", embedding_column_name="embeddings",
-                              input_embedding=text_embedding, recall_size=10)
+    print("[Info] 正在搜尋中央社社稿與查核中心報告")
+    cna_res, tfc_res = _search_resources(text_embedding, text, deadline)
 
     cna_news = []
     if cna_res:
@@ -105,21 +521,15 @@ def es_resources(text):
             print(f"[Info] 找到 {len(cna_res)} 筆社稿資料")
             for item in cna_res:
                 source = item['_source']
-                data = ({
-                        "data_type": "CNA",
-                        "title": source.get('h1', ''),
-                        "date": source.get('dt', '').replace('/', '-'),
-                        "article": source.get('article', ''),
-                        "summary": source.get('whatHappen200', ''),
-                        "url": f"https://www.cna.com.tw/news/aall/{source.get('pid', '')}.aspx"
-                })
+                data = _cna_resource(source)
+                cache_key = relation_cache_key(text, CNA_INDEX, source.get('pid', ''), data['summary'])
 
                 # 相關性檢查
-                if es_relation(text, source.get('whatHappen200', '')) == True:
+                if _judge_within_budget(text, data, cache_key, deadline):
                     cna_news.append(data)
-                    print(f"\n >>> 有相關，加入：{source.get('h1', '')}")
+                    print(f"\n >>> 有相關，加入：{data['title']}")
                 else:
-                    print(f"\n >>> 不相關，跳過：{source.get('h1', '')} ")
+                    print(f"\n >>> 不相關，跳過：{data['title']} ")
 
         except Exception as e:
             print(f"[Error] 查詢社稿資料過程發生錯誤: {str(e)}")
@@ -128,34 +538,21 @@ def es_resources(text):
     else:  
         print("未找到相似CNA社稿資料。")
 
-    # es search TFC
-    print("[Info] 正在搜尋查核中心報告")
-    tfc_res = es_vector_search(es, index="lab_tfc_search_test", embedding_column_name="embeddings",
-                              input_embedding=text_embedding, recall_size=5)  ## 查核告有時候很舊, 只找5筆
-
     tfc_report = []
     if tfc_res:
         try:
             print(f"[Info] 找到 {len(tfc_res)} 筆查核中心報告資料")
             for item in tfc_res:
                 source = item['_source']
-                data = ({
-                    "data_type": "TFC",
-                    "title": source.get('title', ''),
-                    "date": source.get('date', '').replace('/', '-'),
-                    "article": source.get('full_content', ''),
-                    "summary": source.get('summary', ''),
-                    "label": source.get('label', ''),
-                    "url": source.get('link', ''),
-
-                })
+                data = _tfc_resource(source)
+                cache_key = relation_cache_key(text, TFC_INDEX, source.get('link', ''), data['summary'])
 
                 # 如果summary跟text有關係才加入
-                if es_relation(text, source.get('summary', '')) == True:
+                if _judge_within_budget(text, data, cache_key, deadline):
                     tfc_report.append(data)
-                    print(f"\n >>> 有相關，加入：{source.get('title', '')}")
+                    print(f"\n >>> 有相關，加入：{data['title']}")
                 else:
-                    print(f"\n >>> 不相關，跳過：{source.get('title', '')}")
+                    print(f"\n >>> 不相關，跳過：{data['title']}")
 
         except Exception as e:
             print(f"[Error] 查詢查核中心報告資料過程發生錯誤: {str(e)}")
@@ -166,40 +563,199 @@ def es_resources(text):
 
     # return
     all_resources = cna_news + tfc_report
+    set_attributes(relation_mode=relation_mode, candidates=len(cna_res) + len(tfc_res), relevant=len(all_resources))
     end_time = time.time()
     print(f"[Debug] ES查詢耗時: {end_time - start_time:.2f} 秒")
     return all_resources
 
+def _judge_within_budget(text, data, cache_key, deadline):
+    """同步版逐筆判斷相關性；剩餘時間不足時只看快取，單筆逾時視為不相關"""
+    budget = _relation_budget(deadline)
+    if budget is not None and budget < DEADLINE_MIN_STAGE:
+        return relation_cache.get(cache_key) == True
+    try:
+        return es_relation_cached(text, data['summary'], cache_key, budget) == True
+    except APITimeoutError:
+        limit = f"（>{budget:.1f} 秒）" if budget is not None else ""
+        print(f"[Error] 相關性判斷逾時{limit}，跳過：{data['title']}")
+        return False
+
+## 批次判斷版本：CNA 與 TFC 候選資料只送一次相關性判斷
+@traced("es_resources_batch")
+def es_resources_batch(text, deadline=None):
+    text_embedding = text_embeddings_3(text)
+
+    start_time = time.time()
+    print("[Info] 正在搜尋中央社社稿與查核中心報告")
+    cna_res, tfc_res = _search_resources(text_embedding, text, deadline)
+    print(f"[Info] 找到 {len(cna_res)} 筆社稿資料、{len(tfc_res)} 筆查核中心報告資料")
+
+    candidates, keys = _candidates(text, cna_res, tfc_res)
+    budget = _relation_budget(deadline)
+    if budget is not None and budget < DEADLINE_MIN_STAGE:
+        return _cached_relevant(candidates, keys)
+    candidates, keys = _degrade_candidates(candidates, keys, budget)
+    verdicts, misses = _split_cached(candidates, keys)
+    if misses:
+        pairs = _batch_pairs(candidates, misses)
+        try:
+            answers = es_relation_batch(text, pairs, budget)
+        except Exception as e:
+            print(f"[Error] 批次相關性判斷發生錯誤: {str(e)}")
+            return []
+        verdicts = _merge_batch(verdicts, keys, misses, pairs, answers)
+
+    relevant = _collect_relevant(candidates, verdicts)
+    set_attributes(relation_mode="batch", candidates=len(candidates), relevant=len(relevant))
+
+    end_time = time.time()
+    print(f"[Debug] ES查詢耗時: {end_time - start_time:.2f} 秒")
+    return relevant
+
+## 併發版本：所有候選資料同時做相關性判斷
+async def _filter_relevant(text, candidates, keys, max_concurrency, relation_timeout, deadline=None):
+    """
+    併發判斷候選資料的相關性，保留原本的排序
+    單筆逾時或出錯視為不相關，不會拖住整批
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def judge(data, cache_key):
+        async with semaphore:
+            # 排隊等 semaphore 的時間也算在 deadline 內
+            timeout = relation_timeout if deadline is None else min(relation_timeout, _relation_budget(deadline))
+            if timeout <= 0:
+                return relation_cache.get(cache_key) == True
+            try:
+                return await asyncio.wait_for(es_relation_cached_async(text, data['summary'], cache_key), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"[Error] 相關性判斷逾時（>{timeout:.1f} 秒），跳過：{data['title']}")
+            except Exception as e:
+                print(f"[Error] 相關性判斷發生錯誤，跳過：{data['title']}，{str(e)}")
+            return False
+
+    verdicts = await asyncio.gather(*(judge(data, key) for data, key in zip(candidates, keys)))
+    return _collect_relevant(candidates, verdicts)
+
+async def _filter_relevant_batch(text, candidates, keys, relation_timeout):
+    """快取未命中的候選資料一次送出做相關性判斷；逾時或出錯時只保留快取判斷為相關的資料"""
+    verdicts, misses = _split_cached(candidates, keys)
+    if misses:
+        pairs = _batch_pairs(candidates, misses)
+        try:
+            answers = await asyncio.wait_for(es_relation_batch_async(text, pairs), timeout=relation_timeout)
+        except asyncio.TimeoutError:
+            print(f"[Error] 批次相關性判斷逾時（>{relation_timeout:.1f} 秒）")
+            return _collect_relevant(candidates, verdicts)
+        except Exception as e:
+            print(f"[Error] 批次相關性判斷發生錯誤: {str(e)}")
+            return []
+        verdicts = _merge_batch(verdicts, keys, misses, pairs, answers)
+    return _collect_relevant(candidates, verdicts)
+
+def _collect_relevant(candidates, verdicts):
+    relevant = []
+    for data, verdict in zip(candidates, verdicts):
+        if verdict == True:
+            relevant.append(data)
+            print(f"\n >>> 有相關，加入：{data['title']}")
+        else:
+            print(f"\n >>> 不相關，跳過：{data['title']}")
+    return relevant
+
+@traced("es_resources")
+async def es_resources_async(text, max_concurrency=8, relation_timeout=20, relation_mode="single", deadline=None):
+    """
+    es_resources 的非同步版本，回傳格式相同（cna_news + tfc_report）
+    :param max_concurrency: 同時進行的相關性判斷數量上限
+    :param relation_timeout: 單筆相關性判斷的秒數上限（batch 模式為整批的上限）
+    :param relation_mode: "single" 每筆併發判斷；"batch" 所有參考資料一次判斷
+    :param deadline: deadline.Deadline，relation_timeout 不超過剩餘預算，時間不足時減少判斷的候選資料
+    """
+    text_embedding = await text_embeddings_3_async(text)
+
+    start_time = time.time()
+    print("[Info] 正在搜尋中央社社稿與查核中心報告")
+    cna_res, tfc_res = await _search_resources_async(text_embedding, text, deadline)
+    print(f"[Info] 找到 {len(cna_res)} 筆社稿資料、{len(tfc_res)} 筆查核中心報告資料")
+
+    candidates, keys = _candidates(text, cna_res, tfc_res)
+    relation_timeout = _relation_budget(deadline, relation_timeout)
+    if relation_timeout < DEADLINE_MIN_STAGE:
+        return _cached_relevant(candidates, keys)
+    candidates, keys = _degrade_candidates(candidates, keys, relation_timeout)
+
+    # CNA 跟 TFC 一起送，共用同一個併發上限
+    if relation_mode == "batch":
+        relevant = await _filter_relevant_batch(text, candidates, keys, relation_timeout)
+    else:
+        relevant = await _filter_relevant(text, candidates, keys, max_concurrency, relation_timeout, deadline)
+    set_attributes(relation_mode=relation_mode, candidates=len(candidates), relevant=len(relevant))
+
+    end_time = time.time()
+    print(f"[Debug] ES查詢耗時: {end_time - start_time:.2f} 秒")
+    return relevant
+
 ### 日期置換 ###
-def date_noun_converter(text):
+# 同一個詞只保留一次，順序不影響結果（比對時一律最長優先）
+DATE_NOUNS = [
+    ('明後天', lambda dt: f"明後天（{dt+timedelta(days=1):%Y年%m月%d日}、{dt+timedelta(days=2):%Y年%m月%d日}）"),
+    ('上個月', lambda dt: f"上個月（{dt + relativedelta(months=-1):%m月}）"),
+    ('下個月', lambda dt: f"下個月（{dt + relativedelta(months=+1):%m月}）"),
+    ('這個月', lambda dt: f"這個月（{dt:%m月}）"),
+    ('本月', lambda dt: f"本月{dt:%m月}"),
+    ('當月', lambda dt: f"當月{dt:%m月}"),
+    ('前天', lambda dt: f"前天（{dt+timedelta(days=-2):%Y年%m月%d日}）"),
+    ('昨天', lambda dt: f"昨天（{dt+timedelta(days=-1):%Y年%m月%d日}）"),
+    ('今天', lambda dt: f"今天（{dt:%Y年%m月%d日}）"),
+    ('今日', lambda dt: f"今日（{dt:%Y年%m月%d日}）"),
+    ('今晚', lambda dt: f"今晚（{dt:%Y年%m月%d日}）"),
+    ('今早', lambda dt: f"今早（{dt:%Y年%m月%d日}）"),
+    ('明天', lambda dt: f"明天（{dt+timedelta(days=1):%Y年%m月%d日}）"),
+    ('後天', lambda dt: f"後天（{dt+timedelta(days=2):%Y年%m月%d日}）"),
+    ('今年', lambda dt: f"今年（{dt:%Y年}）"),
+    ('去年', lambda dt: f"去年（{dt + relativedelta(years=-1):%Y年}）"),
+    ('明年', lambda dt: f"明年（{dt + relativedelta(years=1):%Y年}）"),
+]
+
+class DateNounNormalizer:
+    """
+    日期詞彙置換，正則在建立時編譯一次，之後每次都是單次掃描
+    - 多個詞彙組成一個 alternation，長的詞排前面，同一位置永遠取最長的詞（「明後天」不會被拆成「明」+「後天」）
+    - 替換後的文字不會再被掃描，「明後天（…）」裡面不會再被置換一次
+    """
+
+    def __init__(self, date_nouns=DATE_NOUNS):
+        self.formatters = dict(date_nouns)
+        keys = sorted(self.formatters, key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(key) for key in keys))
+
+    def replacements(self, ref_date=None):
+        """以 ref_date（預設為現在）算出每個詞彙的置換結果"""
+        ref_date = ref_date or datetime.now()
+        return {key: func(ref_date) for key, func in self.formatters.items()}
+
+    def normalize(self, text, ref_date=None):
+        replacements = self.replacements(ref_date)
+        return self.pattern.sub(lambda m: replacements[m.group(0)], text)
+
+    def normalize_batch(self, texts, ref_date=None):
+        """批次置換，整批共用同一個參考日期，置換結果只算一次"""
+        replacements = self.replacements(ref_date)
+        repl = lambda m: replacements[m.group(0)]
+        return [self.pattern.sub(repl, text) for text in texts]
+
+date_noun_normalizer = DateNounNormalizer()
+
+def date_noun_converter(text, story_dt=None):
+    """
+    :param story_dt: 參考日期，預設為現在
+    """
     print(f"[Info] 時間置換")
-    story_dt = datetime.now()
-    # 按照長度排序，較長的詞彙先處理，避免重複替換問題
-    date_nouns = [
-        ('明後天', lambda dt: f"明後天（{dt+timedelta(days=1):%Y年%m月%d日}、{dt+timedelta(days=2):%Y年%m月%d日}）"),
-        ('上個月', lambda dt: f"上個月（{dt + relativedelta(months=-1):%m月}）"),
-        ('下個月', lambda dt: f"下個月（{dt + relativedelta(months=+1):%m月}）"),
-        ('這個月', lambda dt: f"這個月（{dt:%m月}）"),
-        ('本月', lambda dt: f"本月{dt:%m月}"),
-        ('當月', lambda dt: f"當月{dt:%m月}"),
-        ('前天', lambda dt: f"前天（{dt+timedelta(days=-2):%Y年%m月%d日}）"),
-        ('昨天', lambda dt: f"昨天（{dt+timedelta(days=-1):%Y年%m月%d日}）"),
-        ('今天', lambda dt: f"今天（{dt:%Y年%m月%d日}）"),
-        ('今日', lambda dt: f"今日（{dt:%Y年%m月%d日}）"),
-        ('今晚', lambda dt: f"今晚（{dt:%Y年%m月%d日}）"),
-        ('今早', lambda dt: f"今早（{dt:%Y年%m月%d日}）"),
-        ('明天', lambda dt: f"明天（{dt+timedelta(days=1):%Y年%m月%d日}）"),
-        ('後天', lambda dt: f"後天（{dt+timedelta(days=2):%Y年%m月%d日}）"),
-        ('今年', lambda dt: f"今年（{dt:%Y年}）"),
-        ('去年', lambda dt: f"去年（{dt + relativedelta(years=-1):%Y年}）"),
-        ('明年', lambda dt: f"明年（{dt + relativedelta(years=1):%Y年}）"),
-        ('本月', lambda dt: f"本月{dt:%m月}"),
-    ]
+    return date_noun_normalizer.normalize(text, story_dt)
 
-    converted_text = text
-    for key, func in date_nouns:
-        converted_text = converted_text.replace(key, func(story_dt))
-    return converted_text
+def date_noun_converter_batch(texts, story_dt=None):
+    return date_noun_normalizer.normalize_batch(texts, story_dt)
 
 
 if __name__ == "__main__":
@@ -207,15 +763,29 @@ if __name__ == "__main__":
 
     text_converted = date_noun_converter(text)
     print(f">>> 時間置換後query:\n{text_converted}")
-    
-    check_points_list = get_check_points(text_converted, media_name="Chiming")
-    
-    if check_points_list["Result"] == "Y":
-        check_points = check_points_list["ResultData"]["check_points"]
-        print(check_points)
-    else:
-        check_points = None
-        print("[Info] 查核點 API 失敗")
 
-    resources = es_resources(text)
-    print(f"[Info] 最終有{len(resources)}筆參考資料")
\ No newline at end of file
+    deadline = Deadline()
+    fact_check_id = new_fact_check_id()
+    with fact_check_scope(fact_check_id), span("fact_check", trace_id=fact_check_id, input_chars=len(text)) as root:
+        check_points_list = get_check_points(text_converted, media_name="Chiming", deadline=deadline)
+
+        if check_points_list["Result"] == "Y":
+            check_points = check_points_list["ResultData"]["check_points"]
+            print(check_points)
+        else:
+            check_points = None
+            print("[Info] 查核點 API 失敗")
+
+        resources = es_resources(text, deadline=deadline)
+    print(f"[Info] 最終有{len(resources)}筆參考資料，{deadline}")
+    if root.trace_id:
+        print(f"[Info] trace {root.trace_id}（python -m tracing summary --trace {root.trace_id}）")
+    print(f"[Info] 用量: {get_usage_ledger().summary(fact_check_id)}")
+    print(f"[Info] Embedding 快取統計: {embedding_cache.stats.as_dict()}")
+    print(f"[Info] 相關性快取統計: {relation_cache.stats.as_dict()}")
+    print(f"[Info] 相關性快取每小時命中: {relation_cache.stats.hourly()}")
+    try:
+        print(f"[Info] ES script 編譯 / 快取統計: {script_cache_stats(es)}")
+    except Exception as e:
+        print(f"[Error] 讀取 ES script 統計失敗: {e}")
+    print(f"[Info] ES 搜尋結果快取統計: {result_cache_stats.as_dict()}")
\ No newline at end of file
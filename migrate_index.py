@@ -0,0 +1,141 @@
+"""
+建立降維 / 量化向量索引
+
+從既有索引複製 mapping 與文件到新索引，向量欄位改成：
+- 截斷到 --dims 維並重新正規化（text-embedding-3 為 Matryoshka 向量，不必重新 embedding）
+- --element-type float：由 ES 以 --index-type（int8_hnsw / int4_hnsw / bbq_hnsw / hnsw）建立量化的 HNSW 圖，
+  _source 仍是 float
+- --element-type byte：在 client 端量化成 int8 再寫入，_source 與磁碟都只有 1/4
+
+python -m migrate_index lab_mainsite_search lab_mainsite_search_1024_int8 --dims 1024 --index-type int8_hnsw
+python -m migrate_index lab_tfc_search_test lab_tfc_search_test_1024_byte --dims 1024 --element-type byte --index-type hnsw
+
+建好之後把環境變數 es_cna_index / es_tfc_index 指向新索引即可，查詢向量會依新索引的 mapping 自動截斷、量化。
+"""
+import time
+import copy
+import argparse
+
+from elasticsearch import helpers
+
+from quantization import encode_for_layout
+
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw", "flat", "int8_flat")
+
+
+def vector_mapping(dims, element_type="float", index_type="int8_hnsw", m=16, ef_construction=100):
+    """
+    :param index_type: ES 端的 index_options.type；element_type="byte" 時只能用 hnsw / flat
+    """
+    if element_type not in ("float", "byte"):
+        raise ValueError(f"不支持的 element_type: {element_type}")
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(f"不支持的 index_type: {index_type}")
+    if element_type == "byte" and index_type not in ("hnsw", "flat"):
+        raise ValueError("element_type=byte 已在 client 端量化，index_type 只能是 hnsw 或 flat")
+    index_options = {"type": index_type}
+    if index_type.endswith("hnsw"):
+        index_options.update({"m": m, "ef_construction": ef_construction})
+    return {
+        "type": "dense_vector",
+        "dims": dims,
+        "element_type": element_type,
+        "index": True,
+        # 寫入前已正規化成單位長度，dot_product 等同 cosine 但省去計算長度；byte 向量只能用 cosine
+        "similarity": "dot_product" if element_type == "float" else "cosine",
+        "index_options": index_options,
+    }
+
+
+def build_target_mapping(es, source_index, embedding_column_name, dims, element_type, index_type):
+    response = es.indices.get_mapping(index=source_index)
+    mappings = copy.deepcopy(next(iter(response.values()))["mappings"])
+    properties = mappings.setdefault("properties", {})
+    if embedding_column_name not in properties:
+        raise ValueError(f"{source_index} 沒有向量欄位 {embedding_column_name}")
+    properties[embedding_column_name] = vector_mapping(dims, element_type, index_type)
+    return mappings
+
+
+def _actions(es, source_index, target_index, embedding_column_name, dims, element_type, batch_size, stats):
+    query = {"query": {"match_all": {}}}
+    for hit in helpers.scan(es, index=source_index, query=query, size=batch_size, preserve_order=False):
+        source = hit["_source"]
+        vector = source.get(embedding_column_name)
+        if vector:
+            source[embedding_column_name] = encode_for_layout(vector, dims, element_type)
+        else:
+            source.pop(embedding_column_name, None)
+            stats["without_vector"] += 1
+        yield {"_index": target_index, "_id": hit["_id"], "_source": source}
+
+
+def migrate_index(es, source_index, target_index, embedding_column_name="embeddings", dims=1024,
+                  element_type="float", index_type="int8_hnsw", batch_size=500, shards=None):
+    """
+    建立 target_index 並複製 source_index 的所有文件
+    寫入期間關閉 refresh 與 replica，完成後還原並 force merge 成單一 segment，讓 HNSW 搜尋最快
+    :return: {"indexed", "failed", "without_vector", "seconds"}
+    """
+    if es.indices.exists(index=target_index):
+        raise ValueError(f"{target_index} 已存在")
+
+    start_time = time.time()
+    source_settings = next(iter(es.indices.get_settings(index=source_index).values()))["settings"]["index"]
+    settings = {
+        "number_of_shards": shards or int(source_settings.get("number_of_shards", 1)),
+        "number_of_replicas": 0,
+        "refresh_interval": "-1",
+    }
+    if "analysis" in source_settings:
+        settings["analysis"] = source_settings["analysis"]
+    mappings = build_target_mapping(es, source_index, embedding_column_name, dims, element_type, index_type)
+    es.indices.create(index=target_index, settings=settings, mappings=mappings)
+    print(f"[Info] 建立 {target_index}：{dims} 維 {element_type} / {index_type}")
+
+    stats = {"indexed": 0, "failed": 0, "without_vector": 0}
+    actions = _actions(es, source_index, target_index, embedding_column_name, dims, element_type, batch_size, stats)
+    for ok, item in helpers.streaming_bulk(es, actions, chunk_size=batch_size, raise_on_error=False, max_retries=3):
+        if ok:
+            stats["indexed"] += 1
+        else:
+            stats["failed"] += 1
+            print(f"[Error] 寫入失敗: {item}")
+        if stats["indexed"] and stats["indexed"] % 10000 == 0:
+            print(f"[Info] 已寫入 {stats['indexed']} 筆")
+
+    es.indices.put_settings(index=target_index, settings={
+        "refresh_interval": source_settings.get("refresh_interval", "1s"),
+        "number_of_replicas": int(source_settings.get("number_of_replicas", 1)),
+    })
+    es.indices.refresh(index=target_index)
+    es.options(request_timeout=3600).indices.forcemerge(index=target_index, max_num_segments=1, wait_for_completion=True)
+    stats["seconds"] = round(time.time() - start_time, 2)
+    print(f"[Info] {source_index} -> {target_index} 完成：{stats}")
+    return stats
+
+
+def index_size(es, index):
+    """回傳 (文件數, 主分片大小 bytes)"""
+    primaries = es.indices.stats(index=index, metric="docs,store")["_all"]["primaries"]
+    return primaries["docs"]["count"], primaries["store"]["size_in_bytes"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="建立降維 / 量化向量索引")
+    parser.add_argument("source")
+    parser.add_argument("target")
+    parser.add_argument("--field", default="embeddings")
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--element-type", choices=["float", "byte"], default="float")
+    parser.add_argument("--index-type", choices=VECTOR_INDEX_TYPES, default="int8_hnsw")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--shards", type=int, default=None)
+    args = parser.parse_args()
+
+    from es_SearchLib import es
+    migrate_index(es, args.source, args.target, args.field, args.dims, args.element_type, args.index_type,
+                  args.batch_size, args.shards)
+    for index in (args.source, args.target):
+        docs, size = index_size(es, index)
+        print(f"{index:<40} {docs:>10} 筆  {size / 1024 / 1024:10.1f} MB")
@@ -0,0 +1,74 @@
+"""
+Embedding 降維與量化
+
+text-embedding-3 系列是 Matryoshka 訓練的，取前 N 維再正規化成單位長度，
+效果等同於呼叫 API 時帶 dimensions=N，所以既有的 3072 維向量可以直接截斷，不必重新 embedding。
+
+- truncate_embedding：截斷到 N 維並重新正規化
+- quantize_int8：單位向量乘 127 四捨五入成 int8（對應 dense_vector element_type="byte"）
+- quantize_bits：每一維只留正負號，8 維打包成 1 byte（對應 element_type="bit"，以 hamming 距離比較）
+"""
+import numpy as np
+
+INT8_SCALE = 127.0
+
+
+def normalize(vectors):
+    """把向量（或矩陣的每一列）正規化成單位長度"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def truncate_embedding(vector, dims):
+    """
+    截斷到前 dims 維並重新正規化
+    :param dims: 目標維度；None 或不小於原維度時只做正規化
+    :return: list[float]
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    if dims and dims < vector.shape[-1]:
+        vector = vector[..., :dims]
+    return normalize(vector).tolist()
+
+
+def quantize_int8(vector, dims=None):
+    """截斷、正規化後量化成 -127 ~ 127 的整數，回傳 list[int]"""
+    vector = np.asarray(truncate_embedding(vector, dims), dtype=np.float32)
+    return np.clip(np.round(vector * INT8_SCALE), -127, 127).astype(np.int8).tolist()
+
+
+def dequantize_int8(vector):
+    return (np.asarray(vector, dtype=np.float32) / INT8_SCALE).tolist()
+
+
+def quantize_bits(vector, dims=None):
+    """
+    每一維 > 0 記為 1，8 維打包成 1 byte，回傳 ES bit 向量使用的 hex 字串
+    dims 必須是 8 的倍數
+    """
+    vector = np.asarray(truncate_embedding(vector, dims), dtype=np.float32)
+    if vector.shape[-1] % 8:
+        raise ValueError(f"bit 量化的維度必須是 8 的倍數: {vector.shape[-1]}")
+    return np.packbits(vector > 0).tobytes().hex()
+
+
+def hamming_similarity(bits_a, bits_b):
+    """兩個 quantize_bits 結果相同位元的比例（0 ~ 1）"""
+    a = np.frombuffer(bytes.fromhex(bits_a), dtype=np.uint8)
+    b = np.frombuffer(bytes.fromhex(bits_b), dtype=np.uint8)
+    return 1.0 - np.unpackbits(a ^ b).sum() / (len(a) * 8)
+
+
+def encode_for_layout(vector, dims=None, element_type="float"):
+    """
+    依索引的 dense_vector 設定轉換查詢 / 寫入用的向量
+    :param element_type: "float"（含 int8_hnsw 等由 ES 內部量化的 index_options）/ "byte" / "bit"
+    """
+    if element_type == "float":
+        return truncate_embedding(vector, dims)
+    if element_type == "byte":
+        return quantize_int8(vector, dims)
+    if element_type == "bit":
+        return quantize_bits(vector, dims)
+    raise ValueError(f"不支持的 element_type: {element_type}")
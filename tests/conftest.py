@@ -0,0 +1,21 @@
+"""
+測試共用設定：模組在 import 時讀取環境變數，這裡先設好，
+ES 指向本機（測試一律用 stub，不會真的連線），快取只用記憶體、tracing 關閉
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name, value in {
+    "es_host": "http://localhost:9200",
+    "es_username": "elastic",
+    "es_password": "test",
+    "trace_exporter": "none",
+    "usage_ledger": "false",
+    "factcheck_cache": "false",
+    "embedding_cache_path": "",
+    "relation_cache_path": "",
+    "check_points_cache_path": "",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,65 @@
+import time
+
+from cache import normalize_text, make_key, pack_floats, unpack_floats, LRUCache, DiskCache, TieredCache
+
+
+def test_normalize_text_unifies_width_and_spaces():
+    assert normalize_text("  ＡＢＣ　１２３ \n\t 測試 ") == "ABC 123 測試"
+    assert normalize_text(None) == ""
+
+
+def test_make_key_separates_parts():
+    assert make_key("ab", "c") != make_key("a", "bc")
+    assert make_key("a", None) == make_key("a", None)
+
+
+def test_pack_floats_roundtrip():
+    assert unpack_floats(pack_floats([0.5, -1.0, 2.25])) == [0.5, -1.0, 2.25]
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_items=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_lru_ttl_expires():
+    cache = LRUCache()
+    cache.set("a", 1, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("a", "miss") == "miss"
+    assert len(cache) == 0
+
+
+def test_disk_cache_evicts_to_90_percent(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_bytes=100)
+    for i in range(5):
+        cache.set(f"k{i}", b"x" * 30)
+    assert cache.total_bytes <= 90
+    assert cache.get("k4") == b"x" * 30
+    assert cache.get("k0") is None
+
+
+def test_disk_cache_replace_keeps_size(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"))
+    cache.set("a", b"12345")
+    cache.set("a", b"12")
+    assert cache.total_bytes == 2
+    cache.delete("a")
+    assert cache.total_bytes == 0 and len(cache) == 0
+
+
+def test_tiered_cache_reads_through_disk(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    dumps, loads = lambda v: v.encode("utf-8"), lambda b: b.decode("utf-8")
+    TieredCache(dumps, loads, path).set("k", "value")
+
+    cache = TieredCache(dumps, loads, path)
+    assert cache.get("k") == "value"   # 磁碟命中，並放回記憶體
+    assert cache.get("k") == "value"   # 記憶體命中
+    assert cache.get("missing") is None
+    assert cache.stats.as_dict() == {"memory_hits": 1, "disk_hits": 1, "misses": 1, "hit_rate": 0.6667}
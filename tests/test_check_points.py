@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import check_points
+from check_points import CircuitBreaker, start_stub_server, get_check_points
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow() is True
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.allow() is False
+
+
+def test_breaker_half_open_allows_single_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.state == "half_open"
+    assert breaker.allow() == CircuitBreaker.PROBE
+    assert breaker.allow() is False          # 試探中不再放行
+    breaker.release_probe()                  # 試探被取消，下一個請求可以再試探
+    assert breaker.allow() == CircuitBreaker.PROBE
+
+
+def test_breaker_probe_success_closes_and_failure_reopens():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.01)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow() == CircuitBreaker.PROBE
+    breaker.record_failure()                 # 試探失敗立刻再斷路，不必重新累計
+    assert breaker.state == "open"
+
+    time.sleep(0.02)
+    assert breaker.allow() == CircuitBreaker.PROBE
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow() is True
+
+
+@pytest.fixture
+def fresh_client(monkeypatch):
+    """每個測試用新的斷路器與快取，重試不等待"""
+    monkeypatch.setattr(check_points, "check_points_breaker", CircuitBreaker(failure_threshold=1, reset_timeout=60))
+    monkeypatch.setattr(check_points, "CHECK_POINTS_BACKOFF", 0.0)
+    check_points.check_points_cache.memory.clear()
+    check_points.check_points_negative_cache.clear()
+
+
+def test_get_check_points_against_stub(monkeypatch, fresh_client):
+    server, url = start_stub_server()
+    monkeypatch.setattr(check_points, "CHECK_POINTS_URL", url)
+    try:
+        result = get_check_points("測試傳言", media_name="test")
+        assert result["Result"] == "Y"
+        server.shutdown()
+        assert get_check_points("測試傳言", media_name="test") == result   # 快取命中，不再呼叫 API
+    finally:
+        server.shutdown()
+
+
+def test_get_check_points_failures_open_breaker(monkeypatch, fresh_client):
+    server, url = start_stub_server(fail_rate=1.0)
+    monkeypatch.setattr(check_points, "CHECK_POINTS_URL", url)
+    try:
+        result = get_check_points("失敗的傳言", use_cache=False)
+        assert result["Result"] == "N"
+        assert check_points.check_points_breaker.state == "open"
+        assert get_check_points("失敗的傳言", use_cache=False)["Message"] == "查核點服務暫時無法使用"
+    finally:
+        server.shutdown()
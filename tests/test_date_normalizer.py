@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from functions import DateNounNormalizer, date_noun_converter_batch
+
+REF = datetime(2025, 1, 31)
+
+
+def test_longest_match_wins():
+    # 「明後天」不會被拆成「明」+「後天」
+    assert DateNounNormalizer().normalize("明後天放假", REF) == "明後天（2025年02月01日、2025年02月02日）放假"
+
+
+def test_replacement_is_not_rescanned():
+    text = DateNounNormalizer().normalize("今天與昨天", REF)
+    assert text == "今天（2025年01月31日）與昨天（2025年01月30日）"
+    assert text.count("今天") == 1
+
+
+def test_month_and_year_offsets():
+    normalizer = DateNounNormalizer()
+    assert normalizer.normalize("下個月", REF) == "下個月（02月）"
+    assert normalizer.normalize("去年到明年", REF) == "去年（2024年）到明年（2026年）"
+
+
+def test_text_without_date_nouns_unchanged():
+    assert DateNounNormalizer().normalize("女性皆可領取3萬9522元", REF) == "女性皆可領取3萬9522元"
+
+
+def test_custom_nouns_and_batch():
+    normalizer = DateNounNormalizer([("大後天", lambda dt: "D+3"), ("後天", lambda dt: "D+2")])
+    assert normalizer.normalize_batch(["大後天", "後天", "明天"], REF) == ["D+3", "D+2", "明天"]
+    assert date_noun_converter_batch(["今天", "明天"], REF) == ["今天（2025年01月31日）", "明天（2025年02月01日）"]
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from deadline import Deadline, DeadlineExceeded, STAGE_RESERVES, stage_timeout
+
+
+def test_for_stage_subtracts_reserve_and_applies_cap_floor():
+    deadline = Deadline(budget=100)
+    reserve = STAGE_RESERVES["search"]
+    assert 100 - reserve - 1 < deadline.for_stage("search") <= 100 - reserve
+    assert deadline.for_stage("search", cap=3) == 3
+    assert Deadline(budget=1).for_stage("search", floor=2) == 2
+
+
+def test_stage_timeout_without_deadline_returns_cap():
+    assert stage_timeout(None, "search", cap=7) == 7
+    assert stage_timeout(Deadline(budget=100), "review", cap=7) == 7
+
+
+def test_check_raises_when_expired():
+    deadline = Deadline(budget=0)
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceeded) as info:
+        deadline.check("relation")
+    assert info.value.stage == "relation"
+
+
+def test_run_times_out_with_deadline_exceeded():
+    async def slow():
+        await asyncio.sleep(1)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(Deadline(budget=0.05).run(slow(), "review"))
+
+
+def test_run_without_budget_closes_coroutine():
+    async def never():
+        raise AssertionError("不應該執行")
+
+    coroutine = never()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(Deadline(budget=0).run(coroutine, "review"))
+    assert coroutine.cr_frame is None   # 已 close，不會留下 never awaited 警告
+
+
+def test_run_returns_result_in_time():
+    async def fast():
+        return 42
+
+    assert asyncio.run(Deadline(budget=10).run(fast(), "review")) == 42
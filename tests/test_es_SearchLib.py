@@ -0,0 +1,171 @@
+"""kNN / RRF 的降級邏輯，以 stub ES 模擬叢集回應"""
+import json
+import asyncio
+
+import pytest
+from elastic_transport import ApiResponseMeta, HttpHeaders
+from elasticsearch import BadRequestError
+
+import es_SearchLib as lib
+import es_SearchLib_async as async_lib
+
+KNN_ERROR = {
+    "type": "illegal_argument_exception",
+    "reason": "[knn] queries are only supported on [dense_vector] fields that are indexed",
+    "root_cause": [{"type": "illegal_argument_exception", "reason": "field [embeddings] is not indexed for knn"}],
+}
+RRF_ERROR = {"type": "parsing_exception", "reason": "unknown retriever [rrf]"}
+DIMS_ERROR = {"type": "illegal_argument_exception", "reason": "the query vector has a different dimension [2] than the index vectors [3]"}
+
+VECTOR_HIT = {"_index": "i", "_id": "v1", "_score": 1.5}
+LEXICAL_HIT = {"_index": "i", "_id": "l1", "_score": 3.0}
+RRF_HIT = {"_index": "i", "_id": "r1", "_score": 0.03}
+
+
+def bad_request(error):
+    meta = ApiResponseMeta(status=400, http_version="1.1", headers=HttpHeaders(), duration=0.0, node=None)
+    return BadRequestError(message=error["type"], meta=meta, body={"error": error, "status": 400})
+
+
+class StubES:
+    """
+    search / msearch 依 body 內容回應：generation 探測、rrf retriever、kNN、script_score、關鍵字
+    :param knn_error: kNN（含 rrf retriever 內的 kNN）回傳的錯誤，None 代表成功
+    :param rrf_error: rrf retriever 本身的錯誤
+    """
+
+    def __init__(self, knn_error=None, rrf_error=None):
+        self.knn_error = knn_error
+        self.rrf_error = rrf_error
+        self.searches = []
+        self.msearches = []
+
+    def _respond(self, body):
+        if body.get("track_total_hits"):
+            return {"hits": {"total": {"value": 1}, "hits": []}}
+        if "retriever" in body:
+            error = self.rrf_error or self.knn_error
+            return {"status": 400, "error": error} if error else {"hits": {"hits": [RRF_HIT]}}
+        if "knn" in body:
+            return {"status": 400, "error": self.knn_error} if self.knn_error else {"hits": {"hits": [VECTOR_HIT]}}
+        if "script_score" in json.dumps(body):
+            return {"hits": {"hits": [VECTOR_HIT]}}
+        return {"hits": {"hits": [LEXICAL_HIT]}}
+
+    def search(self, index, body):
+        self.searches.append(body)
+        response = self._respond(body)
+        if "error" in response:
+            raise bad_request(response["error"])
+        return response
+
+    def msearch(self, searches):
+        self.msearches.append(searches)
+        return {"responses": [self._respond(body) for body in searches[1::2]]}
+
+
+@pytest.fixture(autouse=True)
+def reset_state(monkeypatch):
+    monkeypatch.setitem(lib._scripts_state, "ready", False)
+    monkeypatch.setitem(lib._templates_state, "ready", False)
+    lib._knn_unsupported.clear()
+    lib._rrf_unsupported.clear()
+    lib._vector_layouts.clear()
+    lib.clear_result_cache()
+    lib.register_vector_layout("i", "embeddings", 3, "float")
+    yield
+    lib._knn_unsupported.clear()
+    lib._rrf_unsupported.clear()
+    lib._vector_layouts.clear()
+    lib.clear_result_cache()
+
+
+def test_is_unsupported_error():
+    assert lib._is_unsupported_error({**KNN_ERROR, "status": 400})
+    assert not lib._is_unsupported_error({**DIMS_ERROR, "status": 400})
+    assert not lib._is_unsupported_error({"type": "es_rejected_execution_exception", "status": 429})
+    license_error = {"type": "security_exception", "reason": "current license is non-compliant for [rrf]", "status": 403}
+    assert not lib._is_unsupported_error(license_error)
+    assert lib._is_unsupported_error(license_error, license_errors=True)
+
+
+def test_is_knn_unsupported_error_tells_knn_from_rrf():
+    assert lib._is_knn_unsupported_error({**KNN_ERROR, "status": 400})
+    assert not lib._is_knn_unsupported_error({**RRF_ERROR, "status": 400})
+
+
+def test_vector_search_falls_back_to_script_score():
+    es = StubES(knn_error=KNN_ERROR)
+    assert lib.es_vector_search(es, "i", "embeddings", [0.1, 0.2, 0.3], method="knn") == [VECTOR_HIT]
+    assert ("i", "embeddings") in lib._knn_unsupported
+
+    lib.clear_result_cache()
+    es.searches.clear()
+    lib.es_vector_search(es, "i", "embeddings", [0.1, 0.2, 0.3], method="knn")
+    assert not any("knn" in body for body in es.searches)   # 之後直接走 script_score
+
+
+def test_vector_search_reraises_other_bad_requests():
+    es = StubES(knn_error=DIMS_ERROR)
+    with pytest.raises(BadRequestError):
+        lib.es_vector_search(es, "i", "embeddings", [0.1, 0.2], method="knn")
+    assert ("i", "embeddings") not in lib._knn_unsupported
+
+
+def test_bit_layout_rejects_script_score():
+    lib.register_vector_layout("bits", "embeddings", 16, "bit")
+    with pytest.raises(ValueError):
+        lib.es_vector_search(StubES(), "bits", "embeddings", [0.1] * 16, method="script_score")
+
+
+def test_multi_vector_search_probes_in_same_msearch_and_caches():
+    es = StubES()
+    searches = [{"index": "i", "embedding_column_name": "embeddings", "input_embedding": [0.1, 0.2, 0.3]}]
+    assert lib.es_multi_vector_search(es, searches) == [[VECTOR_HIT]]
+    assert len(es.msearches) == 1 and not es.searches
+    assert len(es.msearches[0]) == 4                         # 搜尋 + generation 探測
+
+    assert lib.es_multi_vector_search(es, searches) == [[VECTOR_HIT]]
+    assert len(es.msearches) == 1                            # 快取命中
+
+
+def test_hybrid_server_rrf_knn_error_falls_back_to_client_script_score():
+    es = StubES(knn_error=KNN_ERROR)
+    hits = lib.es_hybrid_search(es, "i", "embeddings", [0.1, 0.2, 0.3], "傳言", ["h1"])
+    assert {hit["_id"] for hit in hits} == {"v1", "l1"}
+    assert ("i", "embeddings") in lib._knn_unsupported
+    assert "i" not in lib._rrf_unsupported                  # 不是 rrf 不支援
+    assert len(es.msearches) == 2
+    assert "script_score" in json.dumps(es.msearches[1])
+
+
+def test_hybrid_rrf_unsupported_uses_client_merge_with_knn():
+    es = StubES(rrf_error=RRF_ERROR)
+    hits = lib.es_hybrid_search(es, "i", "embeddings", [0.1, 0.2, 0.3], "傳言", ["h1"])
+    assert {hit["_id"] for hit in hits} == {"v1", "l1"}
+    assert "i" in lib._rrf_unsupported and not lib._knn_unsupported
+
+
+def test_hybrid_client_side_retries_vector_leg_with_script_score():
+    es = StubES(knn_error=KNN_ERROR)
+    hits = lib.es_hybrid_search(es, "i", "embeddings", [0.1, 0.2, 0.3], "傳言", ["h1"], server_side=False)
+    assert {hit["_id"] for hit in hits} == {"v1", "l1"}
+    assert ("i", "embeddings") in lib._knn_unsupported
+    assert len(es.msearches) == 2
+    assert len(es.msearches[1]) == 2                         # 只重送 vector 一路
+
+
+class AsyncStubES(StubES):
+    async def search(self, index, body):
+        return StubES.search(self, index, body)
+
+    async def msearch(self, searches):
+        return StubES.msearch(self, searches)
+
+
+def test_async_hybrid_server_rrf_knn_error_falls_back():
+    es = AsyncStubES(knn_error=KNN_ERROR)
+    hits = asyncio.run(async_lib.es_hybrid_search(es, "i", "embeddings", [0.1, 0.2, 0.3], "傳言", ["h1"]))
+    assert {hit["_id"] for hit in hits} == {"v1", "l1"}
+    assert ("i", "embeddings") in lib._knn_unsupported and "i" not in lib._rrf_unsupported
+    assert len(es.msearches) == 2
@@ -0,0 +1,59 @@
+import numpy as np
+import pyarrow.parquet as pq
+
+from es_export import export_range, read_embedding_matrix, pid_bounds_clause
+
+HITS = [
+    {"_id": "202501010001", "_source": {"h1": "標題一", "pid": "202501010001", "embeddings": [0.1, 0.2, 0.3]}, "sort": [1]},
+    {"_id": "202501010002", "_source": {"h1": "沒有向量", "pid": "202501010002"}, "sort": [2]},
+    {"_id": "202501010003", "_source": {"h1": "維度不符", "pid": "202501010003", "embeddings": [0.1, 0.2]}, "sort": [3]},
+    {"_id": "202501020001", "_source": {"h1": ["列表", "欄位"], "pid": "202501020001", "embeddings": [1.0, 0.0, -1.0]}, "sort": [4]},
+]
+
+
+class PitStubES:
+    """以 search_after 分頁回傳 HITS 的 point-in-time stub"""
+
+    def __init__(self):
+        self.closed = False
+        self.bodies = []
+
+    def open_point_in_time(self, index, keep_alive):
+        return {"id": "pit"}
+
+    def search(self, body):
+        self.bodies.append(body)
+        after = body.get("search_after", [0])[0]
+        page = [hit for hit in HITS if hit["sort"][0] > after][:body["size"]]
+        return {"pit_id": "pit", "hits": {"hits": page}}
+
+    def close_point_in_time(self, id):
+        self.closed = True
+
+
+def test_export_roundtrip_with_missing_vectors(tmp_path):
+    es = PitStubES()
+    path = str(tmp_path / "export.parquet")
+    stats = export_range(es, "cna", path, "20250101", "20250102", ["h1", "pid"], dims=3, page_size=2)
+    assert stats["rows"] == 4 and es.closed
+
+    table = pq.read_table(path)
+    assert table.column("embeddings_valid").to_pylist() == [True, False, False, True]
+    assert table.column("h1").to_pylist()[3] == '["列表", "欄位"]'
+
+    ids, matrix = read_embedding_matrix(path)
+    assert ids == ["202501010001", "202501020001"]
+    assert matrix.dtype == np.float32 and matrix.shape == (2, 3)
+    np.testing.assert_allclose(matrix[1], [1.0, 0.0, -1.0])
+
+
+def test_export_without_embeddings(tmp_path):
+    path = str(tmp_path / "export.parquet")
+    export_range(PitStubES(), "cna", path, "20250101", "20250102", ["h1"], embedding_column_name=None)
+    assert pq.read_table(path).column_names == ["_id", "h1"]
+
+
+def test_pid_bounds_clause_accepts_dates_and_raw_pids():
+    assert pid_bounds_clause("pid", "20250101", "20250131") == {"range": {"pid": {"gte": "202501010002", "lte": "202501319999"}}}
+    assert pid_bounds_clause("pid", "202501010005", "20250131") == {"range": {"pid": {"gte": "202501010005", "lte": "202501319999"}}}
+    assert pid_bounds_clause("pid", "20250101", "202501010010") == {"range": {"pid": {"gte": "202501010002", "lte": "202501010010"}}}
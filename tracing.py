@@ -0,0 +1,335 @@
+"""
+查核流程的 span tracing
+
+每個階段包成一個 span（名稱、起訖時間、屬性、錯誤），以 contextvars 記錄目前的 span，
+子階段自動掛在父 span 底下，asyncio task 與 asyncio.to_thread 也會沿用；自己開執行緒時要用 contextvars.copy_context()。
+
+    with span("es_search", mode="vector") as s:     # 成為目前的 span，底下再開的 span 都是它的子 span
+        ...
+        s.set_attribute("hits", len(hits))
+
+    @traced("fact_check")                             # 同步 / 非同步函式皆可
+    def start_fact_check(...): ...
+
+    with span("fact_check.final_report", trace_id=fact_check_id): ...   # 之後的步驟接回同一個 trace
+
+    s = start_span("agent.explanation")               # async generator 內用：不切換目前的 span，結束時呼叫 s.end()
+
+span 結束時交給 exporter，環境變數 trace_exporter 決定輸出到哪裡：
+- "jsonl"（默認）：每個 span 一行 OTLP JSON 格式，寫到 trace_path
+- "otlp"：整個 trace 結束後以 OTLP/HTTP JSON 送到 otlp_endpoint（例如本機的 OpenTelemetry Collector / Jaeger）
+- "none"：關閉
+
+python -m tracing summary                  # 以樹狀列出最近一次查核每個階段的耗時
+python -m tracing summary --trace <trace_id>
+"""
+import os
+import json
+import time
+import inspect
+import secrets
+import argparse
+import functools
+import threading
+import contextvars
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACE_EXPORTER = os.getenv("trace_exporter", "jsonl")
+TRACE_PATH = os.getenv("trace_path", ".cache/traces.jsonl")
+OTLP_ENDPOINT = os.getenv("otlp_endpoint", "http://localhost:4318")
+SERVICE_NAME = os.getenv("trace_service_name", "askcna-factcheck")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+### Span
+class Span:
+    def __init__(self, name, parent=None, attributes=None, trace_id=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = {}
+        self.status = "ok"
+        self.error = None
+        self._token = None
+        self.set_attributes(**(attributes or {}))
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+        return self
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+        return self
+
+    def record_error(self, error):
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            get_exporter().export(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_error(exc)
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.status == "error" else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """trace_exporter=none 時使用，介面與 Span 相同"""
+    trace_id = span_id = parent_id = None
+    duration_ms = 0.0
+
+    def set_attribute(self, key, value):
+        return self
+
+    def set_attributes(self, **attributes):
+        return self
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def _from_otlp_value(value):
+    if "intValue" in value:
+        return int(value["intValue"])
+    if "arrayValue" in value:
+        return [_from_otlp_value(item) for item in value["arrayValue"].get("values", [])]
+    return next(iter(value.values()), None)
+
+
+### 建立 span
+def span(name, trace_id=None, **attributes):
+    """
+    建立子 span 並在 with 區塊內成為目前的 span
+    :param trace_id: 沒有父 span 時沿用的 trace id，讓分次執行的步驟（例如 Streamlit 的多次 rerun）歸在同一個 trace
+    """
+    if TRACE_EXPORTER == "none":
+        return _NOOP_SPAN
+    return Span(name, _current_span.get(), attributes, trace_id)
+
+
+def start_span(name, **attributes):
+    """建立子 span 但不切換目前的 span，適合 async generator；結束時呼叫 end()"""
+    return span(name, **attributes)
+
+
+def current_span():
+    return _current_span.get() or _NOOP_SPAN
+
+
+def set_attributes(**attributes):
+    """設定目前 span 的屬性，沒有 span 時不做事"""
+    current_span().set_attributes(**attributes)
+
+
+def traced(name=None, **attributes):
+    """把整個函式包成一個 span，名稱默認為函式名稱"""
+    def decorator(func):
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, **attributes):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+### Exporter
+class JsonlExporter:
+    """每個 span 一行 OTLP JSON，附上 service 名稱"""
+
+    def __init__(self, path=TRACE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def export(self, span):
+        line = json.dumps({"service": SERVICE_NAME, **span.to_otlp()}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class OtlpHttpExporter:
+    """
+    以 OTLP/HTTP JSON 送出；同一個 trace 的 span 先暫存，根 span 結束時一次送出，送出在背景執行緒不影響查核延遲
+    """
+
+    def __init__(self, endpoint=OTLP_ENDPOINT, max_pending=2048):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.max_pending = max_pending
+        self._pending = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._pending[span.trace_id].append(span.to_otlp())
+            if span.parent_id is not None and len(self._pending[span.trace_id]) < self.max_pending:
+                return
+            batch = self._pending.pop(span.trace_id)
+        threading.Thread(target=self._post, args=(batch,), daemon=True).start()
+
+    def _post(self, spans):
+        from clients import get_http_session
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "askcna.tracing"}, "spans": spans}],
+        }]}
+        try:
+            get_http_session().post(self.url, json=payload, timeout=(2, 5))
+        except Exception as e:
+            print(f"[Error] 送出 trace 失敗: {e}")
+
+
+class _NoopExporter:
+    def export(self, span):
+        pass
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = {"jsonl": JsonlExporter, "otlp": OtlpHttpExporter}.get(TRACE_EXPORTER, _NoopExporter)()
+    return _exporter
+
+
+def set_exporter(exporter):
+    """替換 exporter，例如測試時收集到 list"""
+    global _exporter
+    _exporter = exporter
+
+
+### 讀取 JSONL 並以樹狀列出
+def load_traces(path=TRACE_PATH):
+    """回傳 {trace_id: [span dict, ...]}，依檔案順序"""
+    traces = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                traces[item["traceId"]].append(item)
+    return traces
+
+
+def format_trace(spans):
+    children = defaultdict(list)
+    for item in spans:
+        children[item.get("parentSpanId")].append(item)
+    for items in children.values():
+        items.sort(key=lambda item: int(item["startTimeUnixNano"]))
+    origin = min(int(item["startTimeUnixNano"]) for item in spans)
+    known = {item["spanId"] for item in spans}
+    # 父 span 不在檔案裡（例如程式中斷）時，當作根 span 顯示
+    roots = [item for item in spans if item.get("parentSpanId") not in known]
+    roots.sort(key=lambda item: int(item["startTimeUnixNano"]))
+
+    lines = []
+
+    def walk(item, depth):
+        start = (int(item["startTimeUnixNano"]) - origin) / 1e6
+        duration = (int(item["endTimeUnixNano"]) - int(item["startTimeUnixNano"])) / 1e6
+        attributes = " ".join(f"{attr['key']}={_from_otlp_value(attr['value'])}" for attr in item.get("attributes", []))
+        error = f"  [錯誤] {item['status'].get('message')}" if item.get("status", {}).get("code") == 2 else ""
+        lines.append(f"{start:>9.0f} ms {duration:>9.0f} ms  {'  ' * depth}{item['name']}  {attributes}{error}")
+        for child in children.get(item["spanId"], []):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查核流程 trace")
+    parser.add_argument("command", choices=["summary", "list"])
+    parser.add_argument("--path", default=TRACE_PATH)
+    parser.add_argument("--trace", default=None, help="trace id，默認為最近一次")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    traces = load_traces(args.path)
+    if args.command == "list":
+        for trace_id, spans in list(traces.items())[-args.limit:]:
+            root = min(spans, key=lambda item: int(item["startTimeUnixNano"]))
+            duration = (max(int(item["endTimeUnixNano"]) for item in spans) - int(root["startTimeUnixNano"])) / 1e9
+            print(f"{trace_id}  {root['name']:<20} {len(spans):>4} spans  {duration:>8.2f} 秒")
+    else:
+        trace_id = args.trace or next(reversed(traces))
+        print(f"trace {trace_id}")
+        print(f"{'開始':>12} {'耗時':>12}  階段")
+        print(format_trace(traces[trace_id]))
@@ -0,0 +1,238 @@
+"""
+OpenAI 用量帳本
+
+每一次 OpenAI 呼叫（embedding、相關性判斷、agent run）記錄一筆：查核 ID、階段、模型、輸入 / 快取 / 輸出 token 與延遲。
+查核 ID 放在獨立的 contextvar（fact_check_scope），與 tracing 是否開啟無關；app.py 以 session 的 fact_check_id 設定，
+同一次查核在不同 rerun 執行的步驟也會歸在一起。沒有設定時才沿用目前 span 的 trace id。
+
+費用在產生報表時才依 MODEL_PRICES 計算，調整價格後舊的紀錄也會以新價格重算。
+延遲是各次呼叫的加總；併發的相關性判斷彼此重疊，實際等待時間請看 tracing 的 span。
+
+python -m usage_ledger report                    # 依階段彙總最近 24 小時的用量、費用與延遲
+python -m usage_ledger report --by model --hours 168
+python -m usage_ledger report --by fact_check    # 每次查核的總用量
+python -m usage_ledger show <fact_check_id>      # 單次查核各階段的用量
+"""
+import os
+import json
+import time
+import secrets
+import sqlite3
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from tracing import current_span
+
+load_dotenv()
+
+USAGE_LEDGER_ENABLED = os.getenv("usage_ledger", "true").lower() == "true"
+USAGE_LEDGER_PATH = os.getenv("usage_ledger_path", ".cache/usage.sqlite")
+# agent 沒有指定 model 時由 Agents SDK 決定，帳本以此名稱記錄
+AGENT_DEFAULT_MODEL = os.getenv("agent_default_model", "gpt-4.1")
+
+# 每百萬 token 的美元價格：(輸入, 快取輸入, 輸出)；可用環境變數 usage_prices 以相同格式的 JSON 覆寫或新增
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "text-embedding-3-large": (0.13, 0.13, 0.0),
+    "text-embedding-3-small": (0.02, 0.02, 0.0),
+}
+MODEL_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv("usage_prices", "{}")).items()})
+
+REPORT_GROUPS = {"stage": "stage", "model": "model", "fact_check": "fact_check_id"}
+
+_fact_check_id = contextvars.ContextVar("fact_check_id", default=None)
+
+
+def new_fact_check_id():
+    """與 trace id 同格式，tracing 開啟時可直接當作該次查核的 trace id"""
+    return secrets.token_hex(16)
+
+
+@contextmanager
+def fact_check_scope(fact_check_id):
+    """區塊內（含複製 context 的執行緒、asyncio task）的 OpenAI 用量都記在 fact_check_id 底下"""
+    token = _fact_check_id.set(fact_check_id)
+    try:
+        yield fact_check_id
+    finally:
+        _fact_check_id.reset(token)
+
+
+def current_fact_check_id():
+    return _fact_check_id.get() or current_span().trace_id
+
+
+def usage_cost(model, input_tokens, cached_tokens, output_tokens):
+    """美元費用；沒有價格的模型回傳 None"""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price + output_tokens * output_price) / 1e6
+
+
+class UsageLedger:
+    """
+    :param path: SQLite 檔案路徑
+    """
+
+    def __init__(self, path=USAGE_LEDGER_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " fact_check_id TEXT NOT NULL,"
+            " stage TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " requests INTEGER NOT NULL,"
+            " input_tokens INTEGER NOT NULL,"
+            " cached_tokens INTEGER NOT NULL,"
+            " output_tokens INTEGER NOT NULL,"
+            " latency_ms REAL NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_fact_check ON usage(fact_check_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_created ON usage(created_at)")
+
+    ### 寫入
+    def record(self, stage, model, input_tokens=0, output_tokens=0, cached_tokens=0, latency=0.0, requests=1,
+               fact_check_id=None):
+        """
+        :param latency: 秒
+        :param fact_check_id: 默認為 fact_check_scope 設定的查核 ID，沒有時為目前 span 的 trace id
+        """
+        if fact_check_id is None:
+            fact_check_id = current_fact_check_id() or ""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO usage (fact_check_id, stage, model, requests, input_tokens, cached_tokens, output_tokens,"
+                " latency_ms, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (fact_check_id, stage, model, requests, input_tokens or 0, cached_tokens or 0, output_tokens or 0,
+                 latency * 1000, time.time()))
+
+    ### 報表
+    def report(self, by="stage", hours=24, fact_check_id=None):
+        """
+        依 by（"stage" / "model" / "fact_check"）彙總，費用與延遲附上占總數的比例，依費用由高到低排序
+        :param fact_check_id: 只看單次查核
+        """
+        column = REPORT_GROUPS[by]
+        where, params = "created_at >= ?", [time.time() - hours * 3600]
+        if fact_check_id is not None:
+            where, params = "fact_check_id = ?", [fact_check_id]
+        # 費用依模型計算，先以 (分組, 模型) 彙總再合併
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {column}, model, COUNT(*), SUM(requests), SUM(input_tokens), SUM(cached_tokens), SUM(output_tokens),"
+                f" SUM(latency_ms), MIN(created_at) FROM usage WHERE {where} GROUP BY {column}, model", params).fetchall()
+
+        groups = {}
+        for key, model, calls, requests, input_tokens, cached_tokens, output_tokens, latency_ms, started_at in rows:
+            group = groups.setdefault(key, {
+                by: key, "calls": 0, "requests": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0,
+                "cost": 0.0, "latency_ms": 0.0, "started_at": started_at, "unpriced_models": [],
+            })
+            group["calls"] += calls
+            group["requests"] += requests
+            group["input_tokens"] += input_tokens
+            group["cached_tokens"] += cached_tokens
+            group["output_tokens"] += output_tokens
+            group["latency_ms"] += latency_ms
+            group["started_at"] = min(group["started_at"], started_at)
+            cost = usage_cost(model, input_tokens, cached_tokens, output_tokens)
+            if cost is None:
+                group["unpriced_models"].append(model)
+            else:
+                group["cost"] += cost
+
+        total_cost = sum(group["cost"] for group in groups.values()) or 1.0
+        total_latency = sum(group["latency_ms"] for group in groups.values()) or 1.0
+        for group in groups.values():
+            group["cost_share"] = group["cost"] / total_cost
+            group["latency_share"] = group["latency_ms"] / total_latency
+            group["avg_latency_ms"] = group["latency_ms"] / group["calls"]
+        return sorted(groups.values(), key=lambda group: group["cost"], reverse=True)
+
+    def summary(self, fact_check_id):
+        """單次查核的總用量，一行文字，給 log 使用"""
+        stages = self.report("stage", fact_check_id=fact_check_id)
+        if not stages:
+            return "無用量紀錄"
+        total = {key: sum(stage[key] for stage in stages) for key in ("calls", "input_tokens", "cached_tokens", "output_tokens", "cost")}
+        top = stages[0]
+        return (f"{total['calls']} 次呼叫，輸入 {total['input_tokens']}（快取 {total['cached_tokens']}）/ 輸出 {total['output_tokens']} tokens，"
+                f"約 ${total['cost']:.4f}，最高為 {top['stage']}（{top['cost_share']:.0%}）")
+
+    def prune(self, days=90):
+        with self._lock:
+            return self._conn.execute("DELETE FROM usage WHERE created_at < ?", (time.time() - days * 86400,)).rowcount
+
+
+class _NoopLedger:
+    def record(self, *args, **kwargs):
+        pass
+
+    def summary(self, fact_check_id):
+        return "用量帳本未啟用"
+
+
+_usage_ledger = None
+_usage_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger():
+    global _usage_ledger
+    with _usage_ledger_lock:
+        if _usage_ledger is None:
+            _usage_ledger = UsageLedger() if USAGE_LEDGER_ENABLED else _NoopLedger()
+        return _usage_ledger
+
+
+def record_usage(stage, model, input_tokens=0, output_tokens=0, cached_tokens=0, latency=0.0, requests=1):
+    """記錄一次 OpenAI 呼叫，帳本寫入失敗不影響查核"""
+    try:
+        get_usage_ledger().record(stage, model, input_tokens, output_tokens, cached_tokens, latency, requests)
+    except Exception as e:
+        print(f"[Error] 用量紀錄寫入失敗: {str(e)}")
+
+
+def format_report(groups, by):
+    lines = [f"{by:<34} {'呼叫':>6} {'輸入':>10} {'快取':>10} {'輸出':>9} {'費用(USD)':>11} {'占比':>6} {'平均延遲':>10} {'延遲占比':>8}"]
+    for group in groups:
+        name = str(group[by] or "-")
+        if by == "fact_check":
+            name = f"{datetime.fromtimestamp(group['started_at']):%m-%d %H:%M} {name[:20]}"
+        unpriced = f"  （未計價：{', '.join(group['unpriced_models'])}）" if group["unpriced_models"] else ""
+        lines.append(f"{name:<34} {group['calls']:>6} {group['input_tokens']:>10} {group['cached_tokens']:>10} {group['output_tokens']:>9} "
+                     f"{group['cost']:>11.4f} {group['cost_share']:>6.0%} {group['avg_latency_ms']:>8.0f}ms {group['latency_share']:>8.0%}{unpriced}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI 用量帳本")
+    parser.add_argument("command", choices=["report", "show", "prune"])
+    parser.add_argument("fact_check_id", nargs="?")
+    parser.add_argument("--by", choices=sorted(REPORT_GROUPS), default="stage")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--days", type=int, default=90, help="prune 保留的天數")
+    args = parser.parse_args()
+
+    ledger = UsageLedger()
+    if args.command == "report":
+        print(format_report(ledger.report(args.by, args.hours), args.by))
+    elif args.command == "show":
+        print(format_report(ledger.report("stage", fact_check_id=args.fact_check_id), "stage"))
+        print(f"[Info] {ledger.summary(args.fact_check_id)}")
+    else:
+        print(f"[Info] 刪除 {ledger.prune(args.days)} 筆用量紀錄")
@@ -0,0 +1,313 @@
+"""
+本機向量鏡像
+
+把 ES 上近期的 CNA 社稿與全部 TFC 查核報告的 embedding 存成本機 memory-mapped 矩陣，
+metadata 存在 SQLite，查詢時直接用矩陣乘法算 cosine，不必經過網路；
+ES 叢集慢或連不上時也可以離線查詢。
+
+- 向量先正規化成單位長度，float32 存放；dtype="int8" 時以 127 倍量化，檔案只有 1/4
+- 向量檔只會往後附加，被新資料取代或超出時間窗的文件標記為 inactive，compact() 時才重寫
+- 以排序欄位（CNA 為 pid、TFC 為 date）做增量同步，只會抓到排序值不小於上次同步位置的文件；
+  ES 上既有的舊文件被更新（例如重算 embedding、修改內容）或刪除時不會反映到鏡像，需要執行 rebuild 全量重建
+
+python -m vector_mirror sync            # 同步 CNA 與 TFC
+python -m vector_mirror rebuild         # 全量重建，套用舊文件的更新與刪除
+python -m vector_mirror search "要查核的文本"
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from elasticsearch import helpers
+from dotenv import load_dotenv
+
+from quantization import INT8_SCALE
+
+load_dotenv()
+
+MIRROR_DIR = os.getenv("vector_mirror_dir", ".cache/mirror")
+MIRROR_CNA_DAYS = int(os.getenv("vector_mirror_cna_days", "120"))
+MIRROR_DTYPE = os.getenv("vector_mirror_dtype", "float32")
+SEARCH_CHUNK_ROWS = 65536
+
+
+class VectorMirror:
+    """
+    :param name: 鏡像名稱，決定檔名
+    :param dims: 向量維度
+    :param dtype: "float32" 或 "int8"
+    """
+
+    def __init__(self, name, directory=MIRROR_DIR, dims=3072, dtype=MIRROR_DTYPE):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"不支持的 dtype: {dtype}")
+        os.makedirs(directory, exist_ok=True)
+        self.name = name
+        self.dims = dims
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(directory, f"{name}.{dtype}.vectors")
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(directory, f"{name}.sqlite"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            " row INTEGER PRIMARY KEY,"
+            " doc_id TEXT NOT NULL,"
+            " sort_key TEXT NOT NULL,"
+            " active INTEGER NOT NULL DEFAULT 1,"
+            " source TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_docs_doc_id ON docs(doc_id, active)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_docs_sort_key ON docs(sort_key)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._reload()
+
+    ### 載入
+    def _reload(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM docs").fetchone()[0]
+            if rows and os.path.exists(self.vectors_path):
+                self._matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(rows, self.dims))
+            else:
+                self._matrix = np.zeros((0, self.dims), dtype=self.dtype)
+            self._active = np.zeros(rows, dtype=bool)
+            for (row,) in self._conn.execute("SELECT row FROM docs WHERE active = 1"):
+                self._active[row] = True
+
+    def __len__(self):
+        return int(self._active.sum())
+
+    def get_state(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    ### 寫入
+    def _encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype == np.int8:
+            return np.clip(np.round(vectors * INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors
+
+    def add(self, docs, reload=True):
+        """
+        :param docs: [(doc_id, sort_key, vector, source), ...]；同一個 doc_id 已存在時以新資料取代
+        :param reload: 是否重新載入向量檔；連續寫入多批時（sync）最後再載入一次，避免每批都重新 map 整個檔案
+        """
+        if not docs:
+            return 0
+        with self._lock:
+            # 尚未 reload 時 self._active 不含前幾批，列號以資料庫為準
+            start = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM docs").fetchone()[0]
+            encoded = self._encode([vector for _, _, vector, _ in docs])
+            with open(self.vectors_path, "ab") as f:
+                f.write(encoded.tobytes())
+            self._conn.executemany("UPDATE docs SET active = 0 WHERE doc_id = ? AND active = 1",
+                                   [(doc_id,) for doc_id, _, _, _ in docs])
+            self._conn.executemany(
+                "INSERT INTO docs (row, doc_id, sort_key, active, source) VALUES (?, ?, ?, 1, ?)",
+                [(start + i, doc_id, sort_key, json.dumps(source, ensure_ascii=False))
+                 for i, (doc_id, sort_key, _, source) in enumerate(docs)],
+            )
+            self._conn.commit()
+            if reload:
+                self._reload()
+        return len(docs)
+
+    def prune(self, min_sort_key):
+        """把排序欄位早於 min_sort_key 的文件標記為 inactive（時間窗外的舊稿）"""
+        with self._lock:
+            cursor = self._conn.execute("UPDATE docs SET active = 0 WHERE active = 1 AND sort_key < ?", (min_sort_key,))
+            self._conn.commit()
+            self._reload()
+            return cursor.rowcount
+
+    def compact(self):
+        """重寫向量檔，移除 inactive 的列"""
+        with self._lock:
+            rows = [row for (row,) in self._conn.execute("SELECT row FROM docs WHERE active = 1 ORDER BY row")]
+            tmp_path = self.vectors_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(rows), SEARCH_CHUNK_ROWS):
+                    f.write(np.ascontiguousarray(self._matrix[rows[start:start + SEARCH_CHUNK_ROWS]]).tobytes())
+            self._conn.execute("DELETE FROM docs WHERE active = 0")
+            self._conn.executemany("UPDATE docs SET row = ? WHERE row = ?", [(i, row) for i, row in enumerate(rows)])
+            self._conn.commit()
+            self._matrix = None
+            os.replace(tmp_path, self.vectors_path)
+            self._reload()
+
+    ### 同步
+    def sync(self, es, index, embedding_column_name, id_field, sort_field, source_fields, min_sort_key=None, batch_size=500,
+             full=False):
+        """
+        從 ES 增量同步：只抓排序欄位 >= 上次同步位置（且 >= min_sort_key）的文件
+        排序值在同步位置之前的文件即使在 ES 上被更新也不會重抓，要套用這類更新請用 rebuild
+        :param min_sort_key: 時間窗起點，同時會把鏡像中更早的文件標記為 inactive
+        :param full: 忽略上次同步位置，重新抓取時間窗內的全部文件
+        :return: 新增或更新的文件數
+        """
+        start_time = time.time()
+        cursor = None if full else self.get_state("cursor")
+        lower = max(key for key in (cursor, min_sort_key) if key) if (cursor or min_sort_key) else None
+        query = {"exists": {"field": embedding_column_name}}
+        if lower:
+            query = {"bool": {"must": [query, {"range": {sort_field: {"gte": lower}}}]}}
+
+        fields = list(dict.fromkeys(source_fields + [id_field, sort_field, embedding_column_name]))
+        known = {}
+        if cursor:
+            # 邊界上（sort_key == cursor）的文件可能已經同步過，用 doc_id 排除
+            with self._lock:
+                known = {doc_id for (doc_id,) in self._conn.execute(
+                    "SELECT doc_id FROM docs WHERE active = 1 AND sort_key = ?", (cursor,))}
+
+        batch, added, max_key = [], 0, cursor
+        for hit in helpers.scan(es, index=index, query={"query": query, "_source": fields}, size=batch_size):
+            source = hit['_source']
+            doc_id = str(source.get(id_field) or hit['_id'])
+            sort_key = str(source.get(sort_field, ""))
+            vector = source.pop(embedding_column_name, None)
+            if not vector or len(vector) != self.dims or doc_id in known:
+                continue
+            batch.append((doc_id, sort_key, vector, source))
+            max_key = max(max_key or sort_key, sort_key)
+            if len(batch) >= batch_size:
+                added += self.add(batch, reload=False)
+                batch = []
+        added += self.add(batch, reload=False)
+        with self._lock:
+            self._reload()
+
+        if max_key:
+            self.set_state("cursor", max_key)
+        if min_sort_key:
+            self.prune(min_sort_key)
+        print(f"[Info] 鏡像 {self.name} 同步 {added} 筆，目前 {len(self)} 筆，耗時 {time.time() - start_time:.2f} 秒")
+        return added
+
+    def rebuild(self, es, index, embedding_column_name, id_field, sort_field, source_fields, min_sort_key=None, batch_size=500):
+        """
+        全量重建：重新抓取全部文件取代舊資料，ES 上已刪除的文件標記為 inactive，最後 compact
+        重建中途失敗時舊資料仍然有效，可以直接重跑
+        :return: 重建後的文件數
+        """
+        with self._lock:
+            start = len(self._active)
+        self.sync(es, index, embedding_column_name, id_field, sort_field, source_fields, min_sort_key, batch_size, full=True)
+        with self._lock:
+            # 重建前就存在、這次沒有被新資料取代的列，代表文件已不在 ES（或已沒有 embedding）
+            removed = self._conn.execute("UPDATE docs SET active = 0 WHERE active = 1 AND row < ?", (start,)).rowcount
+            self._conn.commit()
+            self._reload()
+        self.compact()
+        print(f"[Info] 鏡像 {self.name} 重建完成，移除 {removed} 筆，目前 {len(self)} 筆")
+        return len(self)
+
+    ### 查詢
+    def search(self, query_vector, k=10):
+        """
+        回傳與 es_vector_search 相同格式的 hits，_score 為 cosine + 1
+        """
+        with self._lock:
+            matrix, active = self._matrix, self._active
+        if not active.any():
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        scores = np.empty(len(active), dtype=np.float32)
+        for start in range(0, len(active), SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(matrix[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32)
+            scores[start:start + len(chunk)] = chunk @ query
+        if self.dtype == np.int8:
+            scores /= INT8_SCALE
+        scores[~active] = -np.inf
+
+        k = min(k, int(active.sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        placeholders = ",".join("?" * len(top))
+        with self._lock:
+            rows = {row: (doc_id, source) for row, doc_id, source in self._conn.execute(
+                f"SELECT row, doc_id, source FROM docs WHERE row IN ({placeholders})", [int(row) for row in top])}
+        return [
+            {"_index": self.name, "_id": rows[int(row)][0], "_score": float(scores[row]) + 1.0,
+             "_source": json.loads(rows[int(row)][1])}
+            for row in top if int(row) in rows
+        ]
+
+
+### CNA / TFC 鏡像
+# 鏡像固定從原始的 3072 維索引同步，與 functions 查詢的索引（可能是降維索引）無關
+CNA_MIRROR_INDEX = "lab_mainsite_search"
+TFC_MIRROR_INDEX = "lab_tfc_search_test"
+CNA_MIRROR_FIELDS = ["h1", "dt", "article", "whatHappen200", "pid"]
+TFC_MIRROR_FIELDS = ["title", "date", "full_content", "summary", "label", "link"]
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(index):
+    with _mirrors_lock:
+        if index not in _mirrors:
+            _mirrors[index] = VectorMirror(index)
+        return _mirrors[index]
+
+
+def mirror_available(index):
+    return os.path.exists(os.path.join(MIRROR_DIR, f"{index}.sqlite")) and len(get_mirror(index)) > 0
+
+
+def sync_mirrors(es, cna_days=MIRROR_CNA_DAYS, rebuild=False):
+    """
+    同步近 cna_days 天的 CNA 社稿（以 pid 前 8 碼為日期）與全部 TFC 查核報告
+    :param rebuild: True 時全量重建，套用舊文件的更新與刪除
+    """
+    min_pid = f"{datetime.now() - timedelta(days=cna_days):%Y%m%d}0000"
+    cna_mirror, tfc_mirror = get_mirror(CNA_MIRROR_INDEX), get_mirror(TFC_MIRROR_INDEX)
+    cna_sync = cna_mirror.rebuild if rebuild else cna_mirror.sync
+    tfc_sync = tfc_mirror.rebuild if rebuild else tfc_mirror.sync
+    cna_sync(es, CNA_MIRROR_INDEX, "embeddings", "pid", "pid", CNA_MIRROR_FIELDS, min_sort_key=min_pid)
+    tfc_sync(es, TFC_MIRROR_INDEX, "embeddings", "link", "date", TFC_MIRROR_FIELDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本機向量鏡像")
+    parser.add_argument("command", choices=["sync", "rebuild", "compact", "search"])
+    parser.add_argument("text", nargs="?")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command in ("sync", "rebuild"):
+        from es_SearchLib import es
+        sync_mirrors(es, rebuild=args.command == "rebuild")
+    elif args.command == "compact":
+        for index in (CNA_MIRROR_INDEX, TFC_MIRROR_INDEX):
+            get_mirror(index).compact()
+    else:
+        if not args.text:
+            sys.exit("請輸入要查詢的文本")
+        from functions import text_embeddings_3
+        embedding = text_embeddings_3(args.text)
+        for index in (CNA_MIRROR_INDEX, TFC_MIRROR_INDEX):
+            start = time.perf_counter()
+            hits = get_mirror(index).search(embedding, args.k)
+            print(f"\n[{index}] {(time.perf_counter() - start) * 1000:.2f} ms")
+            for hit in hits:
+                print(f"  {hit['_score']:.4f}  {hit['_id']}  {hit['_source'].get('h1') or hit['_source'].get('title', '')}")